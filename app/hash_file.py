@@ -1,23 +1,39 @@
 import argparse
+import bisect
 import concurrent
+import contextlib
 import csv
 import hashlib
+import heapq
+import itertools
+import json
 import logging
+import logging.handlers
+import mmap
+import multiprocessing
 import os
 import pathlib
+import sqlite3
+import stat
 import sys
-from concurrent.futures import ProcessPoolExecutor
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from multiprocessing import cpu_count
-from typing import List, Generator
+from typing import List, Generator, NamedTuple
 
 app_name = "hash-file-multiprocessor"
 __author__ = "MY"
 # run python ../update_build.py to auto increment this build number based on git revision number
 __app_build_number__ = 74
 __version__ = f"1.1.2-{__app_build_number__}"
-description = rf"SHA-1 hash all files (with multi processing)"
+description = rf"Hash all files, SHA-1 by default (with multi processing)"
 
 history = """
 20 Oct 2022 1.1.2   1) Added relative-path to the default output and replaced the simple output file path with relative
@@ -42,46 +58,208 @@ A_MB: int = A_KB * A_KB  # 1024 bytes * 1024 is an MB
 A_GB: int = A_MB * A_KB
 A_TB: int = A_GB * A_KB
 max_hash_size_default: int = A_GB  # in bytes - maximum size of file to hash
+read_buffer_size_default: int = A_MB  # in bytes - size of the reusable buffer each file is read into
+mmap_threshold_default: int = 0  # files of this size or more are hashed through mmap (0 is none), see mmap_into_hashes
+mmap_window_size_default: int = 64 * A_MB  # mmap engine: bytes of a file mapped at a time
 first_n_files: int | None = None  # process the first n files, for testing
-cores = cpu_count() - 1  # processor cpu cores to use - leave one for the OS to use
-hash_function = hashlib.sha1()
-hash_function_name = hash_function.name
+cores = max(cpu_count() - 1, 1)  # processor cpu cores to use - leave one for the OS to use
+in_flight_per_core_default: int = 4  # tasks (batches of files) submitted to the executor but not yet reported, per core
+executor_types: tuple = ("process", "thread", "hybrid")
+executor_default: str = "process"
+hybrid_threshold_default: int = A_MB  # hybrid executor: files of this size or more are hashed by threads
+small_file_size_default: int = 0  # files smaller than this are hashed in the main process (0 is none), see InlineExecutor
+rotational_device_readers_default: int = 1  # --device-readers auto: files read at a time from a spinning disk
+walk_threads_default: int = 8  # threads listing folders at the same time, listing releases the GIL
+batch_size_max_default: int = 1024  # most files sent to a worker in one task when the batch size is adaptive
+batch_target_seconds_default: float = 0.05  # adaptive batch size aims for tasks that take about this long
+hash_names_default: tuple = ("sha1",)  # hashlib names of the hash(es) to calculate, all in the one read of a file
+# hashes with a fixed size digest that hashlib always has, so a report can be reproduced on any computer
+supported_hash_names: list = sorted(
+    name for name in hashlib.algorithms_guaranteed if not name.startswith("shake")
+)
+# report column names (default output) for the hashlib names, any not listed use the hashlib name
+hash_column_names: dict = {
+    "sha1": "sha-1",
+    "sha224": "sha-224",
+    "sha256": "sha-256",
+    "sha384": "sha-384",
+    "sha512": "sha-512",
+}
 default_scan_location = pathlib.Path(r"C:")
 case_label_default: str = "no-case"
 simple_output_default: bool = False
 report_default: pathlib.Path = pathlib.Path().cwd() / "hash_report.csv"
+diff_report_default: pathlib.Path = pathlib.Path().cwd() / "diff_report.csv"
+verify_report_default: pathlib.Path = pathlib.Path().cwd() / "verify_report.csv"
+segment_size_default: int = 64 * A_MB  # bytes in each segment of a tree hash (--tree-hash)
+partial_hash_size_default: int = 4 * A_KB  # bytes from the start and from the end of a file for the partial hash
+# --into-archives: archive type by the end of the file name (lower case)
+archive_types: dict = {
+    ".zip": "zip",
+    ".tar": "tar",
+    ".tar.gz": "compressed tar",
+    ".tgz": "compressed tar",
+    ".tar.bz2": "compressed tar",
+    ".tbz2": "compressed tar",
+    ".tar.xz": "compressed tar",
+    ".txz": "compressed tar",
+}
+archive_member_separator: str = "!/"  # in the path of a file in an archive e.g. archive.zip!/inner/file.txt
+checkpoint_rows_default: int = 10_000  # report rows between checkpoints of the scan journal
+checkpoint_seconds_default: float = 30.0  # or seconds, whichever comes first
+cache_max_entries_default: int = 10_000_000  # rows (one per file per hash) kept in the hash cache
+stats_slowest_files_default: int = 10  # the slowest files listed in the --stats file
+report_formats: tuple = ("csv", "sqlite")
+report_format_default: str = "csv"
+report_batch_rows_default: int = 1000  # sqlite report: rows inserted in one executemany
+compare_chunk_rows_default: int = 1_000_000  # compare: report rows sorted in memory at a time
+known_hash_sort_chunk_default: int = 1_000_000  # known hash index: digests sorted in memory at a time
+known_hash_index_magic: bytes = b"HFKNOWN1"  # start of a known hash index file, followed by the hash name
+known_hash_index_header_size: int = 32
+
+
+def get_hash_column_name(hash_name: str, simple_output: bool = simple_output_default) -> str:
+    """the report column for a hash, the hashlib name in the simple output e.g. sha1, otherwise e.g. sha-1"""
+    if simple_output:
+        return hash_name
+    return hash_column_names.get(hash_name, hash_name)
+
+
+def get_tree_hash_column_name(hash_name: str, simple_output: bool = simple_output_default) -> str:
+    """the report column for the tree hash (--tree-hash) of a file over the maximum hash size e.g. tree-sha1"""
+    return f"tree-{get_hash_column_name(hash_name, simple_output)}"
+
+
+def get_csv_report_header(
+        hash_names: tuple = hash_names_default,
+        simple_output: bool = simple_output_default,
+        tree_hash: bool = False,
+        known_hashes: bool = False,
+) -> list:
+    """
+    Build the csv report header with a column for each hash (in the order given)
+    the default output also has an uppercase column for each hash
+    with tree_hash there is also a tree hash column for each hash, after the hash error
+    with known_hashes there is also a known-hash column (the known hash lists the file is in), after those
+    """
+    after_error_columns = []
+    if tree_hash:
+        after_error_columns = [get_tree_hash_column_name(hash_name, simple_output) for hash_name in hash_names]
+    if known_hashes:
+        after_error_columns.append("known-hash")
+    if simple_output:
+        return [
+            "case-label",
+            "relative-path",
+            *hash_names,
+            "hash-error",
+            *after_error_columns,
+            "size",
+            "created",
+            "modified",
+            "file-name",
+            "file-extension",
+        ]
+
+    hash_columns = []
+    for hash_name in hash_names:
+        column = get_hash_column_name(hash_name, simple_output)
+        hash_columns += [column, f"{column}-uc"]
+    return [
+        "case-label",
+        "path",
+        *hash_columns,
+        "hash-error",
+        *after_error_columns,
+        "size",
+        "created",
+        "created-time",
+        "modified",
+        "modified-time",
+        "file-name",
+        "file-extension",
+    ]
+
+
+def get_csv_duplicates_header(
+        hash_names: tuple = hash_names_default,
+        simple_output: bool = simple_output_default,
+) -> list:
+    """the csv header of the duplicates report (--duplicates), one row per file in a group of duplicate files"""
+    return [
+        "group",
+        "files",
+        "size",
+        "reclaimable-bytes",
+        *[get_hash_column_name(hash_name, simple_output) for hash_name in hash_names],
+        "relative-path" if simple_output else "path",
+        "file-name",
+    ]
 
-_csv_report_header_simple_ = [
-    "case-label",
+
+def get_csv_diff_header(path_column: str, hash_columns: list) -> list:
+    """the csv header of the diff report (compare), one row per file added, removed or changed"""
+    return [
+        "change",
+        path_column,
+        "old-size",
+        "new-size",
+        *[f"{prefix}-{column}" for column in hash_columns for prefix in ("old", "new")],
+        "old-modified",
+        "new-modified",
+    ]
+
+
+def get_csv_verify_header(hash_names: tuple = hash_names_default) -> list:
+    """the csv header of the verify report (--verify), one row per file that is missing, extra or does not match"""
+    return [
+        "status",
+        "relative-path",
+        "expected-size",
+        "size",
+        *[f"{prefix}{hash_name}" for hash_name in hash_names for prefix in ("expected-", "")],
+        "error",
+    ]
+
+
+_csv_segments_header_ = [
+    "path",
     "relative-path",
-    hash_function.name,
-    "hash-error",
-    "size",
-    "created",
-    "modified",
-    "file-name",
-    "file-extension",
+    "hash",
+    "segment",
+    "offset",
+    "length",
+    "digest",
 ]
 
-_csv_report_header_ = [
-    "case-label",
-    "path",
-    "sha-1",
-    "sha-1-uc",
-    "hash-error",
-    "size",
-    "created",
-    "created-time",
-    "modified",
-    "modified-time",
-    "file-name",
-    "file-extension",
+# --tree-digests: the directory digests of a report, see write_tree_digests
+_csv_digests_header_ = [
+    "directory",
+    "digest",
+    "files",
+    "bytes",
+]
+
+_csv_digests_diff_header_ = [
+    "change",
+    "directory",
+    "old-digest",
+    "new-digest",
+    "old-files",
+    "new-files",
+    "old-bytes",
+    "new-bytes",
 ]
 
+_csv_report_header_simple_ = get_csv_report_header(hash_names_default, simple_output=True)
+
+_csv_report_header_ = get_csv_report_header(hash_names_default, simple_output=False)
+
 log_format = "[%(asctime)s.%(msecs)03d] %(levelname)-8s %(name)-12s %(lineno)d %(funcName)s - %(message)s"
 log_date_format = "%Y-%m-%d %H:%M:%S"
 
-# show all messages below in order of seriousness
+# show all messages below in order of seriousness (or --log-level)
+log_levels: tuple = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
 log_level = logging.DEBUG  # shows all
 # log_level = logging.INFO  # shows info and below
 # log_level = logging.WARNING
@@ -158,6 +336,60 @@ def parse_args(parser):
         type=pathlib.Path,
     )
 
+    parser.add_argument(
+        "--verify",
+        dest="verify",
+        type=pathlib.Path,
+        default=None,
+        help=f"verify the files listed in this report (simple output) at their relative-path under the scan "
+             f"location e.g. after copying them: only the listed files are hashed, the mismatched, missing and extra "
+             f"files are written to the --report, default is: {verify_report_default}",
+    )
+
+    parser.add_argument(
+        "--known-hashes",
+        "--known_hashes",
+        dest="known_hashes",
+        type=pathlib.Path,
+        action="append",
+        default=[],
+        help="known hash list: a text file with a hex digest at the start of each line (e.g. the NSRL) or an index "
+             "built with --build-known-index, the known-hash column of the report has the names of the lists the "
+             "hash of a file is in, repeat for more than one list",
+    )
+
+    parser.add_argument(
+        "--omit-known-hashes",
+        "--omit_known_hashes",
+        dest="omit_known_hashes",
+        type=pathlib.Path,
+        action="append",
+        default=[],
+        help="known hash list (e.g. of known good files) as --known-hashes, the files with a hash in the list are "
+             "left out of the report, repeat for more than one list",
+    )
+
+    parser.add_argument(
+        "--build-known-index",
+        "--build_known_index",
+        dest="build_known_index",
+        type=pathlib.Path,
+        default=None,
+        help="build the index of the (one) --known-hashes text list to this file, then exit, the index is "
+             "memory mapped so it loads at once however many hashes there are",
+    )
+
+    parser.add_argument(
+        "--report-format",
+        "--report_format",
+        dest="report_format",
+        type=str,
+        choices=report_formats,
+        default=report_format_default,
+        help=f"csv: the report is a csv file, sqlite: the report is a table (report) in an sqlite database, "
+             f"indexed on the hash, size and path columns, default is: {report_format_default}",
+    )
+
     parser.add_argument(
         "-s",
         "--scan",
@@ -184,6 +416,237 @@ def parse_args(parser):
              "default size is: {max_hash_size_default} bytes",
     )
 
+    parser.add_argument(
+        "--hash",
+        "--hashes",
+        dest="hash_names",
+        type=str,
+        default=",".join(hash_names_default),
+        help=f"comma separated list of the hash(es) to calculate in one read of each file e.g. sha1,md5,sha256, "
+             f"default is: {','.join(hash_names_default)}, available: {','.join(supported_hash_names)}",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        help="resume an interrupted scan: skip the files already in the report (from the <report>.journal file) "
+             "and add the rest to the report",
+        action="store_true",  # no extra value after the parameter
+    )
+
+    parser.add_argument(
+        "-t",
+        "--tree-hash",
+        "--tree_hash",
+        dest="tree_hash",
+        help="files over the maximum hash size get a tree hash: the file is split into segments that are hashed "
+             "across all the cores, the tree hash is the hash of the segment digests, the segment digests are "
+             "written to the <report>.segments.csv file",
+        action="store_true",  # no extra value after the parameter
+    )
+
+    parser.add_argument(
+        "--segment-size",
+        "--segment_size",
+        dest="segment_size",
+        type=int,
+        default=segment_size_default,
+        help=f"bytes in each segment of a tree hash, default is: {segment_size_default}",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--duplicates",
+        "--find-duplicates",
+        dest="duplicates",
+        help="report groups of duplicate files rather than every file: files are grouped by size, then by a hash of "
+             "their first and last few kB, only files that still match are hashed in full",
+        action="store_true",  # no extra value after the parameter
+    )
+
+    parser.add_argument(
+        "--partial-hash-size",
+        "--partial_hash_size",
+        dest="partial_hash_size",
+        type=int,
+        default=partial_hash_size_default,
+        help=f"bytes from the start and from the end of a file in the partial hash of --duplicates, "
+             f"default is: {partial_hash_size_default}",
+    )
+
+    parser.add_argument(
+        "--cache",
+        "--hash-cache",
+        "--hash_cache",
+        dest="cache",
+        type=pathlib.Path,
+        default=None,
+        help="hash cache file (sqlite), files whose device, inode, size and modified time are unchanged since "
+             "they were cached are not read again",
+    )
+
+    parser.add_argument(
+        "--cache-max-entries",
+        "--cache_max_entries",
+        dest="cache_max_entries",
+        type=int,
+        default=cache_max_entries_default,
+        help=f"maximum rows (one per file per hash) kept in the hash cache, the least recently used are removed, "
+             f"default is: {cache_max_entries_default}",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--executor",
+        dest="executor",
+        type=str,
+        choices=executor_types,
+        default=executor_default,
+        help=f"process: hash in worker processes, thread: hash in threads (hashlib releases the GIL while it "
+             f"hashes a large buffer, no pickling), hybrid: files of --hybrid-threshold bytes or more in threads, "
+             f"smaller files in processes, default is: {executor_default}",
+    )
+
+    parser.add_argument(
+        "--hybrid-threshold",
+        "--hybrid_threshold",
+        dest="hybrid_threshold",
+        type=int,
+        default=hybrid_threshold_default,
+        help=f"with the hybrid executor files of this size (bytes) or more are hashed in threads, "
+             f"default is: {hybrid_threshold_default}",
+    )
+
+    parser.add_argument(
+        "--mmap-threshold",
+        "--mmap_threshold",
+        dest="mmap_threshold",
+        type=int,
+        default=mmap_threshold_default,
+        help=f"files of this size (bytes) or more are hashed through mmap, in windows of "
+             f"{mmap_window_size_default} bytes, not read into a buffer, e.g. {8 * A_MB}, "
+             f"process executor only, and not below --small-file-size: a file truncated while it is hashed (e.g. "
+             f"a log being written to) kills its worker with SIGBUS and the scan stops (it can be resumed), "
+             f"default is: {mmap_threshold_default} (none)",
+    )
+
+    parser.add_argument(
+        "--tree-digests",
+        "--tree_digests",
+        dest="tree_digests",
+        action="store_true",
+        help="write a Merkle digest of each folder (from the names, sizes and hashes in it) and the root digest of "
+             "the whole tree to <report>.digests.csv, two trees are the same if their root digests are. Compare "
+             "two digests files with the compare command",
+    )
+
+    parser.add_argument(
+        "--into-archives",
+        "--into_archives",
+        dest="into_archives",
+        action="store_true",
+        help=f"also hash the files in zip and tar archives ({', '.join(archive_types)}) without extracting them, "
+             f"reported as archive.zip{archive_member_separator}inner/file.txt",
+    )
+
+    parser.add_argument(
+        "--polite",
+        dest="polite",
+        action="store_true",
+        help="for a scan on a busy host: tell the os each file is read once from start to end and drop it from the "
+             "page cache after it is hashed (posix_fadvise, not on windows or macOS)",
+    )
+
+    parser.add_argument(
+        "--max-bytes-per-second",
+        "--max_bytes_per_second",
+        dest="max_bytes_per_second",
+        type=int,
+        default=0,
+        help="limit the reads of all the workers together to this many bytes per second, default is: 0 (none)",
+    )
+
+    parser.add_argument(
+        "--max-iops",
+        "--max_iops",
+        dest="max_iops",
+        type=int,
+        default=0,
+        help="limit the reads of all the workers together to this many reads (of up to --buffer-size bytes) per "
+             "second, default is: 0 (none)",
+    )
+
+    parser.add_argument(
+        "--small-file-size",
+        "--small_file_size",
+        dest="small_file_size",
+        type=int,
+        default=small_file_size_default,
+        help=f"files smaller than this (bytes) are hashed in large batches in the main process, not sent to a "
+             f"worker, e.g. 4097 for files of up to 4 kB, default is: {small_file_size_default} (none)",
+    )
+
+    parser.add_argument(
+        "--device-readers",
+        "--device_readers",
+        dest="device_readers",
+        type=str,
+        default=None,
+        help=f"batches of files read from a disk (st_dev) at the same time, a number for every disk or auto: "
+             f"{rotational_device_readers_default} for a spinning disk (linux, from /sys/block) and no limit for the "
+             f"rest, the files of a batch are read in inode order, default is no limit",
+    )
+
+    parser.add_argument(
+        "--walk-threads",
+        "--walk_threads",
+        dest="walk_threads",
+        type=int,
+        default=walk_threads_default,
+        help=f"threads listing the folders of the scan location at the same time, "
+             f"default is: {walk_threads_default}",
+    )
+
+    parser.add_argument(
+        "--max-in-flight",
+        "--max_in_flight",
+        dest="max_in_flight",
+        type=int,
+        default=None,
+        help=f"maximum tasks (batches of files) being hashed or waiting to be hashed at any one time, keeps memory "
+             f"flat however many files there are, default is: {in_flight_per_core_default} per core",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        "--batch_size",
+        dest="batch_size",
+        type=int,
+        default=None,
+        help=f"files sent to a worker process in one task, default is adaptive: batches that take about "
+             f"{batch_target_seconds_default} seconds, up to {batch_size_max_default} files",
+    )
+
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        type=pathlib.Path,
+        default=None,
+        help="write the time, files and bytes of each stage of the scan (walk, stat, read, hash, worker, queue and "
+             "ipc, csv) with files/s, MB/s, worker utilisation and the slowest files to this json file",
+    )
+
+    parser.add_argument(
+        "--buffer",
+        "--buffer-size",
+        "--buffer_size",
+        dest="buffer_size",
+        type=int,
+        default=read_buffer_size_default,
+        help=f"size of the read buffer used to feed the hash, "
+             f"default size is: {read_buffer_size_default} bytes",
+    )
+
     parser.add_argument(
         "-b",
         "--simple",
@@ -196,6 +659,17 @@ def parse_args(parser):
         action="store_true",  # no extra value after the parameter
     )
 
+    parser.add_argument(
+        "--log-level",
+        "--log_level",
+        dest="log_level",
+        type=str.upper,
+        choices=log_levels,
+        default=logging.getLevelName(log_level),
+        help=f"show the log messages of this level and above, the worker processes do not format the per file "
+             f"messages below it, default is: {logging.getLevelName(log_level)}",
+    )
+
     parser.add_argument(
         "-v",
         "--version",
@@ -204,28 +678,335 @@ def parse_args(parser):
         action="store_true",  # no extra value after the parameter
     )
 
+    subparsers = parser.add_subparsers(dest="command", help="without a command the scan location is hashed")
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="compare two reports and write the files added, removed and changed to a diff report",
+        description="compare two csv reports (both default or both simple output) e.g. of yesterday's and "
+                    "today's scan, the files are matched on relative-path (simple output) or path. Given two "
+                    "directory digests files (--tree-digests) the folders added, removed and changed are compared",
+    )
+    compare_parser.add_argument("old_report", type=pathlib.Path, help="the earlier report")
+    compare_parser.add_argument("new_report", type=pathlib.Path, help="the later report")
+    compare_parser.add_argument(
+        "-r",
+        "--report",
+        dest="report",
+        type=pathlib.Path,
+        default=None,
+        help=f"output diff report file, default is: {diff_report_default}",
+    )
+    compare_parser.add_argument(
+        "--chunk-rows",
+        "--chunk_rows",
+        dest="chunk_rows",
+        type=int,
+        default=compare_chunk_rows_default,
+        help=f"rows of a report sorted in memory at a time, the rest are sorted in temporary files next to the "
+             f"diff report, default is: {compare_chunk_rows_default}",
+    )
+
     args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
     logging.debug(str(args))
     return args
 
 
-def get_sha1_hash(file: pathlib.Path) -> str:
+class RateLimiter:
+    """
+    --max-bytes-per-second, --max-iops: token buckets of bytes and of reads for all the workers together, in shared
+    memory, so the limits hold however many worker processes and threads there are (give it to a process pool in
+    its initializer, see init_worker)
+    Each bucket holds up to a second of its rate, so the scan runs at the limit and short bursts above it are evened
+    out. A read is counted after it is made: the bucket can go below 0 and the reader waits until it is paid back
+    a limit of 0 is none
+    """
+
+    def __init__(self, bytes_per_second: int = 0, iops: int = 0):
+        self.bytes_per_second = bytes_per_second
+        self.iops = iops
+        # time of the last refill, bytes, reads in the buckets
+        self._buckets = multiprocessing.Array("d", [time.monotonic(), bytes_per_second, iops])
+
+    def acquire(self, n: int, reads: int = 1):
+        """count a read of n bytes (reads reads) against the limits, sleep until they allow it"""
+        with self._buckets.get_lock():
+            now = time.monotonic()
+            elapsed = now - self._buckets[0]
+            self._buckets[0] = now
+            wait = 0.0
+            if self.bytes_per_second:
+                self._buckets[1] = min(self.bytes_per_second, self._buckets[1] + elapsed * self.bytes_per_second) - n
+                wait = max(wait, -self._buckets[1] / self.bytes_per_second)
+            if self.iops:
+                self._buckets[2] = min(self.iops, self._buckets[2] + elapsed * self.iops) - reads
+                wait = max(wait, -self._buckets[2] / self.iops)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class IOLimits(NamedTuple):
+    """how the files are read, for a scan on a busy host: set_io_limits"""
+    polite: bool = False  # --polite, see polite_read
+    rate_limiter: RateLimiter | None = None
+
+
+# the io limits of this process (the main process and each worker process), see set_io_limits
+_io_limits = IOLimits()
+
+
+def set_io_limits(io_limits: IOLimits = IOLimits()):
+    """set the io limits of the files read in this process, and of the worker processes started after it"""
+    global _io_limits
+    _io_limits = io_limits
+
+
+def limit_io(n: int):
+    """count a read of n bytes against the --max-bytes-per-second and --max-iops limits, wait if they are used up"""
+    rate_limiter = _io_limits.rate_limiter
+    if rate_limiter is not None:
+        rate_limiter.acquire(n)
+
+
+def advise(f, advice: str, offset: int = 0, length: int = 0):
+    """posix_fadvise POSIX_FADV_<advice> on a file (length 0 is to the end) where the os has it (not windows or macOS)"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, getattr(os, f"POSIX_FADV_{advice}"))
+        except OSError as e:
+            log.debug("posix_fadvise %s: %s", advice, e)  # e.g. a pipe
+
+
+@contextlib.contextmanager
+def polite_read(f, offset: int = 0, length: int = 0):
+    """
+    --polite: tell the os the file (length bytes from offset, 0 is to the end) is read once from start to end
+    (SEQUENTIAL, more read ahead) and when it has been read to drop it from the page cache (DONTNEED), so a scan
+    does not evict the page cache of the other programs on the host
+    """
+    if not _io_limits.polite:
+        yield
+        return
+    advise(f, "SEQUENTIAL", offset, length)
+    try:
+        yield
+    finally:
+        advise(f, "DONTNEED", offset, length)
+
+
+# one read buffer per thread (and so per process), reused for every file that thread hashes
+_read_buffers = threading.local()
+
+
+def get_read_buffer(buffer_size: int = read_buffer_size_default) -> bytearray:
+    """
+    Get the reusable read buffer for this thread, only allocating a new one when the size changes
+    """
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = bytearray(buffer_size)
+        _read_buffers.buffer = buffer
+    return buffer
+
+
+def read_into_hashes(
+        f,
+        hashes: list,
+        buffer_size: int = read_buffer_size_default,
+        limit: int | None = None,
+        timings: list | None = None,
+) -> int:
+    """
+    Read engine: fill the reusable buffer with readinto and pass a memoryview of it to update() on
+    each hash object, so no new bytes object is created per read
+    f should be opened unbuffered (buffering=0) so the data is not copied through a second buffer
+    read to the end of the file, or with limit no more than limit bytes
+    with timings ([read seconds, hash seconds]) the time in readinto and in update() is added to it
+    each read is counted against the rate limits, see limit_io
+    return the number of bytes read
+    """
+    buffer = get_read_buffer(buffer_size)
+    view = memoryview(buffer)
+    total = 0
+    while limit is None or total < limit:
+        if timings is not None:
+            t = time.perf_counter()
+        if limit is not None and limit - total < buffer_size:
+            n = f.readinto(view[:limit - total])
+        else:
+            n = f.readinto(buffer)
+        if not n:
+            break
+        limit_io(n)
+        if timings is not None:
+            t_read = time.perf_counter()
+            timings[0] += t_read - t
+        chunk = view if n == buffer_size else view[:n]
+        for hash_object in hashes:
+            hash_object.update(chunk)
+        if timings is not None:
+            timings[1] += time.perf_counter() - t_read
+        total += n
+    return total
+
+
+def mmap_into_hashes(
+        f,
+        hashes: list,
+        buffer_size: int = read_buffer_size_default,
+        window_size: int = mmap_window_size_default,
+        timings: list | None = None,
+) -> int:
+    """
+    Mmap engine: map the file window_size bytes at a time and pass memoryview slices of buffer_size bytes of each
+    window to update() on each hash object, so the data is hashed where it is in the page cache, not copied into a
+    read buffer first
+    The file is stat'ed before each slice and the mapping stops at the size it has then, the rest of the file (all
+    of a special file or an empty file, which cannot be mapped, the data past the end of a file that shrinks and
+    any data added to a file while it is hashed) is read with read_into_hashes, so the hash is the same as theirs.
+    Not safe on a file truncated between the stat and the update() of a slice: reading a mapped page past the new
+    end of the file raises SIGBUS, which kills the process, so it is only used in process workers (see __main__)
+    with timings the time mapping a window is added to the read seconds and the time in update() (which includes
+    reading the pages in from the disk) to the hash seconds
+    each slice is counted against the rate limits as a read, see limit_io
+    return the number of bytes hashed
+    """
+    fileno = f.fileno()
+    window_size = max(mmap.ALLOCATIONGRANULARITY, window_size - window_size % mmap.ALLOCATIONGRANULARITY)
+    total = 0
+    mapping = True
+    while mapping:
+        file_stat = os.fstat(fileno)
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size <= total:
+            break
+        if timings is not None:
+            t = time.perf_counter()
+        try:
+            window = mmap.mmap(fileno, min(window_size, file_stat.st_size - total), access=mmap.ACCESS_READ,
+                               offset=total)
+        except (OSError, ValueError):
+            break
+        with window, memoryview(window) as view:
+            if hasattr(window, "madvise"):
+                window.madvise(mmap.MADV_SEQUENTIAL)
+            if timings is not None:
+                t_read = time.perf_counter()
+                timings[0] += t_read - t
+            for start in range(0, len(view), buffer_size):
+                end = min(start + buffer_size, len(view))
+                if start and os.fstat(fileno).st_size < total + end:
+                    mapping = False
+                    break
+                limit_io(end - start)
+                with view[start:end] as chunk:
+                    for hash_object in hashes:
+                        hash_object.update(chunk)
+            else:
+                start = len(view)
+            total += start
+            if timings is not None:
+                timings[1] += time.perf_counter() - t_read
+    f.seek(total)
+    return total + read_into_hashes(f, hashes, buffer_size, timings=timings)
+
+
+def parse_hash_names(hash_names: str) -> tuple:
+    """
+    From a comma separated string of hash names e.g. "sha1, MD5,sha256" get a tuple of hashlib names
+    duplicates are dropped, keeping the order given
+    raise ValueError if a hash is not supported
+    """
+    names = []
+    for name in hash_names.split(","):
+        name = name.strip().lower().replace("-", "")
+        if not name:
+            continue
+        if name not in supported_hash_names:
+            raise ValueError(f"hash not supported: {name}, use one or more of: {','.join(supported_hash_names)}")
+        if name not in names:
+            names.append(name)
+    if not names:
+        raise ValueError("no hash given")
+    return tuple(names)
+
+
+def get_hashes(
+        file: pathlib.Path,
+        hash_names: tuple = hash_names_default,
+        buffer_size: int = read_buffer_size_default,
+        timings: list | None = None,
+        mmap_threshold: int = mmap_threshold_default,
+) -> dict:
     """
-    From a pathlib file get the hash in chunks
+    From a pathlib file get each of the hashes in one read of the file, in chunks of buffer_size bytes
+    a file of mmap_threshold bytes or more (0 is none) is hashed with mmap_into_hashes, the rest with read_into_hashes
+    with timings see read_into_hashes
+    return dict of hash name: hex digest
     """
 
     try:
-        with open(file, mode="rb") as f:
-            hash = hashlib.sha1()
-            for buffer in iter(partial(f.read, hashlib.sha1().block_size), b""):
-                hash.update(buffer)
-        return hash.hexdigest()
+        with open(file, mode="rb", buffering=0) as f:
+            hashes = [hashlib.new(hash_name) for hash_name in hash_names]
+            with polite_read(f):
+                if mmap_threshold and os.fstat(f.fileno()).st_size >= mmap_threshold:
+                    mmap_into_hashes(f, hashes, buffer_size, timings=timings)
+                else:
+                    read_into_hashes(f, hashes, buffer_size, timings=timings)
+        return {hash_name: hash.hexdigest() for hash_name, hash in zip(hash_names, hashes)}
     except FileNotFoundError as fnfe:
         raise Exception("FileNotFoundError {0}: On file: {1}".format(fnfe, file))
     except Exception as e:
         raise Exception("Exception: {0}: On file: {1}".format(e, file))
 
 
+def get_segments(record: "FileRecord", segment_size: int = segment_size_default) -> list:
+    """the segments of a file for a tree hash: list of (path, segment number, offset, length)"""
+    return [
+        (record.path, number, offset, min(segment_size, record.size - offset))
+        for number, offset in enumerate(range(0, record.size, segment_size))
+    ]
+
+
+def get_segment_hashes(
+        segment: tuple,
+        hash_names: tuple = hash_names_default,
+        buffer_size: int = read_buffer_size_default,
+) -> tuple:
+    """
+    Hash one segment (path, segment number, offset, length) of a file, also used to re-verify part of a file
+    from the segments report
+    return (segment, dict of hash name: hex digest)
+    """
+    path, number, offset, length = segment
+    try:
+        with open(path, mode="rb", buffering=0) as f:
+            f.seek(offset)
+            hashes = [hashlib.new(hash_name) for hash_name in hash_names]
+            with polite_read(f, offset, length):
+                n = read_into_hashes(f, hashes, buffer_size, limit=length)
+        if n != length:
+            raise Exception(f"segment {number} is {n} bytes not {length}, the file has changed")
+        return segment, {hash_name: hash.hexdigest() for hash_name, hash in zip(hash_names, hashes)}
+    except Exception as e:
+        raise Exception("Exception: {0}: On file: {1}".format(e, path))
+
+
+def get_tree_hash(segment_digests: list, hash_name: str) -> str:
+    """
+    The tree hash of a file from the hex digests of its segments in order:
+    the hash of the binary segment digests one after the other, hash(digest0 + digest1 + ...)
+    the segments are segment_size bytes (the last may be shorter), a file of one segment has the hash of its digest
+    """
+    return hashlib.new(hash_name, b"".join(bytes.fromhex(digest) for digest in segment_digests)).hexdigest()
+
+
+def get_sha1_hash(file: pathlib.Path, buffer_size: int = read_buffer_size_default) -> str:
+    """
+    From a pathlib file get the hash in chunks of buffer_size bytes
+    """
+    return get_hashes(file, ("sha1",), buffer_size)["sha1"]
+
+
 def get_time(d: datetime) -> str:
     """get the time (including time zone) from a datetime"""
     return d.strftime("%H:%M:%S%z")
@@ -283,6 +1064,81 @@ def get_file_modified(file: pathlib.Path) -> datetime:
         logging.error(f"Exception: {e}")
 
 
+class FileRecord:
+    """
+    A file and its metadata for the report, all from a single stat (the one made by the walk, when there is one)
+    so the size, created and modified columns do not each stat the file again
+    """
+
+    __slots__ = ("path", "size", "ctime", "mtime", "mtime_ns", "dev", "ino", "nlink")
+
+    def __init__(
+            self,
+            path: pathlib.Path,
+            size: int,
+            ctime: float,
+            mtime: float,
+            mtime_ns: int,
+            dev: int,
+            ino: int,
+            nlink: int,
+    ):
+        self.path = path
+        self.size = size
+        self.ctime = ctime
+        self.mtime = mtime
+        self.mtime_ns = mtime_ns
+        self.dev = dev
+        self.ino = ino
+        self.nlink = nlink
+
+    @classmethod
+    def from_stat(cls, path: pathlib.Path, file_stat: os.stat_result) -> "FileRecord":
+        return cls(
+            path,
+            file_stat.st_size,
+            file_stat.st_ctime,
+            file_stat.st_mtime,
+            file_stat.st_mtime_ns,
+            file_stat.st_dev,
+            file_stat.st_ino,
+            file_stat.st_nlink,
+        )
+
+    @classmethod
+    def from_path(cls, path: pathlib.Path) -> "FileRecord":
+        """one stat of the file, raises OSError if it can not be stat'ed"""
+        return cls.from_stat(path, os.stat(path))
+
+    @classmethod
+    def from_dir_entry(cls, entry: os.DirEntry) -> "FileRecord":
+        """
+        From the stat of a folder listing entry, on Windows this comes with the listing but without the device and
+        inode (they are 0) so the file is stat'ed instead
+        """
+        file_stat = entry.stat()
+        if file_stat.st_ino == 0:
+            file_stat = os.stat(entry.path)
+        return cls.from_stat(pathlib.Path(entry.path), file_stat)
+
+    def __reduce__(self):
+        # a compact pickle for sending to the worker processes
+        return FileRecord, tuple(getattr(self, name) for name in FileRecord.__slots__)
+
+    def __repr__(self):
+        return f"FileRecord({self.path!r}, size={self.size})"
+
+    def created(self) -> datetime:
+        return datetime.fromtimestamp(self.ctime)
+
+    def modified(self) -> datetime:
+        return datetime.fromtimestamp(self.mtime)
+
+    def cache_key(self) -> tuple:
+        """the hash cache key of the file: (device, inode, size, modified time in ns)"""
+        return self.dev, self.ino, self.size, self.mtime_ns
+
+
 def get_relative_path(
         file: pathlib.Path,
         scan_location: pathlib.Path = default_scan_location,
@@ -307,174 +1163,2544 @@ def get_relative_path(
     except ValueError as ve:
         # Compute a version of this path relative to the path represented by other.
         # If it’s impossible, ValueError is raised
-        logging.warning(f"{ve} - {file} - {scan_location}")
+        logging.warning("%s - %s - %s", ve, file, scan_location)
         return None
     except Exception as e:
-        logging.error(f"Exception: {e} - {file} - {scan_location}")
+        logging.error("Exception: %s - %s - %s", e, file, scan_location)
         return None
 
 
-def get_file_and_hash_data(
-        file: pathlib.Path,
-        case_label,
-        simple_output,
-        max_hash_size: int = max_hash_size_default,
-        scan_location=default_scan_location,
-) -> dict:
+def get_cache_key(file_stat: os.stat_result) -> tuple:
+    """the hash cache key of a file: (device, inode, size, modified time in ns), as FileRecord.cache_key()"""
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+
+class HashCache:
     """
-    Simple is default true so only report:
-     - the hash in default lower case, not lower and uppercase as the default output
-     - create date and time single value not separately as the default output
+    Persistent (sqlite) cache of file hashes keyed on (device, inode, size, modified time in ns) and hash name
+
+    The process running main() is the only writer, store() and touch() are committed in batches.
+    Worker processes (and threads) only read, using lookup_hash_cache() which opens its own read only connection
+    The least recently used rows are removed on close() when there are more than max_entries rows
     """
-    file_size: int = get_file_size(file)
-    file_data = {
-        "case-label": case_label,
-        "file-name": get_file_name(file),
-        "size": file_size,
-        "file-extension": get_file_extension(file),
-        "hash-error": "",
-    }
-    try:
-        if simple_output:
-            file_data["relative-path"] = str(get_relative_path(file, scan_location))
-            file_data["created"] = get_date_time(get_file_created(file))
-            file_data["modified"] = get_date_time(get_file_modified(file))
-        else:
-            file_data["path"] = str(file)
-            file_data["created"] = get_date(get_file_created(file))
-            file_data["created-time"] = get_time(get_file_created(file))
-            file_data["modified"] = get_date(get_file_modified(file))
-            file_data["modified-time"] = get_time(get_file_modified(file))
 
-        if file_size > max_hash_size:
-            file_data[
-                "hash-error"
-            ] = f"file size, {file_size} > {max_hash_size}, hash skipped"
-            log.debug(f"big file: {file}: size: {file_size} > {max_hash_size}")
-        else:
-            # file size is ok, do the hash
-            if simple_output:
-                file_data[hash_function_name] = get_sha1_hash(file)
-            else:
-                hash_val = get_sha1_hash(file)
-                file_data["sha-1"] = hash_val
-                file_data[f"sha-1-uc"] = hash_val.upper()
+    def __init__(
+            self,
+            cache_file: pathlib.Path,
+            max_entries: int = cache_max_entries_default,
+            commit_every: int = 1000,
+    ):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.run_time = int(time.time())
+        self._pending = 0
+        self.connection = sqlite3.connect(cache_file)
+        # WAL so the worker read only connections do not block (and are not blocked by) this writer
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hash_cache ("
+            "st_dev INTEGER NOT NULL, st_ino INTEGER NOT NULL, hash_name TEXT NOT NULL, "
+            "st_size INTEGER NOT NULL, st_mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, "
+            "last_used INTEGER NOT NULL, "
+            "UNIQUE (st_dev, st_ino, hash_name))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS hash_cache_last_used ON hash_cache (last_used)"
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def lookup(self, key: tuple, hash_names: tuple) -> dict | None:
+        """the cached hashes for key, None unless every one of hash_names is cached"""
+        return _lookup_hash_cache(self.connection, key, hash_names)
+
+    def store(self, key: tuple, hashes: dict):
+        """cache the hashes (hash name: hex digest) of a file, replacing any older entry for the same inode"""
+        st_dev, st_ino, st_size, st_mtime_ns = key
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO hash_cache "
+            "(st_dev, st_ino, hash_name, st_size, st_mtime_ns, digest, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (st_dev, st_ino, hash_name, st_size, st_mtime_ns, digest, self.run_time)
+                for hash_name, digest in hashes.items()
+            ],
+        )
+        self._commit_batch()
+
+    def touch(self, key: tuple):
+        """mark the cached hashes of a file as used by this run, so they are not the first to be removed"""
+        st_dev, st_ino, st_size, st_mtime_ns = key
+        self.connection.execute(
+            "UPDATE hash_cache SET last_used = ? WHERE st_dev = ? AND st_ino = ? AND last_used != ?",
+            (self.run_time, st_dev, st_ino, self.run_time),
+        )
+        self._commit_batch()
+
+    def update(self, file_data: dict):
+        """store or touch the cache from the result of get_file_and_hash_data, counting hits and misses"""
+        key = file_data.get(cache_key_field)
+        if key is None:
+            return
+        if file_data.get(cache_hit_field):
+            self.hits += 1
+            self.touch(key)
+        else:
+            self.misses += 1
+            hashes = file_data.get(cache_hashes_field)
+            if hashes:
+                self.store(key, hashes)
+
+    def _commit_batch(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.connection.commit()
+            self._pending = 0
+
+    def evict(self) -> int:
+        """remove the least recently used rows over max_entries, return the number of rows removed"""
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM hash_cache").fetchone()
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        self.connection.execute(
+            "DELETE FROM hash_cache WHERE rowid IN "
+            "(SELECT rowid FROM hash_cache ORDER BY last_used, rowid LIMIT ?)",
+            (excess,),
+        )
+        self.connection.commit()
+        return excess
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.commit()
+        evicted = self.evict()
+        if evicted:
+            log.info(f"Hash cache: removed {evicted} least recently used rows, maximum: {self.max_entries}")
+        self.connection.close()
+        self.connection = None
+
+
+# keys added to the result of get_file_and_hash_data for the hash cache, they are not written to the report
+cache_key_field = "_cache-key"
+cache_hit_field = "_cache-hit"
+cache_hashes_field = "_cache-hashes"
+stats_field = "_stats"  # --stats: the time of each stage for the file, see ScanStats.add_file()
+hard_link_field = "_hard-link"  # (device, inode, links) of a file with more than one hard link, see HardLinks
+
+# read only connections to the hash cache, one per thread (and so per process) per cache file
+_hash_cache_readers = threading.local()
+
+
+def _lookup_hash_cache(connection: sqlite3.Connection, key: tuple, hash_names: tuple) -> dict | None:
+    st_dev, st_ino, st_size, st_mtime_ns = key
+    rows = connection.execute(
+        "SELECT hash_name, digest FROM hash_cache "
+        "WHERE st_dev = ? AND st_ino = ? AND st_size = ? AND st_mtime_ns = ?",
+        (st_dev, st_ino, st_size, st_mtime_ns),
+    ).fetchall()
+    cached = dict(rows)
+    if all(hash_name in cached for hash_name in hash_names):
+        return {hash_name: cached[hash_name] for hash_name in hash_names}
+    return None
+
+
+def lookup_hash_cache(cache_file: pathlib.Path, key: tuple, hash_names: tuple) -> dict | None:
+    """
+    Look up the hashes of a file in the hash cache from a worker, with this thread's read only connection
+    return None if not cached (or the cache can not be read)
+    """
+    connections = getattr(_hash_cache_readers, "connections", None)
+    if connections is None:
+        connections = _hash_cache_readers.connections = {}
+    try:
+        connection = connections.get(cache_file)
+        if connection is None:
+            connection = sqlite3.connect(f"{pathlib.Path(cache_file).resolve().as_uri()}?mode=ro", uri=True)
+            connections[cache_file] = connection
+        return _lookup_hash_cache(connection, key, hash_names)
+    except sqlite3.Error as e:
+        log.warning("hash cache lookup failed: %s - %s", e, cache_file)
+        return None
+
+
+def get_file_and_hash_data(
+        file: pathlib.Path | FileRecord,
+        case_label,
+        simple_output,
+        max_hash_size: int = max_hash_size_default,
+        scan_location=default_scan_location,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        cache: pathlib.Path | None = None,
+        stats: bool = False,
+        mmap_threshold: int = mmap_threshold_default,
+) -> dict:
+    """
+    Simple is default true so only report:
+     - the hash in default lower case, not lower and uppercase as the default output
+     - create date and time single value not separately as the default output
+    All the hashes in hash_names are calculated from the one read of the file
+    All the metadata comes from the one stat in the FileRecord, given a path the file is stat'ed once here
+    With a hash cache file the hashes of an unchanged file come from the cache, not from reading the file,
+    the cache key and whether it was a hit are added to the result for HashCache.update()
+    (and the file is stat'ed again after it is read, to check it did not change while being read)
+    With stats the seconds taken by the stat, the read and the hash of the file are added to the result
+    Files of mmap_threshold bytes or more are hashed through mmap, see get_hashes
+    A file in an archive (ArchiveMember, --into-archives) is hashed with get_archive_member_hash_data
+    """
+    if isinstance(file, ArchiveMember):
+        return get_archive_member_hash_data(
+            file, case_label, simple_output, max_hash_size, scan_location, buffer_size, hash_names, stats
+        )
+    timings = None
+    if stats:
+        t = time.perf_counter()
+        timings = [0.0, 0.0]  # read, hash seconds
+    record: FileRecord | None = None
+    stat_error: OSError | None = None
+    if isinstance(file, FileRecord):
+        record = file
+        file = record.path
+    else:
+        try:
+            record = FileRecord.from_path(file)
+        except OSError as e:
+            logging.error("Exception: %s", e)
+            stat_error = e
+    if stats:
+        stat_seconds = time.perf_counter() - t
+    read_bytes = 0
+
+    file_size: int | None = None if record is None else record.size
+    file_data = {
+        "case-label": case_label,
+        "file-name": get_file_name(file),
+        "size": file_size,
+        "file-extension": get_file_extension(file),
+        "hash-error": "",
+    }
+    try:
+        if simple_output:
+            file_data["relative-path"] = str(get_relative_path(file, scan_location))
+        else:
+            file_data["path"] = str(file)
+
+        if record is None:
+            raise stat_error
+
+        if record.nlink > 1:
+            file_data[hard_link_field] = (record.dev, record.ino, record.nlink)
+
+        created = record.created()
+        modified = record.modified()
+        if simple_output:
+            file_data["created"] = get_date_time(created)
+            file_data["modified"] = get_date_time(modified)
+        else:
+            file_data["created"] = get_date(created)
+            file_data["created-time"] = get_time(created)
+            file_data["modified"] = get_date(modified)
+            file_data["modified-time"] = get_time(modified)
+
+        if file_size > max_hash_size:
+            file_data[
+                "hash-error"
+            ] = f"file size, {file_size} > {max_hash_size}, hash skipped"
+            log.debug("big file: %s: size: %s > %s", file, file_size, max_hash_size)
+        else:
+            # file size is ok, do the hash
+            hash_values = None
+            if cache is not None:
+                cache_key = record.cache_key()
+                file_data[cache_key_field] = cache_key
+                hash_values = lookup_hash_cache(cache, cache_key, hash_names)
+                file_data[cache_hit_field] = hash_values is not None
+            if hash_values is None:
+                hash_values = get_hashes(file, hash_names, buffer_size, timings=timings, mmap_threshold=mmap_threshold)
+                read_bytes = file_size
+                # only cache the hashes when the file did not change while it was read
+                if cache is not None and get_cache_key(file.stat()) == file_data[cache_key_field]:
+                    file_data[cache_hashes_field] = hash_values
+            for hash_name, hash_val in hash_values.items():
+                column = get_hash_column_name(hash_name, simple_output)
+                file_data[column] = hash_val
+                if not simple_output:
+                    file_data[f"{column}-uc"] = hash_val.upper()
+
+        if file_size < 1:
+            file_data["hash-error"] = "file size is 0 bytes"
+            log.debug("zero bytes file: %s: size: %s", file, file_size)
+
+    except Exception as e:
+        file_data["hash-error"] = e
+
+    if stats:
+        file_data[stats_field] = {
+            "seconds": time.perf_counter() - t,
+            "stat": stat_seconds,
+            "read": timings[0],
+            "hash": timings[1],
+            "bytes": read_bytes,
+        }
+    return file_data
+
+
+def get_archive_type(file: pathlib.Path | str) -> str | None:
+    """the archive type of a file by its name (see archive_types), None if it is not an archive"""
+    name = str(file).lower()
+    for suffix, archive_type in archive_types.items():
+        if name.endswith(suffix):
+            return archive_type
+    return None
+
+
+class ArchiveMember(NamedTuple):
+    """a file in an archive to hash (--into-archives), see get_archive_members"""
+    archive: pathlib.Path
+    name: str | None  # None for all the files of a compressed tar, hashed in one pass
+    size: int  # of the file, or of the archive for all the files of a compressed tar
+    modified: float | None  # timestamp
+    offset: int | None = None  # tar: where the data of the file starts in the archive, None to read it with tarfile
+
+
+def get_zip_modified(info: zipfile.ZipInfo) -> float | None:
+    """the modified time of a file in a zip archive as a timestamp, None if it is not a valid date"""
+    try:
+        return datetime(*info.date_time).timestamp()
+    except ValueError:
+        return None
+
+
+def get_archive_members(record: FileRecord) -> list:
+    """
+    The files (ArchiveMember) in a zip or tar archive, from the zip central directory or the tar headers, each one to
+    be hashed on its own. A compressed tar can only be read from the start, so it is one ArchiveMember for all its
+    files. Folders, links and other special members are left out
+    return an empty list if the file is not an archive or can not be read as one
+    """
+    archive_type = get_archive_type(record.path)
+    try:
+        if archive_type == "zip":
+            with zipfile.ZipFile(record.path) as archive:
+                return [
+                    ArchiveMember(record.path, info.filename, info.file_size, get_zip_modified(info))
+                    for info in archive.infolist()
+                    if not info.is_dir()
+                ]
+        if archive_type == "tar":
+            with tarfile.open(record.path, "r:") as archive:
+                return [
+                    ArchiveMember(record.path, info.name, info.size, info.mtime,
+                                  None if info.issparse() else info.offset_data)
+                    for info in archive
+                    if info.isfile()
+                ]
+        if archive_type == "compressed tar":
+            return [ArchiveMember(record.path, None, record.size, None)]
+    except (OSError, ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+        log.warning(f"Not read as an archive: {record.path}: {e}")
+    return []
+
+
+def expand_archives(file_list) -> Generator:
+    """--into-archives: pass on the files (FileRecord) from the file list, each archive followed by its files"""
+    archives = 0
+    members = 0
+    for record in file_list:
+        yield record
+        if get_archive_type(record.path) is not None:
+            archive_members = get_archive_members(record)
+            archives += 1
+            members += len(archive_members)
+            yield from archive_members
+    log.info(f"Into archives: {archives} archives, {members} files (or compressed tars) in them")
+
+
+def get_archive_member(archive: pathlib.Path, name: str) -> ArchiveMember:
+    """one file in an archive by its name (e.g. from a report), raise KeyError if it is not in the archive"""
+    if get_archive_type(archive) == "zip":
+        info = get_zip_file(archive).getinfo(name)
+        return ArchiveMember(archive, name, info.file_size, get_zip_modified(info))
+    with tarfile.open(archive) as tar:
+        info = tar.getmember(name)
+    offset = info.offset_data if get_archive_type(archive) == "tar" and not info.issparse() else None
+    return ArchiveMember(archive, name, info.size, info.mtime, offset)
+
+
+# the zip archive each thread (and so process) last read a file from, kept open for the next file in it, so the
+# central directory of a big archive is not read again for each of its files
+_zip_files = threading.local()
+
+
+def get_zip_file(archive: pathlib.Path) -> zipfile.ZipFile:
+    """the open zip archive of this thread, opened again if it is another archive or it has changed"""
+    archive_stat = os.stat(archive)
+    key = (str(archive), archive_stat.st_size, archive_stat.st_mtime_ns)
+    cached = getattr(_zip_files, "cached", None)
+    if cached is None or cached[0] != key:
+        if cached is not None:
+            cached[1].close()
+        _zip_files.cached = key, zipfile.ZipFile(archive)
+    return _zip_files.cached[1]
+
+
+@contextlib.contextmanager
+def open_archive_member(member: ArchiveMember):
+    """open a file in an archive to read its data"""
+    if member.offset is not None:
+        # the data of a file in an uncompressed tar is in one piece, read it straight from the archive
+        with open(member.archive, mode="rb", buffering=0) as f, polite_read(f, member.offset, member.size):
+            f.seek(member.offset)
+            yield f
+    elif get_archive_type(member.archive) == "zip":
+        with get_zip_file(member.archive).open(member.name) as f:
+            yield f
+    else:
+        with tarfile.open(member.archive) as archive, archive.extractfile(member.name) as f:
+            yield f
+
+
+def get_member_hashes(
+        f,
+        size: int,
+        hash_names: tuple = hash_names_default,
+        buffer_size: int = read_buffer_size_default,
+        timings: list | None = None,
+) -> dict:
+    """the hashes of a file of size bytes in an archive (open as f), return dict of hash name: hex digest"""
+    hashes = [hashlib.new(hash_name) for hash_name in hash_names]
+    n = read_into_hashes(f, hashes, buffer_size, limit=size, timings=timings)
+    if n != size:
+        raise Exception(f"{n} bytes read not {size}, the archive has changed")
+    return {hash_name: hash.hexdigest() for hash_name, hash in zip(hash_names, hashes)}
+
+
+def get_archive_member_hashes(
+        member: ArchiveMember,
+        hash_names: tuple = hash_names_default,
+        buffer_size: int = read_buffer_size_default,
+        timings: list | None = None,
+) -> dict:
+    """get_hashes of a file in an archive, return dict of hash name: hex digest"""
+    try:
+        with open_archive_member(member) as f:
+            return get_member_hashes(f, member.size, hash_names, buffer_size, timings)
+    except Exception as e:
+        raise Exception("Exception: {0}: On file: {1}{2}{3}".format(e, member.archive, archive_member_separator,
+                                                                    member.name))
+
+
+def get_archive_member_file_data(
+        path: str,
+        name: str,
+        size: int,
+        modified: float | None,
+        case_label,
+        simple_output,
+) -> dict:
+    """the report row of a file in an archive before it is hashed, an archive has no created date for its files"""
+    member = pathlib.PurePosixPath(name)
+    file_data = {
+        "case-label": case_label,
+        "file-name": member.name,
+        "size": size,
+        "file-extension": member.suffix,
+        "hash-error": "",
+    }
+    modified = None if modified is None else datetime.fromtimestamp(modified)
+    if simple_output:
+        file_data["relative-path"] = path
+        file_data["created"] = ""
+        file_data["modified"] = "" if modified is None else get_date_time(modified)
+    else:
+        file_data["path"] = path
+        file_data["created"] = ""
+        file_data["created-time"] = ""
+        file_data["modified"] = "" if modified is None else get_date(modified)
+        file_data["modified-time"] = "" if modified is None else get_time(modified)
+    return file_data
+
+
+def add_archive_member_hashes(file_data: dict, hash_values: dict, simple_output, size: int):
+    for hash_name, hash_val in hash_values.items():
+        column = get_hash_column_name(hash_name, simple_output)
+        file_data[column] = hash_val
+        if not simple_output:
+            file_data[f"{column}-uc"] = hash_val.upper()
+    if size < 1:
+        file_data["hash-error"] = "file size is 0 bytes"
+
+
+def get_archive_member_hash_data(
+        member: ArchiveMember,
+        case_label,
+        simple_output,
+        max_hash_size: int = max_hash_size_default,
+        scan_location=default_scan_location,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        stats: bool = False,
+) -> dict | list:
+    """
+    get_file_and_hash_data of a file in an archive (--into-archives), its path is the path of the archive, !/ and
+    its name in the archive e.g. archive.zip!/inner/file.txt
+    The files of a zip or an uncompressed tar are each read on their own, so the files of a big archive are hashed
+    in parallel. All the files of a compressed tar (member name None) are hashed in one pass from the start of the
+    archive: return a list of their results, with one for the archive itself if it can not be read to the end
+    """
+    archive_path = get_journal_path(member.archive, simple_output, scan_location)
+    if member.name is None:
+        return get_compressed_tar_hash_data(
+            member.archive, archive_path, case_label, simple_output, max_hash_size, buffer_size, hash_names, stats
+        )
+    if stats:
+        t = time.perf_counter()
+    timings = [0.0, 0.0]
+    file_data = get_archive_member_file_data(
+        f"{archive_path}{archive_member_separator}{member.name}",
+        member.name,
+        member.size,
+        member.modified,
+        case_label,
+        simple_output,
+    )
+    read_bytes = 0
+    try:
+        if member.size > max_hash_size:
+            file_data["hash-error"] = f"file size, {member.size} > {max_hash_size}, hash skipped"
+        else:
+            hash_values = get_archive_member_hashes(member, hash_names, buffer_size, timings)
+            read_bytes = member.size
+            add_archive_member_hashes(file_data, hash_values, simple_output, member.size)
+    except Exception as e:
+        file_data["hash-error"] = e
+    if stats:
+        file_data[stats_field] = {
+            "seconds": time.perf_counter() - t,
+            "stat": 0.0,
+            "read": timings[0],
+            "hash": timings[1],
+            "bytes": read_bytes,
+        }
+    return file_data
+
+
+def get_compressed_tar_hash_data(
+        archive: pathlib.Path,
+        archive_path: str,
+        case_label,
+        simple_output,
+        max_hash_size: int = max_hash_size_default,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        stats: bool = False,
+) -> list:
+    """the results of all the files of a compressed tar, read as a stream from the start, see get_archive_member_hash_data"""
+    results = []
+    try:
+        with (
+            open(archive, mode="rb") as f,
+            polite_read(f),
+            tarfile.open(fileobj=f, mode="r|*") as tar,
+        ):
+            for info in tar:
+                if not info.isfile():
+                    continue
+                if stats:
+                    t = time.perf_counter()
+                timings = [0.0, 0.0]
+                file_data = get_archive_member_file_data(
+                    f"{archive_path}{archive_member_separator}{info.name}",
+                    info.name,
+                    info.size,
+                    info.mtime,
+                    case_label,
+                    simple_output,
+                )
+                read_bytes = 0
+                if info.size > max_hash_size:
+                    file_data["hash-error"] = f"file size, {info.size} > {max_hash_size}, hash skipped"
+                else:
+                    with tar.extractfile(info) as member_file:
+                        hash_values = get_member_hashes(member_file, info.size, hash_names, buffer_size, timings)
+                    read_bytes = info.size
+                    add_archive_member_hashes(file_data, hash_values, simple_output, info.size)
+                if stats:
+                    file_data[stats_field] = {
+                        "seconds": time.perf_counter() - t,
+                        "stat": 0.0,
+                        "read": timings[0],
+                        "hash": timings[1],
+                        "bytes": read_bytes,
+                    }
+                results.append(file_data)
+    except Exception as e:
+        # the files hashed before the error are kept, the error is on a row for the rest of the archive
+        file_data = {
+            "case-label": case_label,
+            "file-name": "",
+            "size": None,
+            "file-extension": "",
+            "hash-error": "Exception: {0}: On file: {1}".format(e, archive),
+            "relative-path" if simple_output else "path": f"{archive_path}{archive_member_separator}",
+        }
+        results.append(file_data)
+    return results
+
+
+def scan_directory(directory: str, file_records: bool = False) -> tuple:
+    """
+    List one folder with os.scandir
+    return (list of DirEntry for the files, list of paths of the sub folders)
+    with file_records the files are FileRecord, from a stat of each file here in the walk thread
+    as rglob, symbolic links to files are files and symbolic links to folders are not followed
+    """
+    files = []
+    sub_directories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    # DirEntry uses the type from the folder listing, no stat needed on most file systems
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_directories.append(entry.path)
+                    elif entry.is_file():
+                        files.append(FileRecord.from_dir_entry(entry) if file_records else entry)
+                except OSError as e:
+                    logging.warning("scan directory: %s - %s", e, entry.path)
+    except OSError as e:
+        logging.warning("scan directory: %s - %s", e, directory)
+    return files, sub_directories
+
+
+def walk_files(
+        scan_location: pathlib.Path,
+        walk_threads: int = walk_threads_default,
+        file_records: bool = False,
+) -> Generator[os.DirEntry | FileRecord, None, None]:
+    """
+    Walk the folder scan_location yielding a DirEntry (or with file_records a FileRecord) for each file, in the
+    same order as rglob("*") would: the files in a folder, then each of its sub folders in turn
+    The folders next in line are listed ahead by a pool of walk_threads threads (os.scandir releases the GIL, so
+    slow network shares and huge folders are listed concurrently), at most walk_threads * 4 folders ahead so
+    memory does not grow with the size of the tree
+    """
+    prefetch = walk_threads * 4
+    with ThreadPoolExecutor(walk_threads) as executor:
+        # stack of [folder path, future of scan_directory or None if not listed yet], the top is the next folder
+        stack = [[str(scan_location), None]]
+        while stack:
+            directory, future = stack.pop()
+            if future is None:
+                future = executor.submit(scan_directory, directory, file_records)
+            files, sub_directories = future.result()
+            stack.extend([sub_directory, None] for sub_directory in reversed(sub_directories))
+
+            # list the folders that will be reached next
+            listing = 0
+            for item in reversed(stack):
+                if listing >= prefetch:
+                    break
+                if item[1] is None:
+                    item[1] = executor.submit(scan_directory, item[0], file_records)
+                listing += 1
+
+            yield from files
+
+
+def get_file_list(
+        scan_location: pathlib.Path,
+        first_n_files: int | None = first_n_files,
+        walk_threads: int = walk_threads_default,
+        file_records: bool = False,
+) -> List[pathlib.Path] | List[FileRecord]:
+    """
+    Populates the lists of objects (file(s) etc to be catalogued)
+    file path -scan_location- to be catalogued (relative or absolute)
+    walks the folders with walk_files (os.scandir in a pool of walk_threads threads)
+    yield pathlib items, or with file_records FileRecord items (the file stat'ed once, in the walk)
+    """
+
+    # just a single file
+    if scan_location.is_file():
+        log.info("Scan location is a file: {0}".format(str(scan_location)))
+        yield FileRecord.from_path(scan_location) if file_records else scan_location
+        return
+    else:
+        log.info("Scan location is a folder: {0}".format(pathlib.Path(scan_location)))
+
+    if pathlib.Path(scan_location).is_absolute():
+        # log.debug('Scan location to hash: {0}'.format(pathlib.Path(scan_location)))
+        scan_location = pathlib.Path(scan_location)
+    else:
+        scan_location = pathlib.Path(scan_location).resolve()
+        # log.debug('File (relative) location to hash: {0}'.format(scan_location))
+
+    if not pathlib.Path(scan_location).exists():
+        log.critical("Location to hash is not found: {0}".format(scan_location))
+        exit(1)
+
+    count = 1
+    for entry in walk_files(scan_location, walk_threads, file_records):
+        yield entry if file_records else pathlib.Path(entry.path)
+        if first_n_files is not None:
+            count = count + 1
+            if count > first_n_files:
+                log.info(
+                    f"Only attempting to hash the first: {first_n_files} at the scan_location: {scan_location}"
+                )
+                break
+
+
+class ScanStats:
+    """
+    --stats: the cumulative seconds, files and bytes of each stage of a scan, the stages timed in the workers (see
+    get_file_and_hash_data and run_batch) are added up here in the main process from the results
+    the worker stages (stat, read, hash, worker) are the total over all the workers, so with more than one worker
+    they add up to more than the scan took
+    """
+
+    def __init__(self, slowest_files: int = stats_slowest_files_default):
+        self.start = time.perf_counter()
+        self.stages: dict = {}  # stage: [seconds, files, bytes]
+        self.slowest_files = slowest_files
+        self.slowest: list = []  # heap of (seconds, path, bytes read) of the slowest files
+        self.workers = 0
+        self.pool_seconds = 0.0  # time the workers were running, for the worker utilisation
+
+    def add(self, stage: str, seconds: float, files: int = 1, size: int = 0):
+        totals = self.stages.setdefault(stage, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += files
+        totals[2] += size
+
+    def add_file(self, result: dict, path: str):
+        """the stages of one file, timed in the worker (the stats field of the result)"""
+        file_stats = result.get(stats_field)
+        if file_stats is None:
+            return
+        self.add("stat", file_stats["stat"])
+        self.add("read", file_stats["read"], size=file_stats["bytes"])
+        self.add("hash", file_stats["hash"], size=file_stats["bytes"])
+        if len(self.slowest) < self.slowest_files:
+            heapq.heappush(self.slowest, (file_stats["seconds"], path, file_stats["bytes"]))
+        elif file_stats["seconds"] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (file_stats["seconds"], path, file_stats["bytes"]))
+
+    def add_batch(self, files: int, seconds: float, round_trip: float):
+        """a batch of files that took a worker seconds, round_trip seconds from when it was submitted"""
+        self.add("worker", seconds, files)
+        self.add("queue and ipc", max(round_trip - seconds, 0.0), files)
+
+    def timed(self, items, stage: str) -> Generator:
+        """pass on the items (e.g. the files from the walk) adding the time taken to get each one to stage"""
+        iterator = iter(items)
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - t, files=0)
+                return
+            self.add(stage, time.perf_counter() - t)
+            yield item
+
+    def get_stats(self, files: int, **run_info) -> dict:
+        """the stats as a dict, with run_info e.g. the scan location first"""
+        seconds = time.perf_counter() - self.start
+        read_bytes = self.stages.get("read", [0.0, 0, 0])[2]
+        worker_seconds = self.stages.get("worker", [0.0, 0, 0])[0]
+        worker_utilisation = None
+        if self.workers and self.pool_seconds:
+            worker_utilisation = worker_seconds / (self.pool_seconds * self.workers)
+        return run_info | {
+            "seconds": seconds,
+            "files": files,
+            "bytes read": read_bytes,
+            "files/s": files / seconds,
+            "MB/s": read_bytes / A_MB / seconds,
+            "workers": self.workers,
+            "worker utilisation": worker_utilisation,
+            "stages": {
+                stage: {
+                    "seconds": stage_seconds,
+                    "files": stage_files,
+                    "bytes": stage_bytes,
+                    "files/s": stage_files / stage_seconds if stage_seconds else None,
+                    "MB/s": stage_bytes / A_MB / stage_seconds if stage_seconds else None,
+                }
+                for stage, (stage_seconds, stage_files, stage_bytes) in self.stages.items()
+            },
+            "slowest files": [
+                {"path": path, "seconds": file_seconds, "bytes read": file_bytes}
+                for file_seconds, path, file_bytes in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def write(self, stats_file: pathlib.Path, files: int, **run_info):
+        with open(stats_file, "w", encoding="utf-8") as f:
+            json.dump(self.get_stats(files, **run_info), f, indent=2, default=str)
+
+
+def run_batch(function, items: list, *args) -> tuple:
+    """
+    Run function(item, *args) e.g. get_file_and_hash_data on a batch of items (files) in one worker task, so the
+    process pool pickles one task and one list of results rather than one per file
+    return (list of results, seconds taken) the time is used to size the following batches
+    """
+    t = time.perf_counter()
+    results = []
+    for item in items:
+        try:
+            results.append(function(item, *args))
+        except Exception as e:
+            log.error("hash generated an exception: %s - %s", e, item)
+    return results, time.perf_counter() - t
+
+
+class BatchSizer:
+    """
+    The number of files to put in the next batch, either fixed (batch_size) or, when batch_size is None, adaptive:
+    from the (smoothed) time per file of the batches so far, aiming for batches that take about target_seconds,
+    so tiny files are sent in large batches and big files one at a time
+    """
+
+    def __init__(
+            self,
+            batch_size: int | None = None,
+            target_seconds: float = batch_target_seconds_default,
+            max_size: int = batch_size_max_default,
+    ):
+        self.adaptive = batch_size is None
+        self.size = 1 if self.adaptive else batch_size
+        self.target_seconds = target_seconds
+        self.max_size = max_size
+        self.seconds_per_file = None
+
+    def record(self, files: int, seconds: float):
+        if not self.adaptive or files < 1:
+            return
+        seconds_per_file = seconds / files
+        if self.seconds_per_file is None:
+            self.seconds_per_file = seconds_per_file
+        else:
+            self.seconds_per_file = 0.8 * self.seconds_per_file + 0.2 * seconds_per_file
+        self.size = max(1, min(self.max_size, int(self.target_seconds / max(self.seconds_per_file, 1e-9))))
+
+
+def get_batches(file_list, batch_sizer: BatchSizer) -> Generator[list, None, None]:
+    """group the file list into batches, the size of each batch is taken from the batch sizer as it is started"""
+    batch = []
+    for file in file_list:
+        batch.append(file)
+        if len(batch) >= batch_sizer.size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def is_rotational_device(device: int) -> bool | None:
+    """
+    Whether the device (st_dev) is a spinning disk, from /sys/dev/block/<major>:<minor> (or the disk of a partition)
+    queue/rotational on linux, None if it is not known e.g. on windows, a network share or a virtual file system
+    """
+    if not hasattr(os, "major"):
+        return None
+    try:
+        block = pathlib.Path(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}").resolve(strict=True)
+        for rotational in (block / "queue" / "rotational", block.parent / "queue" / "rotational"):
+            if rotational.exists():
+                return rotational.read_text().strip() == "1"
+    except OSError:
+        pass
+    return None
+
+
+def get_device_readers(device: int | None, device_readers: int | str | None) -> int | None:
+    """
+    The batches of files read from a device at the same time, None is no limit
+    device_readers is the number for every device or auto: rotational_device_readers_default for a spinning disk
+    (see is_rotational_device) and no limit for the rest
+    """
+    if device is None or device_readers is None:
+        return None
+    if device_readers == "auto":
+        return rotational_device_readers_default if is_rotational_device(device) else None
+    return device_readers
+
+
+class DeviceScheduler:
+    """
+    --device-readers: the full batches of files wait here (in a queue per device, st_dev) until there is a reader
+    free on their device, so a spinning disk is read by one worker (or a few) at a time rather than all of them
+    seeking between files, while the other disks of a scan are read at the same time. The files in a batch are
+    read in inode order, close to the order they are on the disk, the batches in walk (folder) order
+    Without device_readers items have no device and there is no limit, batches are ready as soon as they are added
+    """
+
+    def __init__(self, device_readers: int | str | None = None):
+        self.device_readers = device_readers
+        self.queued: dict = {}  # device: deque of (pool, batch)
+        self.readers: dict = {}  # device: batches in flight
+        self.limits: dict = {}  # device: readers, None is no limit
+        self.waiting = 0
+
+    def get_device(self, item) -> int | None:
+        if self.device_readers is None:
+            return None
+        return getattr(item, "dev", None)
+
+    def get_limit(self, device: int | None) -> int | None:
+        if device not in self.limits:
+            self.limits[device] = get_device_readers(device, self.device_readers)
+            if device is not None:
+                log.info(f"Device {device}: readers at a time: {self.limits[device] or 'no limit'}")
+        return self.limits[device]
+
+    def add(self, device: int | None, pool: str, batch: list):
+        """a full batch of files for the pool (executor) from the device"""
+        if device is not None:
+            batch.sort(key=lambda item: getattr(item, "ino", 0))
+        self.queued.setdefault(device, deque()).append((pool, batch))
+        self.waiting += 1
+
+    def ready(self, slots: int) -> list:
+        """up to slots batches that can be read now: [(device, pool, batch)], they are counted as in flight"""
+        ready = []
+        for device, queue in self.queued.items():
+            limit = self.get_limit(device)
+            while queue and len(ready) < slots and (limit is None or self.readers.get(device, 0) < limit):
+                pool, batch = queue.popleft()
+                self.waiting -= 1
+                self.readers[device] = self.readers.get(device, 0) + 1
+                ready.append((device, pool, batch))
+        return ready
+
+    def done(self, device: int | None):
+        """a batch from the device is complete"""
+        self.readers[device] -= 1
+
+
+def _completed_results(
+        done: set,
+        in_flight: dict,
+        stats: ScanStats | None = None,
+        scheduler: DeviceScheduler | None = None,
+) -> Generator:
+    """
+    The results of the completed (batch) futures, logging (not raising) any exception
+    in_flight is future: (batch sizer, time submitted, device), the completed futures are removed from it
+    """
+    for future in done:
+        batch_sizer, submitted, device = in_flight.pop(future)
+        if scheduler is not None:
+            scheduler.done(device)
+        try:
+            results, seconds = future.result()
+        except Exception as e:
+            log.error(f"hash generated an exception: {e}")
+        else:
+            batch_sizer.record(len(results), seconds)
+            if stats is not None:
+                stats.add_batch(len(results), seconds, time.perf_counter() - submitted)
+            yield from results
+
+
+class LogRecordHandler(logging.Handler):
+    """
+    Handler of the QueueListener of the worker process log records: each record is handled by the logger of the
+    same name in this (the main) process, so it goes through the handlers set up here, one at a time
+    """
+
+    def emit(self, record: logging.LogRecord):
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def init_worker_logging(log_queue, level: int):
+    """
+    Process pool initializer: the worker sends its log records (at level or above) to the main process on
+    log_queue rather than each worker writing to stdout, the records below level are dropped in the worker
+    before a message is formatted (the per file log calls use % arguments, not f-strings)
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+
+def init_worker(log_queue, level: int, io_limits: IOLimits):
+    """Process pool initializer: the worker logs to log_queue (if not None, see init_worker_logging) and reads the
+    files with the io limits of the main process (see set_io_limits)"""
+    if log_queue is not None:
+        init_worker_logging(log_queue, level)
+    set_io_limits(io_limits)
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """
+    Runs each task in the calling thread when it is submitted and returns it as a completed future, for the batches
+    of small files (--small-file-size) that cost more to send to a worker process and back than to hash
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def get_executors(
+        executor: str = executor_default,
+        cores: int | None = cores,
+        log_queue=None,
+        inline: bool = False,
+) -> dict:
+    """
+    the executor(s) for the executor type: dict of "process" and/or "thread": executor with cores workers
+    with a log queue the worker processes log to it, see init_worker
+    the worker processes have the io limits of this process, see set_io_limits
+    with inline there is also an "inline" executor, see InlineExecutor
+    """
+    if executor not in executor_types:
+        raise ValueError(f"executor not supported: {executor}, use one of: {','.join(executor_types)}")
+    executors = {}
+    if executor in ("process", "hybrid"):
+        executors["process"] = ProcessPoolExecutor(
+            cores,
+            initializer=init_worker,
+            initargs=(log_queue, logging.getLogger().getEffectiveLevel(), _io_limits),
+        )
+    if executor in ("thread", "hybrid"):
+        executors["thread"] = ThreadPoolExecutor(cores)
+    if inline:
+        executors["inline"] = InlineExecutor()
+    return executors
+
+
+def run_batches_multiprocessor_yield(
+        function,
+        items,
+        args: tuple = (),
+        cores: int | None = None,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        executor: str = executor_default,
+        hybrid_threshold: int = hybrid_threshold_default,
+        stats: ScanStats | None = None,
+        device_readers: int | str | None = None,
+        small_file_size: int = small_file_size_default,
+) -> Generator:
+    """
+    Run function(item, *args) on each item (file) with a process pool (or thread pool, see executor), in batches
+    (see BatchSizer), yielding each result as soon as its batch is complete, in the order the batches complete
+    With the hybrid executor, items with a size (FileRecord) of hybrid_threshold bytes or more go to the thread pool
+    (the hash of large buffers runs outside the GIL and there is nothing to pickle), the rest to the process pool
+    (where the per file python work runs in parallel), each pool has its own batches
+    No more than max_in_flight batches are submitted and not yet yielded, so items (a generator) is only read as
+    fast as the work is done and memory does not grow with the number of items
+    With stats the time of each batch in the worker and in the queue is added to it
+    With device_readers the batches are made per device (st_dev of a FileRecord) and no more than device_readers
+    batches of a device are in flight at a time, see DeviceScheduler
+    Items with a size (FileRecord) of less than small_file_size bytes are run in batches in this thread while the
+    workers hash the rest (InlineExecutor), rather than being sent to a worker and back
+    """
+    if cores is None:
+        cores = max(cpu_count() - 1, 1)
+    if max_in_flight is None:
+        max_in_flight = cores * in_flight_per_core_default
+    log.info(
+        f"Processing with {executor} executor with {cores} out of {cpu_count()} cores, "
+        f"maximum tasks in flight: {max_in_flight}, batch size: {batch_size or 'adaptive'}"
+    )
+    log_listener = None
+    if executor in ("process", "hybrid"):
+        # the worker processes log through the one listener thread here, see init_worker_logging
+        log_listener = logging.handlers.QueueListener(multiprocessing.Queue(), LogRecordHandler())
+        log_listener.start()
+    executors = {}
+    in_flight = {}  # future: (batch sizer, time submitted, device)
+    scheduler = DeviceScheduler(device_readers)
+    if stats is not None:
+        t = time.perf_counter()
+
+    def submit_ready():
+        for device, pool, ready_batch in scheduler.ready(max_in_flight - len(in_flight)):
+            in_flight[executors[pool].submit(run_batch, function, ready_batch, *args)] = (
+                batch_sizers[pool], time.perf_counter(), device
+            )
+
+    try:
+        executors = get_executors(
+            executor, cores, None if log_listener is None else log_listener.queue, inline=small_file_size > 0
+        )
+        batch_sizers = {pool: BatchSizer(batch_size) for pool in executors}
+        batches = {}  # (pool, device): batch being filled
+        if stats is not None:
+            stats.workers = max(stats.workers, sum(1 if pool == "inline" else cores for pool in executors))
+        for item in items:
+            size = getattr(item, "size", None)  # None: not known (a path, or a report row without a size)
+            if size is not None and size < small_file_size:
+                pool = "inline"
+            elif executor == "hybrid":
+                pool = "thread" if size is not None and size >= hybrid_threshold else "process"
+            else:
+                pool = executor
+            key = (pool, scheduler.get_device(item))
+            batch = batches.setdefault(key, [])
+            batch.append(item)
+            if len(batch) < batch_sizers[pool].size:
+                continue
+            scheduler.add(key[1], pool, batch)
+            batches[key] = []
+            submit_ready()
+            # batches waiting for a reader on their device count towards the limit too
+            while in_flight and (len(in_flight) >= max_in_flight or scheduler.waiting >= max_in_flight):
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from _completed_results(done, in_flight, stats, scheduler)
+                submit_ready()
+
+        for (pool, device), batch in batches.items():
+            if batch:
+                scheduler.add(device, pool, batch)
+        submit_ready()
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from _completed_results(done, in_flight, stats, scheduler)
+            submit_ready()
+    finally:
+        for pool_executor in executors.values():
+            pool_executor.shutdown(wait=True)
+        if log_listener is not None:
+            log_listener.stop()  # after the workers have exited, so their last records are handled
+        if stats is not None:
+            stats.pool_seconds += time.perf_counter() - t
+
+
+def hold_back_big_files(file_list, max_hash_size: int, big_files: list) -> Generator:
+    """
+    pass on the files (FileRecord) from the file list, except those over max_hash_size: add them to big_files
+    the files in archives (ArchiveMember) are passed on, they are not tree hashed
+    """
+    for record in file_list:
+        if isinstance(record, FileRecord) and record.size > max_hash_size:
+            big_files.append(record)
+        else:
+            yield record
+
+
+class HardLinks:
+    """
+    Hash each physical file once: of the hard links to a file (FileRecord.nlink > 1) only the first in the file list is
+    hashed, the others wait for its result (or use it if it is already back) and get a copy of it with their own
+    path, file name and extension, the same row as if they had been read again
+    The result of a file is kept until all its links have been seen, the links outside the scan location never are
+    In a scan (main) the file list is filtered before the archives are expanded and the big files held back, so the
+    files in an archive are listed once, under its first link, and a big file is tree hashed once
+    With completed (--resume) the links already in the report are passed on (to be skipped), not waited on
+    """
+
+    def __init__(
+            self,
+            simple_output: bool,
+            scan_location: pathlib.Path = default_scan_location,
+            completed: set | None = None,
+    ):
+        self.simple_output = simple_output
+        self.scan_location = scan_location
+        self.completed = completed
+        self.waiting: dict = {}  # (device, inode): links found while the first link is being hashed
+        self.results: dict = {}  # (device, inode): [result, number of links not seen yet]
+        self.ready: deque = deque()  # (result, link) to pass on
+        self.links = 0
+        self.bytes_saved = 0
+
+    def filter(self, file_list) -> Generator:
+        """pass on the files (FileRecord) to hash, holding back the links to a file that is already hashed"""
+        for record in file_list:
+            if not isinstance(record, FileRecord) or record.nlink < 2:
+                yield record
+                continue
+            if (
+                    self.completed
+                    and get_journal_path(record.path, self.simple_output, self.scan_location) in self.completed
+            ):
+                yield record  # left out by skip_completed, the links not in the report are hashed (or copied)
+                continue
+            key = (record.dev, record.ino)
+            if key in self.waiting:
+                self.waiting[key].append(record)
+            elif key in self.results:
+                result_links = self.results[key]
+                self.ready.append((result_links[0], record))
+                result_links[1] -= 1
+                if result_links[1] < 1:
+                    del self.results[key]
+            else:
+                self.waiting[key] = []
+                yield record
+
+    def add_links(self, results) -> Generator[dict, None, None]:
+        """pass on the results (get_file_and_hash_data) of the files hashed, each followed by those of its links"""
+        for result in results:
+            yield result
+            hard_link = result.get(hard_link_field)
+            if hard_link is not None and hard_link[:2] in self.waiting:
+                links = self.waiting.pop(hard_link[:2])
+                not_seen = hard_link[2] - 1 - len(links)
+                if not_seen > 0:
+                    self.results[hard_link[:2]] = [result, not_seen]
+                self.ready.extend((result, link) for link in links)
+            while self.ready:
+                yield self.get_link_result(*self.ready.popleft())
+        while self.ready:
+            yield self.get_link_result(*self.ready.popleft())
+        if self.links:
+            log.info(f"Hard links: {self.links} files not read again, {self.bytes_saved} bytes saved")
+
+    def get_link_result(self, result: dict, link: FileRecord) -> dict:
+        """the result of a file for another hard link to it, without the internal (underscore) fields"""
+        self.links += 1
+        self.bytes_saved += link.size
+        link_result = {key: value for key, value in result.items() if not key.startswith("_")}
+        link_result["relative-path" if self.simple_output else "path"] = get_journal_path(
+            link.path, self.simple_output, self.scan_location
+        )
+        link_result["file-name"] = get_file_name(link.path)
+        link_result["file-extension"] = get_file_extension(link.path)
+        return link_result
+
+
+def run_hash_multiprocessor_yield(
+        file_list: List[pathlib.Path],
+        case_label: str,
+        simple_output: bool,
+        cores: int | None = None,
+        max_hash_size: int = max_hash_size_default,
+        scan_location: pathlib.Path = default_scan_location,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        cache: pathlib.Path | None = None,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        executor: str = executor_default,
+        hybrid_threshold: int = hybrid_threshold_default,
+        stats: ScanStats | None = None,
+        device_readers: int | str | None = None,
+        small_file_size: int = small_file_size_default,
+        mmap_threshold: int = mmap_threshold_default,
+        hard_links: HardLinks | None = None,
+) -> Generator[dict, None, None]:
+    """
+    Hash the files (get_file_and_hash_data) with a process pool, yielding each result as soon as it is complete
+    see run_batches_multiprocessor_yield
+    with stats each result has the time of the stages of the file, for stats.add_file()
+    the files of a compressed tar (--into-archives) come back as a list, each of them is yielded
+    each file with more than one hard link is read once, see HardLinks, with hard_links the file list is already
+    filtered by it and the caller adds the links to the results
+    """
+    add_links = hard_links is None
+    if add_links:
+        hard_links = HardLinks(simple_output, scan_location)
+        file_list = hard_links.filter(file_list)
+    results = run_batches_multiprocessor_yield(
+        get_file_and_hash_data,
+        file_list,
+        (
+            case_label,
+            simple_output,
+            max_hash_size,
+            scan_location,
+            buffer_size,
+            hash_names,
+            cache,
+            stats is not None,
+            mmap_threshold,
+        ),
+        cores=cores,
+        max_in_flight=max_in_flight,
+        batch_size=batch_size,
+        executor=executor,
+        hybrid_threshold=hybrid_threshold,
+        stats=stats,
+        device_readers=device_readers,
+        small_file_size=small_file_size,
+    )
+    results = (file_data for result in results for file_data in (result if isinstance(result, list) else [result]))
+    if add_links:
+        results = hard_links.add_links(results)
+    yield from results
+
+
+@benchmark
+def run_hash(file_list: List[pathlib.Path], case_label):
+    """used for testing - simple single processor core hash"""
+    for file in file_list:
+        result = get_file_and_hash_data(
+            file, case_label, simple_output=simple_output_default
+        )
+        print(result)
+
+
+def get_partial_hash(record: FileRecord, partial_hash_size: int = partial_hash_size_default) -> tuple:
+    """
+    SHA-1 of the first and last partial_hash_size bytes of a file (the whole file if it is no bigger than
+    2 * partial_hash_size), used to tell apart files of the same size without reading them all
+    return (record, hex digest)
+    """
+    hash = hashlib.sha1()
+    with open(record.path, mode="rb") as f, polite_read(f):
+        if record.size <= 2 * partial_hash_size:
+            data = f.read()
+            limit_io(len(data))
+            hash.update(data)
+        else:
+            for offset in (0, record.size - partial_hash_size):
+                f.seek(offset)
+                data = f.read(partial_hash_size)
+                limit_io(len(data))
+                hash.update(data)
+    return record, hash.hexdigest()
+
+
+@benchmark
+def find_duplicates(
+        scan_location: pathlib.Path,
+        report: pathlib.Path,
+        case_label: str,
+        simple_output: bool = simple_output_default,
+        first_n_files: int = None,
+        cores: int | None = cores,
+        max_hash_size: int = max_hash_size_default,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        cache: pathlib.Path | None = None,
+        cache_max_entries: int = cache_max_entries_default,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        walk_threads: int = walk_threads_default,
+        partial_hash_size: int = partial_hash_size_default,
+        executor: str = executor_default,
+        hybrid_threshold: int = hybrid_threshold_default,
+        device_readers: int | str | None = None,
+        small_file_size: int = small_file_size_default,
+        mmap_threshold: int = mmap_threshold_default,
+) -> pathlib.Path:
+    """
+    Find the groups of duplicate files at the scan location in stages, so most of the data is never read:
+    1) group the files from the walk by size, a file with a unique size has no duplicate
+    2) hash the first and last partial_hash_size bytes of the files that share a size, regroup
+    3) hash in full (all of hash_names) only the files that still share a size and partial hash, regroup
+    Write a report (get_csv_duplicates_header) of each group of duplicates with the bytes that would be
+    reclaimed by keeping only one of them, largest first
+    Empty files and files over max_hash_size are left out, hard links to the same file (st_dev, st_ino) are one file
+    (the first link found), they share the data so deleting a link would not reclaim any bytes
+    """
+    logging.debug(f"CSV duplicates report file: {report}")
+    if report.exists():
+        log.warning(f"Overwriting existing report file: {report}")
+
+    # 1) by size
+    by_size: dict = {}
+    files = 0
+    total_bytes = 0
+    linked = set()  # (st_dev, st_ino) of the files with more than one link
+    links = 0
+    for record in get_file_list(scan_location, first_n_files=first_n_files, walk_threads=walk_threads,
+                                file_records=True):
+        if record.nlink > 1:
+            if (record.dev, record.ino) in linked:
+                links += 1
+                continue
+            linked.add((record.dev, record.ino))
+        files += 1
+        total_bytes += record.size
+        if 0 < record.size <= max_hash_size:
+            by_size.setdefault(record.size, []).append(record)
+    candidates = [record for group in by_size.values() if len(group) > 1 for record in group]
+    del by_size, linked
+    if links:
+        log.info(f"{links} more hard links to files already found are left out")
+    log.info(f"{files} files, {total_bytes} bytes - {len(candidates)} files share a size with another file")
+
+    # 2) by partial hash
+    by_partial: dict = {}
+    bytes_read = 0
+    for record, partial_hash in run_batches_multiprocessor_yield(
+            get_partial_hash,
+            candidates,
+            (partial_hash_size,),
+            cores=cores,
+            max_in_flight=max_in_flight,
+            batch_size=batch_size,
+            executor=executor,
+            hybrid_threshold=hybrid_threshold,
+            device_readers=device_readers,
+            small_file_size=small_file_size,
+    ):
+        bytes_read += min(record.size, 2 * partial_hash_size)
+        by_partial.setdefault((record.size, partial_hash), []).append(record)
+    candidates = [record for group in by_partial.values() if len(group) > 1 for record in group]
+    del by_partial
+    log.info(f"{len(candidates)} files share a size and partial hash with another file")
+
+    # 3) by full hash(es)
+    hash_columns = [get_hash_column_name(hash_name, simple_output) for hash_name in hash_names]
+    by_hash: dict = {}
+    hash_cache = None
+    try:
+        if cache is not None:
+            hash_cache = HashCache(cache, max_entries=cache_max_entries)
+        for result in run_hash_multiprocessor_yield(
+                candidates,
+                case_label,
+                simple_output,
+                cores=cores,
+                max_hash_size=max_hash_size,
+                scan_location=scan_location,
+                buffer_size=buffer_size,
+                hash_names=hash_names,
+                cache=cache,
+                max_in_flight=max_in_flight,
+                batch_size=batch_size,
+                executor=executor,
+                hybrid_threshold=hybrid_threshold,
+                device_readers=device_readers,
+                small_file_size=small_file_size,
+                mmap_threshold=mmap_threshold,
+        ):
+            if hash_cache is not None:
+                hash_cache.update(result)
+            if not result.get(cache_hit_field):
+                bytes_read += result["size"]
+            if result["hash-error"] or hash_columns[0] not in result:
+                log.warning(f"not hashed: {result.get('path', result.get('relative-path'))}: {result['hash-error']}")
+                continue
+            key = (result["size"], *[result[column] for column in hash_columns])
+            by_hash.setdefault(key, []).append(result)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    groups = sorted(
+        (group for group in by_hash.values() if len(group) > 1),
+        key=lambda group: (-group[0]["size"] * (len(group) - 1), group[0]["size"]),
+    )
+    del by_hash
+
+    csv_head = get_csv_duplicates_header(hash_names, simple_output)
+    path_column = "relative-path" if simple_output else "path"
+    reclaimable_bytes = 0
+    with open(report, "w", encoding="utf-8") as output_file:
+        csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames=csv_head,
+            quoting=csv.QUOTE_ALL,
+            lineterminator="\n",
+            extrasaction="ignore",
+        )
+        csv_writer.writeheader()
+        for group_number, group in enumerate(groups, start=1):
+            group_reclaimable_bytes = group[0]["size"] * (len(group) - 1)
+            reclaimable_bytes += group_reclaimable_bytes
+            for result in sorted(group, key=lambda r: r[path_column]):
+                csv_writer.writerow(
+                    {
+                        **result,
+                        "group": group_number,
+                        "files": len(group),
+                        "reclaimable-bytes": group_reclaimable_bytes,
+                    }
+                )
+    log.info(
+        f"{len(groups)} groups of duplicate files, {sum(len(group) for group in groups)} files, "
+        f"reclaimable: {reclaimable_bytes} bytes - read {bytes_read} of {total_bytes} bytes"
+    )
+    return report
+
+
+def get_sorted_report_rows(
+        report: pathlib.Path,
+        key_column: str,
+        runs_location: pathlib.Path,
+        chunk_rows: int = compare_chunk_rows_default,
+        sort_key=None,
+) -> Generator[dict, None, None]:
+    """
+    The rows (dicts) of a csv report sorted on key_column, an external sort so the memory used does not grow with
+    the size of the report: chunk_rows rows at a time are sorted and written to a run file in a folder of its own in
+    runs_location (so two reports of the same name can be sorted there at the same time), then the runs are merged
+    (a report of no more than chunk_rows rows is sorted in memory)
+    with sort_key the rows are sorted on sort_key(value of key_column) rather than the value
+    """
+    with open(report, "r", encoding="utf-8", newline="") as fin:
+        reader = csv.reader(fin)
+        header = next(reader)
+        column = header.index(key_column)
+        if sort_key is None:
+            def key(r):
+                return r[column]
+        else:
+            def key(r):
+                return sort_key(r[column])
+        runs = []
+        runs_folder = None
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                chunk.sort(key=key)
+                if runs_folder is None:
+                    runs_folder = pathlib.Path(tempfile.mkdtemp(prefix=f"{report.stem}-", dir=runs_location))
+                run_file = runs_folder / f"{report.stem}-{len(runs)}.run.csv"
+                with open(run_file, "w", encoding="utf-8", newline="") as fout:
+                    csv.writer(fout, quoting=csv.QUOTE_ALL, lineterminator="\n").writerows(chunk)
+                runs.append(run_file)
+                chunk = []
+    chunk.sort(key=key)
+    if not runs:
+        for row in chunk:
+            yield dict(zip(header, row))
+        return
+
+    run_files = [open(run_file, "r", encoding="utf-8", newline="") for run_file in runs]
+    try:
+        for row in heapq.merge(*(csv.reader(f) for f in run_files), chunk, key=key):
+            yield dict(zip(header, row))
+    finally:
+        for f in run_files:
+            f.close()
+        for run_file in runs:
+            run_file.unlink(missing_ok=True)
+        runs_folder.rmdir()
+
+
+def get_report_header(report: pathlib.Path) -> list:
+    """the header (first row) of a csv report"""
+    with open(report, "r", encoding="utf-8", newline="") as fin:
+        return next(csv.reader(fin), [])
+
+
+def get_file_change(old: dict | None, new: dict | None, hash_columns: list) -> str | None:
+    """
+    added, removed or changed (the size or a hash that is in both is different), None if the file is unchanged
+    """
+    if old is None:
+        return "added"
+    if new is None:
+        return "removed"
+    if old["size"] != new["size"]:
+        return "changed"
+    for column in hash_columns:
+        if old[column] and new[column] and old[column] != new[column]:
+            return "changed"
+    return None
+
+
+@benchmark
+def compare_reports(
+        old_report: pathlib.Path,
+        new_report: pathlib.Path,
+        diff_report: pathlib.Path,
+        chunk_rows: int = compare_chunk_rows_default,
+) -> dict:
+    """
+    Compare two csv reports (default or simple output, both the same) e.g. of yesterday's and today's scan and write
+    the files added, removed and changed to the diff report (get_csv_diff_header)
+    The files are matched on relative-path (simple output) or path. Both reports are sorted on it (an external sort,
+    see get_sorted_report_rows) and merge joined, so no more than chunk_rows rows of either are in memory at a time
+    return dict of change: number of files, including unchanged
+    raise ValueError if the reports can not be compared
+    """
+    old_header = get_report_header(old_report)
+    new_header = get_report_header(new_report)
+    path_columns = [column for column in ("relative-path", "path") if column in old_header]
+    if not path_columns or path_columns[0] not in new_header:
+        raise ValueError(f"the reports do not have the same path column (relative-path or path): {old_header}, "
+                         f"{new_header}")
+    path_column = path_columns[0]
+    hash_columns = [column for column in get_hash_report_columns(old_header) if column in new_header]
+    if not hash_columns:
+        raise ValueError(f"the reports do not have a hash in common: {old_header}, {new_header}")
+    log.info(f"Comparing {old_report} with {new_report} on {path_column}, hashes: {','.join(hash_columns)}")
+
+    counts = {"added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+    with (
+        tempfile.TemporaryDirectory(dir=diff_report.parent) as runs_location,
+        open(diff_report, "w", encoding="utf-8") as output_file,
+    ):
+        csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames=get_csv_diff_header(path_column, hash_columns),
+            quoting=csv.QUOTE_ALL,
+            lineterminator="\n",
+        )
+        csv_writer.writeheader()
+        old_rows = get_sorted_report_rows(old_report, path_column, pathlib.Path(runs_location), chunk_rows)
+        new_rows = get_sorted_report_rows(new_report, path_column, pathlib.Path(runs_location), chunk_rows)
+        old = next(old_rows, None)
+        new = next(new_rows, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[path_column] < new[path_column]):
+                pair = (old, None)
+                old = next(old_rows, None)
+            elif old is None or new[path_column] < old[path_column]:
+                pair = (None, new)
+                new = next(new_rows, None)
+            else:
+                pair = (old, new)
+                old = next(old_rows, None)
+                new = next(new_rows, None)
+            change = get_file_change(*pair, hash_columns)
+            if change is None:
+                counts["unchanged"] += 1
+                continue
+            counts[change] += 1
+            row = {"change": change, path_column: (pair[0] or pair[1])[path_column]}
+            for prefix, file_row in zip(("old", "new"), pair):
+                if file_row is None:
+                    continue
+                row[f"{prefix}-size"] = file_row["size"]
+                row[f"{prefix}-modified"] = " ".join(
+                    file_row[column] for column in ("modified", "modified-time") if column in file_row
+                )
+                for column in hash_columns:
+                    row[f"{prefix}-{column}"] = file_row[column]
+            csv_writer.writerow(row)
+    log.info(", ".join(f"{change}: {count}" for change, count in counts.items()) + f" - diff report: {diff_report}")
+    return counts
+
+
+def get_digests_file(report: pathlib.Path) -> pathlib.Path:
+    """the file the directory digests of a report are written to (--tree-digests) e.g. hash_report.digests.csv"""
+    return report.with_suffix(".digests.csv")
+
+
+def get_tree_path_parts(path: str, simple_output: bool, scan_location: pathlib.Path) -> tuple:
+    """
+    the names of the folders and the file of a report path under the scan location, sorting on them puts each folder
+    and everything in it together, () for a path that is not in the tree (no relative path or a file in an archive)
+    """
+    if not path or path == "None" or archive_member_separator in path:
+        return ()
+    parts = pathlib.PurePath(path)
+    if not simple_output:
+        try:
+            parts = parts.relative_to(scan_location)
+        except ValueError:
+            return ()
+    return parts.parts
+
+
+@benchmark
+def write_tree_digests(
+        report: pathlib.Path,
+        digests_file: pathlib.Path,
+        hash_name: str = hash_names_default[0],
+        simple_output: bool = simple_output_default,
+        scan_location: pathlib.Path = default_scan_location,
+        chunk_rows: int = compare_chunk_rows_default,
+) -> str:
+    """
+    Merkle digests of the folders of a csv report (--tree-digests): the digest of a folder is the hash_name hash of a
+    line for each of its files (name, size and hash) and sub folders (name and digest) in name order, so it is the
+    same for two trees with the same names, sizes and hashes wherever they are, and the root digest is the same only
+    if the whole trees are the same. A file with no hash (e.g. over the maximum hash size) is in its folder by name
+    and size, one with a tree hash by its tree hash. The files in archives are left out, the archive is in its folder
+    The report is sorted on the names in its paths (an external sort, see get_sorted_report_rows) and each folder is
+    hashed as it goes, so no more than chunk_rows rows and one branch of the tree are in memory at a time
+    The digests are written to digests_file (_csv_digests_header_), each folder (by its relative path) before the
+    folder it is in, the root (.) last, rows that are not under the scan location (or have no relative path, "None")
+    are left out with a warning
+    return the root digest
+    raise ValueError if no row of the report is under the scan location (the digests would be of an empty tree)
+    """
+    if not pathlib.Path(scan_location).is_absolute():
+        # as get_file_list, the paths of a default output report are under the resolved scan location
+        scan_location = pathlib.Path(scan_location).resolve()
+    path_column = "relative-path" if simple_output else "path"
+    hash_column = get_hash_column_name(hash_name, simple_output)
+    tree_hash_column = get_tree_hash_column_name(hash_name, simple_output)
 
-        if file_size < 1:
-            file_data["hash-error"] = "file size is 0 bytes"
-            log.debug(f"zero bytes file: {file}: size: {file_size}")
+    def get_parts(path: str) -> tuple:
+        return get_tree_path_parts(path, simple_output, scan_location)
+
+    # the folders of the branch being hashed, root first: [names, hash, files, bytes]
+    stack = [[(), hashlib.new(hash_name), 0, 0]]
+    inside = 0
+    outside = 0
+    with (
+        tempfile.TemporaryDirectory(dir=digests_file.parent) as runs_location,
+        open(digests_file, "w", encoding="utf-8") as output_file,
+    ):
+        csv_writer = csv.writer(output_file, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        csv_writer.writerow(_csv_digests_header_)
+
+        def close_folder() -> str:
+            names, folder_hash, files, total = stack.pop()
+            digest = folder_hash.hexdigest()
+            csv_writer.writerow(["/".join(names) or ".", digest, files, total])
+            if stack:
+                parent = stack[-1]
+                parent[1].update(json.dumps(["d", names[-1], digest]).encode() + b"\n")
+                parent[2] += files
+                parent[3] += total
+            return digest
+
+        for row in get_sorted_report_rows(report, path_column, pathlib.Path(runs_location), chunk_rows, get_parts):
+            names = get_parts(row[path_column])
+            if not names:
+                if archive_member_separator not in row[path_column]:
+                    outside += 1
+                continue
+            inside += 1
+            folder = names[:-1]
+            while stack[-1][0] != folder[:len(stack[-1][0])]:
+                close_folder()
+            for depth in range(len(stack[-1][0]), len(folder)):
+                stack.append([folder[:depth + 1], hashlib.new(hash_name), 0, 0])
+            size = row.get("size") or ""
+            file_hash = row.get(hash_column) or ""
+            if not file_hash and row.get(tree_hash_column):
+                file_hash = f"tree:{row[tree_hash_column]}"
+            stack[-1][1].update(json.dumps(["f", names[-1], size, file_hash]).encode() + b"\n")
+            stack[-1][2] += 1
+            stack[-1][3] += int(size) if size else 0
+        while len(stack) > 1:
+            close_folder()
+        root_digest = close_folder()
+    if outside and not inside:
+        digests_file.unlink()
+        raise ValueError(f"none of the {outside} rows of {report} are under the scan location {scan_location}")
+    if outside:
+        log.warning(f"{outside} rows of {report} are not under the scan location {scan_location}, "
+                    f"they are not in the directory digests")
+    log.info(f"Root digest: {root_digest} - directory digests: {digests_file}")
+    return root_digest
+
+
+def read_tree_digests(digests_file: pathlib.Path) -> dict:
+    """the digests of a digests file (write_tree_digests): dict of folder: row, raise ValueError if it is not one"""
+    with open(digests_file, "r", encoding="utf-8", newline="") as fin:
+        reader = csv.DictReader(fin)
+        if reader.fieldnames != _csv_digests_header_:
+            raise ValueError(f"not a directory digests file: {digests_file}")
+        return {row["directory"]: row for row in reader}
+
+
+def is_digests_file(file: pathlib.Path) -> bool:
+    return get_report_header(file) == _csv_digests_header_
+
+
+@benchmark
+def compare_tree_digests(old_digests: pathlib.Path, new_digests: pathlib.Path, diff_report: pathlib.Path) -> dict:
+    """
+    Compare the directory digests of two trees (write_tree_digests): if the root digests are the same so are the
+    trees. The folders added, removed and changed (a different digest, so a file or folder in it, or in a folder in
+    it, is different) are written to the diff report (_csv_digests_diff_header_) in path order, the changed folders
+    with no changed sub folder are where the differences are
+    The digests files have one row per folder, not per file, so both are read into memory
+    return dict of change: number of folders, including unchanged
+    """
+    old = read_tree_digests(old_digests)
+    new = read_tree_digests(new_digests)
+    counts = {"added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+    with open(diff_report, "w", encoding="utf-8") as output_file:
+        csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames=_csv_digests_diff_header_,
+            quoting=csv.QUOTE_ALL,
+            lineterminator="\n",
+        )
+        csv_writer.writeheader()
+        for folder in sorted(old.keys() | new.keys(), key=lambda f: () if f == "." else tuple(f.split("/"))):
+            old_row = old.get(folder)
+            new_row = new.get(folder)
+            if old_row is None:
+                change = "added"
+            elif new_row is None:
+                change = "removed"
+            elif old_row["digest"] != new_row["digest"]:
+                change = "changed"
+            else:
+                counts["unchanged"] += 1
+                continue
+            counts[change] += 1
+            row = {"change": change, "directory": folder}
+            for prefix, folder_row in (("old", old_row), ("new", new_row)):
+                if folder_row is not None:
+                    for column in ("digest", "files", "bytes"):
+                        row[f"{prefix}-{column}"] = folder_row[column]
+            csv_writer.writerow(row)
+    if old.get(".", {}).get("digest") == new.get(".", {}).get("digest"):
+        log.info(f"The trees are the same, root digest: {old['.']['digest']}")
+    else:
+        log.info("The trees are different")
+    log.info(", ".join(f"{change}: {count}" for change, count in counts.items()) + f" - diff report: {diff_report}")
+    return counts
 
+
+class VerifyItem(NamedTuple):
+    """a file listed in the report being verified (--verify), with its size and hashes from the report"""
+    relative_path: str | None  # None: the row has no relative path, it can not be verified
+    size: int | None
+    hashes: dict  # hash name: hex digest, only the hashes that are in the report for the file
+
+
+def verify_file(
+        item: VerifyItem,
+        scan_location: pathlib.Path,
+        buffer_size: int = read_buffer_size_default,
+        mmap_threshold: int = mmap_threshold_default,
+) -> dict:
+    """
+    Hash a file listed in a report at its relative path under the scan location, all its hashes in one read
+    a file in an archive (--into-archives, archive.zip!/inner/file.txt) is read from the archive
+    return a row of the verify report (get_csv_verify_header) with status: ok, mismatch (size or a hash is
+    different), missing, not hashed (no hash in the report, the size matches), not verified (no relative path in the
+    report) or error
+    """
+    if item.relative_path is None:
+        return {"status": "not verified", "expected-size": item.size, "error": "no relative path in the report"}
+    archive, separator, name = item.relative_path.partition(archive_member_separator)
+    file = scan_location / item.relative_path
+    result = {"relative-path": item.relative_path, "expected-size": item.size}
+    for hash_name, digest in item.hashes.items():
+        result[f"expected-{hash_name}"] = digest
+    try:
+        member = None
+        if separator:
+            member = get_archive_member(scan_location / archive, name)
+            result["size"] = member.size
+        else:
+            result["size"] = file.stat().st_size
+        if item.size is not None and result["size"] != item.size:
+            result["status"] = "mismatch"
+        elif not item.hashes:
+            result["status"] = "not hashed"
+        else:
+            if member is not None:
+                result |= get_archive_member_hashes(member, tuple(item.hashes), buffer_size)
+            else:
+                result |= get_hashes(file, tuple(item.hashes), buffer_size, mmap_threshold=mmap_threshold)
+            matched = all(result[hash_name] == digest for hash_name, digest in item.hashes.items())
+            result["status"] = "ok" if matched else "mismatch"
+    except (FileNotFoundError, KeyError):
+        result["status"] = "missing"
     except Exception as e:
-        file_data["hash-error"] = e
+        result["status"] = "error"
+        result["error"] = str(e)
+    return result
 
-    return file_data
+
+def read_verify_items(report: pathlib.Path, hash_names: tuple) -> Generator[VerifyItem, None, None]:
+    """
+    Stream the files listed in a simple output report (relative-path) as VerifyItem, a row with no relative path
+    (e.g. "None") has a relative path of None, so it is counted as not verified
+    """
+    with open(report, "r", encoding="utf-8", newline="") as fin:
+        for row in csv.DictReader(fin):
+            relative_path = row["relative-path"]
+            if not relative_path or relative_path == "None":
+                log.warning(f"no relative path in the report, not verified: {row}")
+                relative_path = None
+            size = row.get("size")
+            yield VerifyItem(
+                relative_path,
+                int(size) if size else None,
+                {hash_name: row[hash_name] for hash_name in hash_names if row.get(hash_name)},
+            )
 
 
-def get_file_list(
+def get_extra_files(
+        report: pathlib.Path,
         scan_location: pathlib.Path,
-        first_n_files: int | None = first_n_files,
-) -> List[pathlib.Path]:
+        runs_location: pathlib.Path,
+        chunk_rows: int = compare_chunk_rows_default,
+) -> Generator[str, None, None]:
     """
-    Populates the lists of objects (file(s) etc to be catalogued)
-    file path -scan_location- to be catalogued (relative or absolute)
-    creates a list of all file items
-    yield pathlib items
+    The relative paths of the files in the folders of a simple output report that are not listed in it, each folder
+    is listed on its own (os.scandir) rather than walking the whole tree, so files in folders that are not in the
+    report are not found, the files in archives are not checked
+    The report is sorted on the folder of each path (an external sort in runs_location, see get_sorted_report_rows)
+    so only the names listed in one folder are in memory at a time, the folder is listed once the rows move past it
     """
-    file_list = []
 
-    # just a single file
-    if scan_location.is_file():
-        log.info("Scan location is a file: {0}".format(str(scan_location)))
-        # file_list.append(pathlib.Path(scan_location))
-        yield scan_location
-    else:
-        log.info("Scan location is a folder: {0}".format(pathlib.Path(scan_location)))
+    def get_folder(relative_path: str) -> str:
+        return str(pathlib.PurePath(relative_path).parent)
 
-    if pathlib.Path(scan_location).is_absolute():
-        # log.debug('Scan location to hash: {0}'.format(pathlib.Path(scan_location)))
-        scan_location = pathlib.Path(scan_location)
-    else:
-        scan_location = pathlib.Path(scan_location).resolve()
-        # log.debug('File (relative) location to hash: {0}'.format(scan_location))
+    def get_folder_extra_files(folder: str, names: set) -> Generator[str, None, None]:
+        try:
+            with os.scandir(scan_location / folder) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False) and entry.name not in names:
+                        yield str(pathlib.PurePath(folder) / entry.name)
+        except OSError as e:
+            log.debug(f"folder not listed: {e}")
 
-    if not pathlib.Path(scan_location).exists():
-        log.critical("Location to hash is not found: {0}".format(scan_location))
-        exit(1)
+    folder = None
+    names = set()
+    for row in get_sorted_report_rows(report, "relative-path", runs_location, chunk_rows, get_folder):
+        relative_path = row["relative-path"]
+        if not relative_path or relative_path == "None" or archive_member_separator in relative_path:
+            continue
+        path = pathlib.PurePath(relative_path)
+        if str(path.parent) != folder:
+            if folder is not None:
+                yield from get_folder_extra_files(folder, names)
+            folder = str(path.parent)
+            names = set()
+        names.add(path.name)
+    if folder is not None:
+        yield from get_folder_extra_files(folder, names)
 
-    # item_list = scan_location.glob(filter)
-    item_list: Generator[pathlib.Path, None, None] | None = None
-    try:
-        item_list = scan_location.rglob("*")
 
-    except Exception as e:
-        logging.warning("rglob: {0}".format(e))
+@benchmark
+def verify_report(
+        report: pathlib.Path,
+        scan_location: pathlib.Path,
+        verify_output: pathlib.Path,
+        cores: int | None = cores,
+        buffer_size: int = read_buffer_size_default,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        executor: str = executor_default,
+        hybrid_threshold: int = hybrid_threshold_default,
+        mmap_threshold: int = mmap_threshold_default,
+        chunk_rows: int = compare_chunk_rows_default,
+) -> dict:
+    """
+    Verify the files listed in a report (simple output, relative-path) e.g. after they have been copied to new
+    media: each file is hashed at its relative path under the scan location (the new root) with the hashes in
+    the report, through the process pool, the report is streamed so it is never all in memory
+    The files that do not match, are missing or are in the folders of the report but not listed in it (extra, see
+    get_extra_files, which sorts the report chunk_rows rows at a time) are written to the verify output
+    (get_csv_verify_header), only the listed files and folders are read: the tree is not walked
+    The rows with no relative path (e.g. "None") can not be checked, they are not verified (which fails the verify)
+    return dict of status: number of files
+    raise ValueError if the report has no relative-path or hash column
+    """
+    header = get_report_header(report)
+    if "relative-path" not in header:
+        raise ValueError(f"the report to verify needs a relative-path column (a --simple report): {report}")
+    hash_names = tuple(column for column in header if column in supported_hash_names)
+    if not hash_names:
+        raise ValueError(f"no hash column in the report to verify: {report}")
+    log.info(f"Verifying the files in {report} under {scan_location}, hashes: {','.join(hash_names)}")
+    if verify_output.exists():
+        log.warning(f"Overwriting existing report file: {verify_output}")
 
-    count = 1
-    for item in item_list:
+    counts = {"ok": 0, "mismatch": 0, "missing": 0, "extra": 0, "not hashed": 0, "not verified": 0, "error": 0}
+    with (
+        tempfile.TemporaryDirectory(dir=verify_output.parent) as runs_location,
+        open(verify_output, "w", encoding="utf-8") as output_file,
+    ):
+        csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames=get_csv_verify_header(hash_names),
+            quoting=csv.QUOTE_ALL,
+            lineterminator="\n",
+        )
+        csv_writer.writeheader()
+        for result in run_batches_multiprocessor_yield(
+                verify_file,
+                read_verify_items(report, hash_names),
+                (scan_location, buffer_size, mmap_threshold),
+                cores=cores,
+                max_in_flight=max_in_flight,
+                batch_size=batch_size,
+                executor=executor,
+                hybrid_threshold=hybrid_threshold,
+        ):
+            counts[result["status"]] += 1
+            if result["status"] != "ok":
+                csv_writer.writerow(result)
+        for relative_path in get_extra_files(report, scan_location, pathlib.Path(runs_location), chunk_rows):
+            counts["extra"] += 1
+            csv_writer.writerow({"status": "extra", "relative-path": relative_path})
+    log.info(", ".join(f"{status}: {count}" for status, count in counts.items()) + f" - verify report: {verify_output}")
+    return counts
+
+
+def read_known_hash_list(hash_list: pathlib.Path) -> Generator[bytes, None, None]:
+    """
+    The digests in a known hash list: a text file with a hex digest at the start of each line, on its own or as the
+    first (maybe quoted) field of a csv e.g. the NSRL, lines that do not start with a hex digest (e.g. a header) are
+    skipped
+    """
+    with open(hash_list, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            field = line.split(",", 1)[0].strip().strip('"').strip()
+            if not field:
+                continue
+            try:
+                yield bytes.fromhex(field)
+            except ValueError:
+                continue
+
+
+def get_known_hash_name(digest_size: int, hash_names: tuple = hash_names_default) -> str:
+    """the first of the hash names with digests of digest_size bytes, raise ValueError if there is not one"""
+    for hash_name in hash_names:
+        if hashlib.new(hash_name).digest_size == digest_size:
+            return hash_name
+    raise ValueError(f"no hash of {digest_size} bytes in: {','.join(hash_names)}")
+
+
+def build_known_hash_index(
+        hash_list: pathlib.Path,
+        index_file: pathlib.Path,
+        hash_names: tuple = hash_names_default,
+        chunk_digests: int = known_hash_sort_chunk_default,
+) -> pathlib.Path:
+    """
+    Build the index of a known hash list (see KnownHashes): the header and the digests, sorted, without duplicates
+    The hash is the first of hash_names with the digest size of the list (e.g. 20 bytes: sha1)
+    The list is sorted chunk_digests at a time into temporary runs that are then merged, so lists bigger than memory
+    can be indexed, digests of a different size to the first are skipped
+    return the index file
+    """
+    digest_size = None
+    skipped = 0
+    with tempfile.TemporaryDirectory(dir=index_file.parent) as runs_location:
+        runs = []
+
+        def write_run(digests: list):
+            run_file = pathlib.Path(runs_location) / f"{len(runs)}.run"
+            with open(run_file, "wb") as run:
+                run.write(b"".join(sorted(digests)))
+            runs.append(run_file)
+
+        chunk = []
+        for digest in read_known_hash_list(hash_list):
+            if digest_size is None:
+                digest_size = len(digest)
+            if len(digest) != digest_size:
+                skipped += 1
+                continue
+            chunk.append(digest)
+            if len(chunk) >= chunk_digests:
+                write_run(chunk)
+                chunk = []
+        if chunk:
+            write_run(chunk)
+        if digest_size is None:
+            raise ValueError(f"no hashes in the known hash list: {hash_list}")
+        hash_name = get_known_hash_name(digest_size, hash_names)
+        if skipped:
+            log.warning(f"{skipped} hashes that are not {hash_name} skipped in the known hash list: {hash_list}")
+
+        run_files = [open(run_file, "rb") for run_file in runs]
         try:
-            # lots of other files system information may be gathered at this point if needed
-            if item.is_file():
-                # file_list.append(item)
-                yield item
-                if first_n_files is not None:
-                    count = count + 1
-                    if count > first_n_files:
-                        log.info(
-                            f"Only attempting to hash the first: {first_n_files} at the scan_location: {scan_location}"
-                        )
-                        break
+            with open(index_file, "wb") as index:
+                index.write(
+                    known_hash_index_magic + hash_name.encode("ascii").ljust(
+                        known_hash_index_header_size - len(known_hash_index_magic), b"\0"
+                    )
+                )
+                previous = None
+                count = 0
+                for digest in heapq.merge(
+                        *(iter(partial(run_file.read, digest_size), b"") for run_file in run_files)
+                ):
+                    if digest != previous:
+                        index.write(digest)
+                        previous = digest
+                        count += 1
+        finally:
+            for run_file in run_files:
+                run_file.close()
+    log.info(f"Known hash index: {count} {hash_name} hashes from {hash_list}: {index_file}")
+    return index_file
 
-        except Exception as e:
-            logging.warning("get file list: {0}".format(e))
 
-    # logging.debug('Size of file list to hash: {0}'.format(len(file_list)))
-    # return file_list
+class KnownHashes:
+    """
+    A known hash list (--known-hashes) as its index file (see build_known_hash_index) memory mapped: a header with
+    the hash name, then the binary digests sorted, looked up with a binary search. A digest is 20 bytes for SHA-1
+    rather than the 100 or so of a hex string in a python set, and the pages of the index are shared by the
+    operating system and only read as they are needed
+    """
 
+    def __init__(self, index_file: pathlib.Path, name: str | None = None):
+        self.index_file = index_file
+        self.name = index_file.stem if name is None else name
+        self._file = open(index_file, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can not be mapped
+            self._file.close()
+            raise ValueError(f"not a known hash index: {index_file}")
+        header = self._map[:known_hash_index_header_size]
+        if not header.startswith(known_hash_index_magic):
+            self.close()
+            raise ValueError(f"not a known hash index: {index_file}")
+        self.hash_name = header[len(known_hash_index_magic):].rstrip(b"\0").decode("ascii")
+        self.digest_size = hashlib.new(self.hash_name).digest_size
+        self._count = (len(self._map) - known_hash_index_header_size) // self.digest_size
 
-def run_hash_multiprocessor_yield(
-        file_list: List[pathlib.Path],
-        case_label: str,
-        simple_output: bool,
-        cores: int | None = None,
-        max_hash_size: int = max_hash_size_default,
-        scan_location: pathlib.Path = default_scan_location,
-) -> Generator[int, None, None]:
-    futures = []
-    if cores is None:
-        cores = cpu_count() - 1
-    log.info(
-        f"Processing with multi processor executor with {cores} out of {cpu_count()} cores"
-    )
-    with ProcessPoolExecutor(cores) as executor:
-        for file in file_list:
-            futures.append(
-                executor.submit(
-                    get_file_and_hash_data,
-                    file,
-                    case_label,
-                    simple_output,
-                    max_hash_size,
-                    scan_location,
+    @classmethod
+    def load(cls, hash_list: pathlib.Path, hash_names: tuple, index_location: pathlib.Path) -> "KnownHashes":
+        """the known hashes of an index file, or of a text list: indexed to a file in index_location first"""
+        with open(hash_list, "rb") as f:
+            is_index = f.read(len(known_hash_index_magic)) == known_hash_index_magic
+        if is_index:
+            known_hashes = cls(hash_list)
+        else:
+            index_file = build_known_hash_index(hash_list, index_location / f"{hash_list.name}.index", hash_names)
+            known_hashes = cls(index_file, name=hash_list.stem)
+        if known_hashes.hash_name not in hash_names:
+            known_hashes.close()
+            raise ValueError(f"the known hash list is {known_hashes.hash_name}, not hashed (--hash): {hash_list}")
+        return known_hashes
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        """the i-th digest, for bisect"""
+        start = known_hash_index_header_size + i * self.digest_size
+        return self._map[start:start + self.digest_size]
+
+    def __contains__(self, hex_digest: str | None) -> bool:
+        if not hex_digest:
+            return False
+        try:
+            digest = bytes.fromhex(hex_digest)
+        except ValueError:
+            return False
+        i = bisect.bisect_left(self, digest)
+        return i < self._count and self[i] == digest
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+
+def get_known_hash_matches(file_data: dict, known_hashes: list, simple_output: bool = simple_output_default) -> list:
+    """the names of the known hash lists (KnownHashes) the hash of a file (get_file_and_hash_data) is in"""
+    return [
+        known.name for known in known_hashes
+        if file_data.get(get_hash_column_name(known.hash_name, simple_output)) in known
+    ]
+
+
+class SqliteReport:
+    """
+    --report-format sqlite: the report as the table report in an sqlite database, a column for each column of the
+    csv report, so the duplicate and lookup queries can be run on the report itself
+
+    Used in place of csv.DictWriter: writerow() keeps the rows and inserts them batch_rows at a time with
+    executemany, commit() commits them in one transaction (at each checkpoint of the scan journal) and returns the
+    number of rows in the report. The indexes on the hash, size and path columns are only made at the end
+    (create_indexes()) as building them once is much faster than updating them for every row
+    """
+
+    table = "report"
+
+    def __init__(
+            self,
+            report_file: pathlib.Path,
+            fieldnames: list,
+            append: bool = False,
+            batch_rows: int = report_batch_rows_default,
+    ):
+        if not append:
+            for file in (report_file, pathlib.Path(f"{report_file}-wal"), pathlib.Path(f"{report_file}-shm")):
+                file.unlink(missing_ok=True)
+        self.report_file = report_file
+        self.fieldnames = fieldnames
+        self.batch_rows = batch_rows
+        self.closed = False
+        self._rows = []
+        self.connection = sqlite3.connect(report_file)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")  # a commit is on disk, as the journal says it is
+        columns = ", ".join(self.quote(name) for name in fieldnames)
+        self._insert = f"INSERT INTO {self.table} ({columns}) VALUES ({', '.join('?' * len(fieldnames))})"
+
+    @staticmethod
+    def quote(name: str) -> str:
+        """a column name as an sqlite identifier, the names have - in them"""
+        return '"' + name.replace('"', '""') + '"'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def writeheader(self):
+        """create the table, size is an integer column and the rest are text as in the csv report"""
+        columns = ", ".join(
+            f"{self.quote(name)} {'INTEGER' if name == 'size' else 'TEXT'}" for name in self.fieldnames
+        )
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({columns})")
+
+    def writerow(self, row: dict):
+        """add a report row, the fields not in the report (e.g. the internal underscore fields) are left out"""
+        values = []
+        for name in self.fieldnames:
+            value = row.get(name, "")
+            if not isinstance(value, (str, int, float)) and value is not None:
+                value = str(value)  # e.g. the exception in hash-error
+            values.append(value)
+        self._rows.append(values)
+        if len(self._rows) >= self.batch_rows:
+            self._insert_rows()
+
+    def _insert_rows(self):
+        if self._rows:
+            self.connection.executemany(self._insert, self._rows)
+            self._rows = []
+
+    def commit(self) -> int:
+        """commit the rows written so far, return the number of rows in the report"""
+        self._insert_rows()
+        self.connection.commit()
+        return self.connection.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {self.table}").fetchone()[0]
+
+    def create_indexes(self):
+        """index the hash columns, size and the path column"""
+        for name in self.fieldnames:
+            if name in ("size", "path", "relative-path") or name in get_hash_report_columns(self.fieldnames):
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self.quote(f'{self.table}-{name}')} "
+                    f"ON {self.table} ({self.quote(name)})"
                 )
-            )
+        self.connection.commit()
+
+    def close(self):
+        if self.closed:
+            return
+        self.commit()
+        self.connection.close()
+        self.closed = True
 
-    for future in concurrent.futures.as_completed(futures):
+    @classmethod
+    def truncate(cls, report_file: pathlib.Path, rows: int):
+        """drop the rows after the first rows, e.g. those after the last checkpoint of an interrupted scan"""
+        connection = sqlite3.connect(report_file)
         try:
-            hash_object = future.result()
-        except Exception as e:
-            log.error(f"hash generated an exception: {e}")
+            connection.execute(f"DELETE FROM {cls.table} WHERE rowid > ?", (rows,))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def get_hash_report_columns(fieldnames: list) -> list:
+    """the hash columns (any hash, tree hash, not the uppercase copies) of a report header"""
+    hash_columns = {get_hash_column_name(name, simple) for name in supported_hash_names for simple in (True, False)}
+    return [
+        name for name in fieldnames
+        if name in hash_columns or (name.startswith("tree-") and name[len("tree-"):] in hash_columns)
+    ]
+
+
+def get_journal(report: pathlib.Path) -> pathlib.Path:
+    """the journal of the files completed in the report e.g. hash_report.journal"""
+    return report.with_suffix(".journal")
+
+
+class ScanJournal:
+    """
+    Journal of the files written to the report, so an interrupted scan can be resumed (--resume)
+
+    Each file is a line: P<tab><json path>. At a checkpoint the report is flushed (and synced) to disk, then the
+    files written since the last checkpoint and a commit line with the size of the report: C<tab><bytes> are
+    appended to the journal and synced. On resume the report is cut back to the size in the last commit line (so
+    rows after it, maybe half written, are dropped) and only the files before that line are skipped
+    With an sqlite report (SqliteReport) the checkpoint is a commit and the commit line has the number of rows
+    A checkpoint is made every checkpoint_rows files or checkpoint_seconds, and when the journal is closed
+    (including when the scan is stopped with Ctrl-C)
+    """
+
+    def __init__(
+            self,
+            journal_file: pathlib.Path,
+            report_file,
+            append: bool = False,
+            checkpoint_rows: int = checkpoint_rows_default,
+            checkpoint_seconds: float = checkpoint_seconds_default,
+    ):
+        self.journal_file = journal_file
+        self.report_file = report_file
+        self.checkpoint_rows = checkpoint_rows
+        self.checkpoint_seconds = checkpoint_seconds
+        self._pending = []
+        self._last_checkpoint = time.monotonic()
+        self._journal = open(journal_file, "a" if append else "w", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, path: str):
+        """a file has been written to the report"""
+        self._pending.append(path)
+        if (
+                len(self._pending) >= self.checkpoint_rows
+                or time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds
+        ):
+            self.checkpoint()
+
+    def checkpoint(self):
+        if isinstance(self.report_file, SqliteReport):
+            offset = self.report_file.commit()
         else:
-            yield hash_object
+            self.report_file.flush()
+            os.fsync(self.report_file.fileno())
+            offset = self.report_file.tell()
+        self._journal.writelines(f"P\t{json.dumps(path)}\n" for path in self._pending)
+        self._journal.write(f"C\t{offset}\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._pending = []
+        self._last_checkpoint = time.monotonic()
 
+    def close(self):
+        if self._journal.closed:
+            return
+        if not self.report_file.closed:
+            self.checkpoint()
+        self._journal.close()
 
-@benchmark
-def run_hash(file_list: List[pathlib.Path], case_label):
-    """used for testing - simple single processor core hash"""
-    for file in file_list:
-        result = get_file_and_hash_data(
-            file, case_label, simple_output=simple_output_default
+    @staticmethod
+    def load(journal_file: pathlib.Path) -> tuple:
+        """
+        Read the journal of an interrupted scan, and cut it back to its last commit line
+        return (set of the paths in the report, size of the report in bytes (rows for an sqlite report)) the size
+        is None if there is no commit
+        """
+        completed = set()
+        pending = []
+        offset = None
+        journal_size = 0
+        position = 0
+        with open(journal_file, "rb") as f:
+            for line in f:
+                position += len(line)
+                if not line.endswith(b"\n"):
+                    break  # half written
+                kind, _, value = line.decode("utf-8").rstrip("\n").partition("\t")
+                if kind == "P":
+                    pending.append(json.loads(value))
+                elif kind == "C":
+                    completed.update(pending)
+                    pending = []
+                    offset = int(value)
+                    journal_size = position
+        with open(journal_file, "r+b") as f:
+            f.truncate(journal_size)
+        return completed, offset
+
+
+def skip_completed(file_list, completed: set, simple_output: bool, scan_location: pathlib.Path) -> Generator:
+    """
+    pass on the files (FileRecord) from the file list that are not already completed (in the report)
+    the files of a compressed tar (ArchiveMember with no name) are hashed in one pass, those completed are left out of
+    the report after they are hashed
+    """
+    skipped = 0
+    for record in file_list:
+        if isinstance(record, ArchiveMember):
+            if record.name is None:
+                yield record
+                continue
+            path = get_journal_path(record.archive, simple_output, scan_location)
+            path = f"{path}{archive_member_separator}{record.name}"
+        else:
+            path = get_journal_path(record.path, simple_output, scan_location)
+        if path in completed:
+            skipped += 1
+            continue
+        yield record
+    log.info(f"Resume: skipped {skipped} files already in the report")
+
+
+def get_journal_path(file: pathlib.Path, simple_output: bool, scan_location: pathlib.Path) -> str:
+    """the path of a file as in the report, relative-path (simple output) or path, for the journal"""
+    if simple_output:
+        return str(get_relative_path(file, scan_location))
+    return str(file)
+
+
+def get_segments_report(report: pathlib.Path) -> pathlib.Path:
+    """the file the segment digests of the tree hashes are written to e.g. hash_report.segments.csv"""
+    return report.with_suffix(".segments.csv")
+
+
+def run_tree_hashes(
+        big_files: list,
+        segments_report: pathlib.Path,
+        hash_names: tuple = hash_names_default,
+        segment_size: int = segment_size_default,
+        buffer_size: int = read_buffer_size_default,
+        cores: int | None = cores,
+        max_in_flight: int | None = None,
+        scan_location: pathlib.Path = default_scan_location,
+        append: bool = False,
+        executor: str = executor_default,
+        stats: ScanStats | None = None,
+) -> Generator[tuple, None, None]:
+    """
+    Tree hash the big files (FileRecord), the segments of all of them are hashed across the process pool so even
+    one big file uses all the cores
+    The segment digests of each file are written to the segments report (added to the end of it with append) as
+    soon as all its segments are hashed, and the file is yielded then, so it can be written to the report (and
+    journaled) before the next one
+    With the thread or hybrid executor the segments are hashed in threads (they are all large buffers)
+    yield (record, dict of hash name: tree hash) or (record, the exception) if a segment could not be hashed
+    """
+    records = {record.path: record for record in big_files}
+    segment_digests: dict = {}  # path: {segment number: (offset, length, digests)} of the files not complete yet
+    segments = (segment for record in big_files for segment in get_segments(record, segment_size))
+
+    append = append and segments_report.exists()
+    with open(segments_report, "a" if append else "w", encoding="utf-8") as output_file:
+        csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames=_csv_segments_header_,
+            quoting=csv.QUOTE_ALL,
+            lineterminator="\n",
         )
-        print(result)
+        if not append:
+            csv_writer.writeheader()
+        for segment, digests in run_batches_multiprocessor_yield(
+                get_segment_hashes,
+                segments,
+                (hash_names, buffer_size),
+                cores=cores,
+                max_in_flight=max_in_flight,
+                batch_size=1,  # each segment is a big task
+                executor="process" if executor == "process" else "thread",
+                stats=stats,
+        ):
+            path, number, offset, length = segment
+            record_digests = segment_digests.setdefault(path, {})
+            record_digests[number] = (offset, length, digests)
+            expected = len(get_segments(records[path], segment_size))
+            if len(record_digests) < expected:
+                continue
+            del segment_digests[path]
+            for number in range(expected):
+                offset, length, segment_hashes = record_digests[number]
+                for hash_name in hash_names:
+                    csv_writer.writerow(
+                        {
+                            "path": str(path),
+                            "relative-path": str(get_relative_path(path, scan_location)),
+                            "hash": hash_name,
+                            "segment": number,
+                            "offset": offset,
+                            "length": length,
+                            "digest": segment_hashes[hash_name],
+                        }
+                    )
+            output_file.flush()
+            yield records[path], {
+                hash_name: get_tree_hash([record_digests[n][2][hash_name] for n in range(expected)], hash_name)
+                for hash_name in hash_names
+            }
+        for record in big_files:
+            if record.path in segment_digests:
+                expected = len(get_segments(record, segment_size))
+                yield record, Exception(
+                    f"tree hash failed, {expected - len(segment_digests[record.path])} of {expected} segments "
+                    f"not hashed"
+                )
+
+
+def get_tree_hash_results(
+        big_files: list,
+        segments_report: pathlib.Path,
+        case_label: str,
+        simple_output: bool,
+        max_hash_size: int = max_hash_size_default,
+        scan_location: pathlib.Path = default_scan_location,
+        hash_names: tuple = hash_names_default,
+        segment_size: int = segment_size_default,
+        buffer_size: int = read_buffer_size_default,
+        cores: int | None = cores,
+        max_in_flight: int | None = None,
+        append: bool = False,
+        executor: str = executor_default,
+        stats: ScanStats | None = None,
+) -> Generator[dict, None, None]:
+    """
+    --tree-hash: the results (get_file_and_hash_data) of the big files held back from the main pass (see
+    hold_back_big_files) with their tree hashes (run_tree_hashes), each as soon as its tree hash is done
+    big_files is only read when the first result is asked for, so it can still be filled by the main pass until then
+    """
+    if not big_files:
+        return
+    log.info(f"Tree hashing {len(big_files)} files over {max_hash_size} bytes, "
+             f"segments of {segment_size} bytes, segments report: {segments_report}")
+    for record, record_tree_hashes in run_tree_hashes(
+            big_files,
+            segments_report,
+            hash_names=hash_names,
+            segment_size=segment_size,
+            buffer_size=buffer_size,
+            cores=cores,
+            max_in_flight=max_in_flight,
+            scan_location=scan_location,
+            append=append,
+            executor=executor,
+            stats=stats,
+    ):
+        result = get_file_and_hash_data(record, case_label, simple_output, max_hash_size, scan_location)
+        if isinstance(record_tree_hashes, Exception):
+            result["hash-error"] = f"{result['hash-error']}, {record_tree_hashes}"
+        else:
+            result["hash-error"] = (
+                f"file size, {record.size} > {max_hash_size}, tree hash of {segment_size} byte segments"
+            )
+            for hash_name, tree_hash_value in record_tree_hashes.items():
+                result[get_tree_hash_column_name(hash_name, simple_output)] = tree_hash_value
+        yield result
+
+
+def drop_uncompleted_segments(segments_report: pathlib.Path, completed: set, simple_output: bool):
+    """
+    --resume: remove the segments of the files that are not in the report (completed) from the segments report of
+    an interrupted scan, they are tree hashed again
+    """
+    path_column = "relative-path" if simple_output else "path"
+    kept = segments_report.with_name(f"{segments_report.name}.resume")
+    dropped = 0
+    with (
+        open(segments_report, "r", encoding="utf-8", newline="") as fin,
+        open(kept, "w", encoding="utf-8") as fout,
+    ):
+        csv_writer = csv.DictWriter(fout, fieldnames=_csv_segments_header_, quoting=csv.QUOTE_ALL,
+                                    lineterminator="\n")
+        csv_writer.writeheader()
+        for row in csv.DictReader(fin):
+            if row[path_column] in completed:
+                csv_writer.writerow(row)
+            else:
+                dropped += 1
+    os.replace(kept, segments_report)
+    if dropped:
+        log.info(f"Resume: dropped {dropped} segments of files not in the report: {segments_report}")
 
 
 @benchmark
@@ -486,50 +3712,245 @@ def main(
         first_n_files: int = None,
         cores: int | None = cores,
         max_hash_size: int = max_hash_size_default,
+        buffer_size: int = read_buffer_size_default,
+        hash_names: tuple = hash_names_default,
+        cache: pathlib.Path | None = None,
+        cache_max_entries: int = cache_max_entries_default,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        walk_threads: int = walk_threads_default,
+        tree_hash: bool = False,
+        segment_size: int = segment_size_default,
+        resume: bool = False,
+        executor: str = executor_default,
+        hybrid_threshold: int = hybrid_threshold_default,
+        stats: pathlib.Path | None = None,
+        report_format: str = report_format_default,
+        known_hashes: tuple = (),
+        omit_known_hashes: tuple = (),
+        device_readers: int | str | None = None,
+        small_file_size: int = small_file_size_default,
+        mmap_threshold: int = mmap_threshold_default,
+        into_archives: bool = False,
+        tree_digests: bool = False,
 ) -> pathlib.Path:
+    """
+    Hash the files at the scan location and write the csv report
+    with tree_hash the files over max_hash_size are held back from the main pass and tree hashed afterwards
+    (run_tree_hashes) with the segment digests in the segments report
+    The files written to the report are kept in a journal (ScanJournal), with resume the files in the journal of
+    an interrupted scan are skipped and the rest are added to its report. The journal is removed when the scan
+    is complete
+    With stats (a json file) the time of each stage of the scan is written to it, see ScanStats
+    With the sqlite report format the report is an sqlite database (SqliteReport), indexed when the scan is complete
+    With known_hashes (known hash list files, see KnownHashes) the known-hash column has the lists the hash of each
+    file is in, the files with a hash in one of the omit_known_hashes lists are left out of the report
+    With device_readers the reads of each disk are limited (e.g. one at a time on a spinning disk), see
+    DeviceScheduler
+    With into_archives the files in zip and tar archives are hashed as well as the archive, see expand_archives
+    With tree_digests the Merkle digest of each folder and the root digest are written to the digests file of the
+    complete csv report (get_digests_file), see write_tree_digests
+    """
+    if not pathlib.Path(scan_location).is_absolute():
+        # as get_file_list, so the relative paths (and the journal) are relative to the files it finds
+        scan_location = pathlib.Path(scan_location).resolve()
     logging.debug(f"CSV report file: {report}")
-    if report.exists():
+    journal_file = get_journal(report)
+    completed = set()
+    report_size = None
+    if resume:
+        if journal_file.exists() and report.exists():
+            completed, report_size = ScanJournal.load(journal_file)
+        if report_size is None:
+            log.warning(f"Nothing to resume (no journal: {journal_file}), starting from the beginning")
+        else:
+            log.info(f"Resuming: {len(completed)} files already in the report: {report}")
+            # drop any rows after the last checkpoint
+            if report_format == "sqlite":
+                SqliteReport.truncate(report, report_size)
+            else:
+                with open(report, "r+b") as f:
+                    f.truncate(report_size)
+            if get_segments_report(report).exists():
+                drop_uncompleted_segments(get_segments_report(report), completed, simple_output)
+    if report_size is None and report.exists():
         log.warning(f"Overwriting existing report file: {report}")
     output_file = None
 
-    if simple_output:
-        csv_head = _csv_report_header_simple_
-    else:
-        csv_head = _csv_report_header_
+    csv_head = get_csv_report_header(hash_names, simple_output, tree_hash=tree_hash, known_hashes=bool(known_hashes))
     log.debug(f"CSV output format: {csv_head} - simple output: {simple_output}")
+    path_column = "relative-path" if simple_output else "path"
+    hash_cache = None
+    scan_stats = None if stats is None else ScanStats()
+    index = None
+    known_lists = []
+    omit_lists = []
+    omitted = 0
+    index_location = None
+    complete = False
     try:
-        with open(report, "w", encoding="utf-8") as output_file:
-            csv_writer = csv.DictWriter(
-                output_file,
-                fieldnames=csv_head,
-                quoting=csv.QUOTE_ALL,
-                lineterminator="\n",
+        if known_hashes or omit_known_hashes:
+            # the indexes of any text lists, next to the report as they can be large
+            index_location = tempfile.TemporaryDirectory(dir=report.parent)
+            for hash_list in known_hashes:
+                known_lists.append(KnownHashes.load(hash_list, hash_names, pathlib.Path(index_location.name)))
+            for hash_list in omit_known_hashes:
+                omit_lists.append(KnownHashes.load(hash_list, hash_names, pathlib.Path(index_location.name)))
+            for known in known_lists + omit_lists:
+                log.info(f"Known hash list: {known.name}, {len(known)} {known.hash_name} hashes")
+        if report_format == "sqlite":
+            output = SqliteReport(report, csv_head, append=report_size is not None)
+        else:
+            output = open(report, "w" if report_size is None else "a", encoding="utf-8")
+        with (
+            output as output_file,
+            ScanJournal(journal_file, output_file, append=report_size is not None) as journal,
+        ):
+            if report_format == "sqlite":
+                csv_writer = output_file
+            else:
+                csv_writer = csv.DictWriter(
+                    output_file,
+                    fieldnames=csv_head,
+                    quoting=csv.QUOTE_ALL,
+                    lineterminator="\n",
+                    extrasaction="ignore",  # the internal (underscore) fields e.g. for the hash cache
+                )
+            if report_size is None:
+                csv_writer.writeheader()
+                journal.checkpoint()
+
+            if cache is not None:
+                # created before the workers start so their read only connections find the cache file
+                hash_cache = HashCache(cache, max_entries=cache_max_entries)
+                log.info(f"Hash cache: {cache}")
+
+            file_list = get_file_list(
+                scan_location,
+                first_n_files=first_n_files,
+                walk_threads=walk_threads,
+                file_records=True,
             )
-            csv_writer.writeheader()
+            if scan_stats is not None:
+                file_list = scan_stats.timed(file_list, "walk")
+            # before the archives are expanded and the big files held back, so neither is done again for a link
+            hard_links = HardLinks(simple_output, scan_location, completed)
+            file_list = hard_links.filter(file_list)
+            if into_archives:
+                file_list = expand_archives(file_list)
+            if completed:
+                file_list = skip_completed(file_list, completed, simple_output, scan_location)
+            big_files = []
+            if tree_hash:
+                file_list = hold_back_big_files(file_list, max_hash_size, big_files)
 
             hash_generator = run_hash_multiprocessor_yield(
-                get_file_list(
-                    scan_location,
-                    first_n_files=first_n_files,
-                ),
+                file_list,
                 case_label,
                 simple_output,
                 cores=cores,
                 max_hash_size=max_hash_size,
                 scan_location=scan_location,
+                buffer_size=buffer_size,
+                hash_names=hash_names,
+                cache=cache,
+                max_in_flight=max_in_flight,
+                batch_size=batch_size,
+                executor=executor,
+                hybrid_threshold=hybrid_threshold,
+                stats=scan_stats,
+                device_readers=device_readers,
+                small_file_size=small_file_size,
+                mmap_threshold=mmap_threshold,
+                hard_links=hard_links,
+            )
+            # the big files are tree hashed after the main pass, their rows go through the same filters, cache,
+            # stats and journal
+            tree_hash_generator = get_tree_hash_results(
+                big_files,
+                get_segments_report(report),
+                case_label,
+                simple_output,
+                max_hash_size=max_hash_size,
+                scan_location=scan_location,
+                hash_names=hash_names,
+                segment_size=segment_size,
+                buffer_size=buffer_size,
+                cores=cores,
+                max_in_flight=max_in_flight,
+                append=report_size is not None,
+                executor=executor,
+                stats=scan_stats,
             )
-            index = None
-            for index, result in enumerate(hash_generator, start=1):
+            for result in hard_links.add_links(itertools.chain(hash_generator, tree_hash_generator)):
+                if completed and result[path_column] in completed:
+                    continue  # a file of a compressed tar already in the report, see skip_completed
+                index = (index or 0) + 1
                 # log.debug(f'index: {index} - {result}')
                 # result_specifics = {key: value for key, value in result.items() if key in csv_head}
                 # print('result as dict', '- ', result_specifics)
                 # result_errors = {key: value for key, value in result.items() if key not in csv_head}
                 # pprint('result as dict', '- ', result_errors)
-                csv_writer.writerow(result)
-            log.info(f"{index} files hashed")
+                if scan_stats is not None:
+                    scan_stats.add_file(result, result[path_column])
+                    t = time.perf_counter()
+                if hash_cache is not None:
+                    hash_cache.update(result)
+                if known_lists:
+                    result["known-hash"] = ";".join(get_known_hash_matches(result, known_lists, simple_output))
+                if omit_lists and get_known_hash_matches(result, omit_lists, simple_output):
+                    omitted += 1
+                else:
+                    csv_writer.writerow(result)
+                journal.add(result[path_column])
+                if scan_stats is not None:
+                    scan_stats.add("csv", time.perf_counter() - t)
+
+            if hash_cache is not None:
+                log.info(f"{index} files hashed, hash cache hits: {hash_cache.hits}, misses: {hash_cache.misses}")
+            else:
+                log.info(f"{index} files hashed")
+            if omit_lists:
+                log.info(f"{omitted} files with a known hash left out of the report")
+            if report_format == "sqlite":
+                log.info(f"Indexing the report: {report}")
+                journal.checkpoint()
+                output_file.create_indexes()
+            complete = True
     except Exception as e:
         log.error(f"Exception: {e} - report file: {report}")
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+        for known in known_lists + omit_lists:
+            known.close()
+        if index_location is not None:
+            index_location.cleanup()
+        if scan_stats is not None:
+            scan_stats.write(
+                stats,
+                files=index or 0,
+                version=__version__,
+                scan_location=scan_location,
+                report=report,
+                cores=cores,
+                executor=executor,
+                complete=complete,
+            )
+            log.info(f"Stats: {stats}")
 
+    if complete:
+        journal_file.unlink(missing_ok=True)
+    else:
+        log.warning(f"Scan not complete, it can be resumed with --resume (journal: {journal_file})")
+    if complete and tree_digests:
+        if report_format != "csv":
+            log.warning(f"Directory digests are made from a csv report, not: {report_format}")
+        else:
+            try:
+                write_tree_digests(report, get_digests_file(report), hash_names[0], simple_output, scan_location)
+            except (OSError, ValueError) as e:
+                log.error(f"Directory digests not written: {e}")
     return report
 
 
@@ -542,6 +3963,32 @@ if __name__ == "__main__":
         print(f"Application: {app_name}, Version: {__version__}")
         sys.exit(0)
 
+    if args.command == "compare":
+        if args.chunk_rows < 1:
+            logging.critical(f"Chunk rows must be at least 1, not: {args.chunk_rows}")
+            sys.exit(1)
+        diff_report = diff_report_default if args.report is None else args.report
+        try:
+            if is_digests_file(args.old_report) and is_digests_file(args.new_report):
+                compare_tree_digests(args.old_report, args.new_report, diff_report)
+            else:
+                compare_reports(args.old_report, args.new_report, diff_report, chunk_rows=args.chunk_rows)
+        except (OSError, ValueError) as e:
+            logging.critical(f"Reports not compared: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.build_known_index is not None:
+        if len(args.known_hashes) != 1:
+            logging.critical(f"--build-known-index needs one --known-hashes list, not: {len(args.known_hashes)}")
+            sys.exit(1)
+        try:
+            build_known_hash_index(args.known_hashes[0], args.build_known_index, parse_hash_names(args.hash_names))
+        except (OSError, ValueError) as e:
+            logging.critical(f"Known hash index not built: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
     if args.scan is None:
         logging.critical(
             f"Scan location not provided, please provide a directory or file to scan for files to hash."
@@ -577,6 +4024,93 @@ if __name__ == "__main__":
     else:
         max_hash_size = args.max_hash_size
         log.warning(f"Maximum file size to hash is:  {max_hash_size} bytes")
+
+    if args.buffer_size < 1:
+        logging.critical(f"Read buffer size must be at least 1 byte, not: {args.buffer_size}")
+        sys.exit(1)
+    buffer_size = args.buffer_size
+    log.info(f"Read buffer size: {buffer_size} bytes")
+
+    try:
+        hash_names = parse_hash_names(args.hash_names)
+    except ValueError as ve:
+        logging.critical(f"Invalid --hash: {ve}")
+        sys.exit(1)
+    log.info(f"Hash(es): {','.join(hash_names)}")
+
+    if args.max_in_flight is not None and args.max_in_flight < 1:
+        logging.critical(f"Maximum tasks in flight must be at least 1, not: {args.max_in_flight}")
+        sys.exit(1)
+
+    log.info(f"Executor: {args.executor}")
+    if args.executor == "hybrid":
+        log.info(f"Files of {args.hybrid_threshold} bytes or more hashed in threads")
+
+    device_readers = args.device_readers
+    if device_readers is not None and device_readers != "auto":
+        if not device_readers.isdigit() or int(device_readers) < 1:
+            logging.critical(f"Device readers must be auto or at least 1, not: {device_readers}")
+            sys.exit(1)
+        device_readers = int(device_readers)
+    if device_readers is not None:
+        log.info(f"Device readers: {device_readers}")
+
+    if args.small_file_size < 0:
+        logging.critical(f"Small file size must be at least 0 bytes, not: {args.small_file_size}")
+        sys.exit(1)
+    if args.small_file_size:
+        log.info(f"Files of less than {args.small_file_size} bytes hashed in the main process")
+
+    if args.mmap_threshold < 0:
+        logging.critical(f"Mmap threshold must be at least 0 bytes, not: {args.mmap_threshold}")
+        sys.exit(1)
+    if args.mmap_threshold:
+        # SIGBUS (a file truncated while it is mapped) kills the process that reads the mapping: a worker is lost,
+        # the main process (threads or the small files hashed inline) is the whole scan
+        if args.executor != "process":
+            logging.critical(f"--mmap-threshold needs the process executor, not: {args.executor}")
+            sys.exit(1)
+        if args.small_file_size > args.mmap_threshold:
+            logging.critical(f"--mmap-threshold must be at least --small-file-size ({args.small_file_size}) so "
+                             f"the files hashed in the main process are not mapped, not: {args.mmap_threshold}")
+            sys.exit(1)
+        log.info(f"Files of {args.mmap_threshold} bytes or more hashed through mmap")
+
+    if args.tree_digests and args.report_format != "csv":
+        logging.critical(f"--tree-digests needs a csv report, not: {args.report_format}")
+        sys.exit(1)
+
+    if args.max_bytes_per_second < 0 or args.max_iops < 0:
+        logging.critical(f"Max bytes per second and max iops must be at least 0, not: "
+                         f"{args.max_bytes_per_second}, {args.max_iops}")
+        sys.exit(1)
+    rate_limiter = None
+    if args.max_bytes_per_second or args.max_iops:
+        rate_limiter = RateLimiter(args.max_bytes_per_second, args.max_iops)
+        log.info(f"Reads limited to {args.max_bytes_per_second or 'any'} bytes and "
+                 f"{args.max_iops or 'any'} reads per second")
+    if args.polite:
+        log.info("Polite: files dropped from the page cache after they are hashed")
+    set_io_limits(IOLimits(args.polite, rate_limiter))
+
+    if args.walk_threads < 1:
+        logging.critical(f"Walk threads must be at least 1, not: {args.walk_threads}")
+        sys.exit(1)
+
+    if args.batch_size is not None and args.batch_size < 1:
+        logging.critical(f"Batch size must be at least 1, not: {args.batch_size}")
+        sys.exit(1)
+
+    if args.cache is not None:
+        log.info(f"Hash cache: {args.cache}, maximum rows: {args.cache_max_entries}")
+
+    if args.segment_size < 1:
+        logging.critical(f"Segment size must be at least 1 byte, not: {args.segment_size}")
+        sys.exit(1)
+
+    if args.partial_hash_size < 1:
+        logging.critical(f"Partial hash size must be at least 1 byte, not: {args.partial_hash_size}")
+        sys.exit(1)
     # # works (single core)
     # run_hash(get_file_list(scan_location, first_n_files=first_n_files), case_label_default)
 
@@ -584,19 +4118,91 @@ if __name__ == "__main__":
     # works with error catching
     # run_hash_multiprocessor(get_file_list(scan_location, first_n_files=first_n_files), cores=cores)
 
-    report_file = main(
-        args.scan,
-        report,
-        case_label,
-        simple_output=simple,
-        first_n_files=first_n_files,
-        cores=cores,
-        max_hash_size=max_hash_size,
-    )
+    exit_code = 0
+    if args.verify is not None:
+        report_file = verify_report_default if args.report is None else args.report
+        try:
+            counts = verify_report(
+                args.verify,
+                args.scan,
+                report_file,
+                cores=cores,
+                buffer_size=buffer_size,
+                max_in_flight=args.max_in_flight,
+                batch_size=args.batch_size,
+                executor=args.executor,
+                hybrid_threshold=args.hybrid_threshold,
+                mmap_threshold=args.mmap_threshold,
+            )
+        except (OSError, ValueError) as e:
+            logging.critical(f"Report not verified: {e}")
+            sys.exit(1)
+        if any(count for status, count in counts.items() if status not in ("ok", "not hashed")):
+            log.warning(f"Verify failed, see: {report_file}")
+            exit_code = 2
+    elif args.duplicates:
+        log.info(f"Finding duplicate files, partial hash size: {args.partial_hash_size} bytes")
+        if args.stats is not None:
+            log.warning(f"--stats is not written with --duplicates: {args.stats}")
+        if args.report_format != report_format_default:
+            log.warning(f"The duplicates report is always csv, not: {args.report_format}")
+        report_file = find_duplicates(
+            args.scan,
+            report,
+            case_label,
+            simple_output=simple,
+            first_n_files=first_n_files,
+            cores=cores,
+            max_hash_size=max_hash_size,
+            buffer_size=buffer_size,
+            hash_names=hash_names,
+            cache=args.cache,
+            cache_max_entries=args.cache_max_entries,
+            max_in_flight=args.max_in_flight,
+            batch_size=args.batch_size,
+            walk_threads=args.walk_threads,
+            partial_hash_size=args.partial_hash_size,
+            executor=args.executor,
+            hybrid_threshold=args.hybrid_threshold,
+            device_readers=device_readers,
+            small_file_size=args.small_file_size,
+            mmap_threshold=args.mmap_threshold,
+        )
+    else:
+        report_file = main(
+            args.scan,
+            report,
+            case_label,
+            simple_output=simple,
+            first_n_files=first_n_files,
+            cores=cores,
+            max_hash_size=max_hash_size,
+            buffer_size=buffer_size,
+            hash_names=hash_names,
+            cache=args.cache,
+            cache_max_entries=args.cache_max_entries,
+            max_in_flight=args.max_in_flight,
+            batch_size=args.batch_size,
+            walk_threads=args.walk_threads,
+            tree_hash=args.tree_hash,
+            segment_size=args.segment_size,
+            resume=args.resume,
+            executor=args.executor,
+            hybrid_threshold=args.hybrid_threshold,
+            stats=args.stats,
+            report_format=args.report_format,
+            known_hashes=tuple(args.known_hashes),
+            omit_known_hashes=tuple(args.omit_known_hashes),
+            device_readers=device_readers,
+            small_file_size=args.small_file_size,
+            mmap_threshold=args.mmap_threshold,
+            into_archives=args.into_archives,
+            tree_digests=args.tree_digests,
+        )
     log.info(f"Output report: {report_file}")
     logging.info(
         "Programme stop: {0}, running time: {1}".format(
             datetime.now(), datetime.now() - programme_start
         )
     )
-    sys.exit(0)
+    sys.exit(exit_code)
@@ -0,0 +1,57 @@
+"""
+Benchmark files/s through the process pool for a number of batch sizes, on a tree of tiny files where the cost of
+sending each file to a worker (and the result back) is more than the cost of the hash
+
+Run from the repository root:
+    python -m benchmarks.benchmark_batch_size
+    python -m benchmarks.benchmark_batch_size --files 100000 --cores 4
+"""
+import argparse
+import logging
+import pathlib
+import tempfile
+import time
+
+from app.hash_file import cores as cores_default, get_file_list, run_hash_multiprocessor_yield
+
+batch_sizes = [1, 8, 64, 512, None]  # None is adaptive
+
+
+def make_tiny_files(location: pathlib.Path, files: int, per_folder: int = 1000):
+    for i in range(files):
+        folder = location / f"{i // per_folder:05d}"
+        if i % per_folder == 0:
+            folder.mkdir()
+        (folder / f"{i}.txt").write_bytes(f"tiny file {i}\n".encode())
+
+
+def run(location: pathlib.Path, files: int, cores: int):
+    make_tiny_files(location, files)
+    print(f"{files} tiny files, {cores} cores")
+    print(f"{'batch size':<12}{'seconds':>10}{'files/s':>12}")
+    for batch_size in batch_sizes:
+        t = time.perf_counter()
+        count = 0
+        for _ in run_hash_multiprocessor_yield(
+                get_file_list(location),
+                "benchmark",
+                True,
+                cores=cores,
+                scan_location=location,
+                batch_size=batch_size,
+        ):
+            count += 1
+        seconds = time.perf_counter() - t
+        assert count == files
+        print(f"{batch_size or 'adaptive':<12}{seconds:>10.3f}{count / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark files/s for a number of batch sizes")
+    parser.add_argument("--files", dest="files", type=int, default=20000, help="number of tiny files")
+    parser.add_argument("--cores", dest="cores", type=int, default=cores_default, help="worker processes")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run(pathlib.Path(tmp), args.files, args.cores)
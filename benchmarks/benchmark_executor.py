@@ -0,0 +1,91 @@
+"""
+Benchmark the process, thread and hybrid executors on a number of file size mixes, to show which executor wins
+for which mix
+
+Run from the repository root:
+    python -m benchmarks.benchmark_executor
+    python -m benchmarks.benchmark_executor --cores 4 --scale 4
+
+The files are written just before they are hashed so they are likely to be in the page cache
+"""
+import argparse
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+from app.hash_file import (
+    A_KB,
+    A_MB,
+    cores as cores_default,
+    executor_types,
+    get_file_list,
+    run_hash_multiprocessor_yield,
+)
+
+# name: list of (number of files, size of each file)
+file_mixes = {
+    "tiny": [(5000, 4 * A_KB)],
+    "medium": [(200, A_MB)],
+    "large": [(4, 64 * A_MB)],
+    "mixed": [(5000, 4 * A_KB), (200, A_MB), (4, 64 * A_MB)],
+}
+
+
+def make_files(location: pathlib.Path, mix: list, scale: int) -> tuple:
+    """write the files of a mix, return (files, bytes)"""
+    block = os.urandom(A_MB)
+    files = 0
+    total = 0
+    for count, size in mix:
+        folder = location / f"{size}"
+        folder.mkdir()
+        for i in range(count * scale):
+            with open(folder / f"{i}.bin", "wb") as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(block[:remaining])
+                    remaining -= len(block)
+            files += 1
+            total += size
+    return files, total
+
+
+def run(location: pathlib.Path, cores: int, scale: int):
+    print(f"{cores} cores")
+    print(f"{'mix':<8}{'files':>8}{'MB':>8}  {'executor':<10}{'seconds':>10}{'files/s':>10}{'MB/s':>10}")
+    for name, mix in file_mixes.items():
+        mix_location = location / name
+        mix_location.mkdir()
+        files, total = make_files(mix_location, mix, scale)
+        timings = {}
+        for executor in executor_types:
+            t = time.perf_counter()
+            count = 0
+            for _ in run_hash_multiprocessor_yield(
+                    get_file_list(mix_location, file_records=True),
+                    "benchmark",
+                    True,
+                    cores=cores,
+                    scan_location=mix_location,
+                    executor=executor,
+            ):
+                count += 1
+            seconds = time.perf_counter() - t
+            assert count == files
+            timings[executor] = seconds
+            print(f"{name:<8}{files:>8}{total / A_MB:>8.0f}  {executor:<10}{seconds:>10.3f}"
+                  f"{files / seconds:>10.0f}{total / A_MB / seconds:>10.1f}")
+        print(f"{name:<8} fastest: {min(timings, key=timings.get)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the process, thread and hybrid executors")
+    parser.add_argument("--cores", dest="cores", type=int, default=cores_default, help="workers")
+    parser.add_argument("--scale", dest="scale", type=int, default=1, help="multiply the number of files by this")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run(pathlib.Path(tmp), args.cores, args.scale)
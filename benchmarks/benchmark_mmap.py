@@ -0,0 +1,80 @@
+"""
+Benchmark the mmap engine (mmap_into_hashes) against the buffered read engine (read_into_hashes): wall time, CPU
+time and peak RSS to hash medium and large files, each case in a new process so its peak RSS is its own
+
+Run from the repository root (on linux or macOS, it uses the resource module):
+    python -m benchmarks.benchmark_mmap
+    python -m benchmarks.benchmark_mmap --large-gb 2 --hash sha1 --hash md5
+
+The files are written just before they are hashed so they are likely to be in the page cache, this measures the
+cost of getting the data to the hash rather than the disk. The mapped pages of the page cache count in the RSS of
+the mmap engine, up to a window (mmap_window_size_default) at a time
+"""
+import argparse
+import multiprocessing
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+
+from app.hash_file import A_GB, A_KB, A_MB, get_hashes, read_buffer_size_default
+from benchmarks.benchmark_read_engine import write_file
+
+# name: mmap_threshold, 0 is the buffered read engine
+engines = {"readinto": 0, "mmap": 1}
+
+
+def hash_files(files: list, hash_names: tuple, mmap_threshold: int) -> tuple:
+    """in a new process: hash the files, return (wall seconds, CPU seconds, peak RSS in bytes)"""
+    t = time.perf_counter()
+    for file in files:
+        get_hashes(file, hash_names, read_buffer_size_default, mmap_threshold=mmap_threshold)
+    seconds = time.perf_counter() - t
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is kB on linux, bytes on macOS
+    return seconds, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * (1 if sys.platform == "darwin" else A_KB)
+
+
+def run(location: pathlib.Path, large_gb: int, hash_names: tuple):
+    cases = [
+        ("medium", 8 * A_MB, 32),
+        ("large", 256 * A_MB, 2),
+    ]
+    if large_gb:
+        cases.append(("huge", large_gb * A_GB, 1))
+
+    print(f"hashes: {','.join(hash_names)}")
+    print(f"{'files':<8}{'size':>12}{'count':>7}  {'engine':<10}{'seconds':>10}{'MB/s':>9}{'CPU s':>9}"
+          f"{'peak RSS MB':>13}")
+    context = multiprocessing.get_context("spawn")
+    for name, size, count in cases:
+        files = [location / f"{name}-{i}.bin" for i in range(count)]
+        for file in files:
+            write_file(file, size)
+        total_mb = size * count / A_MB
+        for engine, mmap_threshold in engines.items():
+            with context.Pool(1) as pool:
+                seconds, cpu_seconds, peak_rss = pool.apply(hash_files, (files, hash_names, mmap_threshold))
+            print(f"{name:<8}{size:>12}{count:>7}  {engine:<10}{seconds:>10.3f}{total_mb / seconds:>9.0f}"
+                  f"{cpu_seconds:>9.3f}{peak_rss / A_MB:>13.1f}")
+        for file in files:
+            file.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the mmap engine against the buffered read engine")
+    parser.add_argument("--large-gb", dest="large_gb", type=int, default=0,
+                        help="also benchmark a file of this many GB (needs the free disk space)")
+    parser.add_argument("--hash", dest="hash_names", action="append",
+                        help="hash to calculate, repeat for more than one, default is sha1")
+    parser.add_argument("--location", dest="location", type=pathlib.Path, default=None,
+                        help="directory to write the benchmark files to, default is a temporary directory")
+    args = parser.parse_args()
+    hash_names = tuple(args.hash_names or ["sha1"])
+
+    if args.location is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(pathlib.Path(tmp), args.large_gb, hash_names)
+    else:
+        run(args.location, args.large_gb, hash_names)
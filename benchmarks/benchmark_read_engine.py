@@ -0,0 +1,94 @@
+"""
+Benchmark the read engine behind the hash against the old per block (64 byte) reads
+
+Run from the repository root:
+    python -m benchmarks.benchmark_read_engine
+    python -m benchmarks.benchmark_read_engine --large-gb 2   # also time a multi-GB file
+
+The files are written just before they are read so they are likely to be in the page cache, this
+measures the cost of the read loop and the hash rather than the disk
+"""
+import argparse
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+from functools import partial
+
+from app.hash_file import A_KB, A_MB, A_GB, get_sha1_hash
+
+buffer_sizes = [64 * A_KB, A_MB, 8 * A_MB]
+
+
+def legacy_sha1_hash(file: pathlib.Path) -> str:
+    """the hash loop as it was before the read engine, reading hashlib.sha1().block_size bytes at a time"""
+    with open(file, mode="rb") as f:
+        hash = hashlib.sha1()
+        for buffer in iter(partial(f.read, hashlib.sha1().block_size), b""):
+            hash.update(buffer)
+    return hash.hexdigest()
+
+
+def write_file(file: pathlib.Path, size: int):
+    """write size bytes of random-ish data, one MB block repeated"""
+    block = os.urandom(min(size, A_MB))
+    with open(file, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def time_files(hash_func, files: list[pathlib.Path]) -> float:
+    t = time.perf_counter()
+    for file in files:
+        hash_func(file)
+    return time.perf_counter() - t
+
+
+def run(location: pathlib.Path, large_gb: int, skip_legacy_large: bool):
+    cases = [
+        ("small", 64 * A_KB, 500),
+        ("medium", 64 * A_MB, 4),
+    ]
+    if large_gb:
+        cases.append(("large", large_gb * A_GB, 1))
+
+    print(f"{'files':<8}{'size':>14}{'count':>7}  {'engine':<22}{'seconds':>10}{'MB/s':>10}")
+    for name, size, count in cases:
+        files = [location / f"{name}-{i}.bin" for i in range(count)]
+        for file in files:
+            write_file(file, size)
+        total_mb = size * count / A_MB
+
+        engines = [("legacy 64 byte reads", legacy_sha1_hash)]
+        if name == "large" and skip_legacy_large:
+            engines = []
+        engines += [
+            (f"readinto {buffer_size // A_KB} kB", partial(get_sha1_hash, buffer_size=buffer_size))
+            for buffer_size in buffer_sizes
+        ]
+        for engine_name, hash_func in engines:
+            seconds = time_files(hash_func, files)
+            print(f"{name:<8}{size:>14}{count:>7}  {engine_name:<22}{seconds:>10.3f}{total_mb / seconds:>10.1f}")
+
+        for file in files:
+            file.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the hash read engine")
+    parser.add_argument("--large-gb", dest="large_gb", type=int, default=0,
+                        help="also benchmark a file of this many GB (needs the free disk space)")
+    parser.add_argument("--skip-legacy-large", dest="skip_legacy_large", action="store_true",
+                        help="do not time the legacy 64 byte reads on the large file, it is slow")
+    parser.add_argument("--location", dest="location", type=pathlib.Path, default=None,
+                        help="directory to write the benchmark files to, default is a temporary directory")
+    args = parser.parse_args()
+
+    if args.location is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(pathlib.Path(tmp), args.large_gb, args.skip_legacy_large)
+    else:
+        run(args.location, args.large_gb, args.skip_legacy_large)
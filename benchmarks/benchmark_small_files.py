@@ -0,0 +1,70 @@
+"""
+Benchmark --small-file-size: files/s on the tiny tree (see tree_generator) with every file sent to the workers
+(before, a small file size of 0) and with the files of less than each small file size hashed in the main process
+(after)
+
+Run from the repository root:
+    python -m benchmarks.benchmark_small_files
+    python -m benchmarks.benchmark_small_files --cores 4 --scale 4 --small-file-size 1025 --small-file-size 4097
+"""
+import argparse
+import logging
+import pathlib
+import tempfile
+import time
+
+from app.hash_file import (
+    A_KB,
+    cores as cores_default,
+    executor_types,
+    get_file_list,
+    run_hash_multiprocessor_yield,
+)
+from benchmarks.tree_generator import make_tree, seed_default
+
+small_file_sizes_default = [4 * A_KB + 1]  # all the files of the tiny tree
+
+
+def run(location: pathlib.Path, cores: int, scale: int, seed: int, small_file_sizes: list, executors: list):
+    files, total = make_tree(location, "tiny", scale, seed)
+    print(f"tiny tree: {files} files, {cores} cores")
+    print(f"{'executor':<10}{'small file size':>16}{'seconds':>10}{'files/s':>10}{'speedup':>9}")
+    for executor in executors:
+        before = None
+        for small_file_size in [0] + small_file_sizes:
+            t = time.perf_counter()
+            count = 0
+            for _ in run_hash_multiprocessor_yield(
+                    get_file_list(location, file_records=True),
+                    "benchmark",
+                    True,
+                    cores=cores,
+                    scan_location=location,
+                    executor=executor,
+                    small_file_size=small_file_size,
+            ):
+                count += 1
+            seconds = time.perf_counter() - t
+            assert count == files
+            if before is None:
+                before = seconds
+            print(f"{executor:<10}{small_file_size:>16}{seconds:>10.3f}{files / seconds:>10.0f}"
+                  f"{before / seconds:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark hashing small files in the main process")
+    parser.add_argument("--cores", dest="cores", type=int, default=cores_default, help="workers")
+    parser.add_argument("--scale", dest="scale", type=int, default=1, help="multiply the number of files by this")
+    parser.add_argument("--seed", dest="seed", type=int, default=seed_default, help="random seed of the contents")
+    parser.add_argument("--small-file-size", dest="small_file_sizes", type=int, action="append",
+                        help=f"small file size to compare with 0, repeat for more than one, "
+                             f"default is {small_file_sizes_default}")
+    parser.add_argument("--executor", dest="executors", action="append", choices=executor_types,
+                        help="executor, repeat for more than one, default is all")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run(pathlib.Path(tmp), args.cores, args.scale, args.seed, args.small_file_sizes or small_file_sizes_default,
+            args.executors or list(executor_types))
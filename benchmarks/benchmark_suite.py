@@ -0,0 +1,172 @@
+"""
+Benchmark main() and the single core run_hash on synthetic file trees (see tree_generator): files/s and MB/s for
+each tree, number of cores and output format, saved as json so a version can be compared with an earlier one
+
+Run from the repository root:
+    python -m benchmarks.benchmark_suite --output results-1.1.2.json
+    python -m benchmarks.benchmark_suite --cores 1 --cores 4 --tree tiny --tree huge --repeat 3
+    python -m benchmarks.benchmark_suite --output new.json --compare old.json
+
+The trees are made in a temporary directory unless --trees is given, trees already in --trees are used as they
+are, so making them is not part of the timings and the same trees can be used for the runs being compared
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import platform
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import cpu_count
+
+from app.hash_file import A_MB, __version__, cores as cores_default, get_file_list, main, run_hash
+from benchmarks.tree_generator import make_tree, seed_default, trees
+
+output_formats = {"simple": True, "default": False}  # name: simple_output
+tolerance_default: float = 0.1  # compare: report a case as slower when its files/s drops by more than this
+
+
+def get_tree(location: pathlib.Path, tree: str, scale: int, seed: int) -> tuple:
+    """the tree in location, made if it is not there already, return (files, bytes)"""
+    info_file = location.with_name(f"{location.name}.json")
+    info = {"scale": scale, "seed": seed}
+    if info_file.exists():
+        made = json.loads(info_file.read_text())
+        if {key: made[key] for key in info} == info:
+            return made["files"], made["bytes"]
+        raise ValueError(f"{location} was made with {made}, not {info}: use another --trees location")
+    files, total = make_tree(location, tree, scale, seed)
+    info_file.write_text(json.dumps(info | {"files": files, "bytes": total}))
+    return files, total
+
+
+def time_best(func, repeat: int) -> float:
+    """fewest seconds of repeat runs of func, the least disturbed by anything else on the computer"""
+    seconds = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - t)
+    return min(seconds)
+
+
+def get_result(tree: str, function: str, cores: int, output: str, seconds: float, files: int, total: int) -> dict:
+    return {
+        "tree": tree,
+        "function": function,
+        "cores": cores,
+        "output": output,
+        "seconds": round(seconds, 4),
+        "files": files,
+        "bytes": total,
+        "files/s": round(files / seconds, 1),
+        "MB/s": round(total / A_MB / seconds, 1),
+    }
+
+
+def get_case(result: dict) -> tuple:
+    """what identifies a result, to match it with the same case in another run"""
+    return result["tree"], result["function"], result["cores"], result["output"]
+
+
+def run(trees_location: pathlib.Path, tree_names: list, cores_list: list, scale: int, seed: int, repeat: int) -> list:
+    results = []
+    print(f"{'tree':<8}{'function':<10}{'cores':>6}  {'output':<9}{'files':>9}{'MB':>9}"
+          f"{'seconds':>10}{'files/s':>10}{'MB/s':>9}")
+    with tempfile.TemporaryDirectory() as reports:
+        for tree in tree_names:
+            location = trees_location / tree
+            files, total = get_tree(location, tree, scale, seed)
+            cases = [
+                ("main", cores, output)
+                for cores in cores_list
+                for output in output_formats
+            ]
+            cases.append(("run_hash", 1, "default"))
+            for function, cores, output in cases:
+                if function == "main":
+                    report = pathlib.Path(reports) / f"{tree}-{cores}-{output}.csv"
+
+                    def func():
+                        main(location, report, "benchmark", simple_output=output_formats[output], cores=cores)
+                else:
+                    def func():
+                        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                            run_hash(get_file_list(location), "benchmark")
+
+                seconds = time_best(func, repeat)
+                result = get_result(tree, function, cores, output, seconds, files, total)
+                results.append(result)
+                print(f"{tree:<8}{function:<10}{cores:>6}  {output:<9}{files:>9}{total / A_MB:>9.0f}"
+                      f"{seconds:>10.3f}{result['files/s']:>10.0f}{result['MB/s']:>9.1f}")
+    return results
+
+
+def compare(results: list, previous: dict, tolerance: float = tolerance_default) -> int:
+    """print files/s against the previous run for the cases in both, return the number of cases that are slower"""
+    previous_results = {get_case(result): result for result in previous["results"]}
+    print(f"compared with version {previous['version']} of {previous['date']}")
+    print(f"{'tree':<8}{'function':<10}{'cores':>6}  {'output':<9}{'was files/s':>12}{'files/s':>10}{'change':>9}")
+    slower = 0
+    for result in results:
+        was = previous_results.get(get_case(result))
+        if was is None:
+            continue
+        change = result["files/s"] / was["files/s"] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  slower"
+            slower += 1
+        print(f"{result['tree']:<8}{result['function']:<10}{result['cores']:>6}  {result['output']:<9}"
+              f"{was['files/s']:>12.0f}{result['files/s']:>10.0f}{change:>9.1%}{flag}")
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark main() and run_hash on synthetic file trees")
+    parser.add_argument("--tree", dest="trees", action="append", choices=list(trees),
+                        help="tree to benchmark, repeat for more than one, default is all")
+    parser.add_argument("--cores", dest="cores", type=int, action="append",
+                        help=f"cores for main(), repeat for more than one, default is 1 and {cores_default}")
+    parser.add_argument("--scale", dest="scale", type=int, default=1, help="multiply the size of the trees by this")
+    parser.add_argument("--seed", dest="seed", type=int, default=seed_default, help="random seed of the contents")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1, help="runs of each case, the fastest is kept")
+    parser.add_argument("--trees", dest="trees_location", type=pathlib.Path, default=None,
+                        help="directory to make the trees in (or use the trees already there), default is a "
+                             "temporary directory")
+    parser.add_argument("--output", dest="output", type=pathlib.Path, default=None, help="json file of the results")
+    parser.add_argument("--compare", dest="compare", type=pathlib.Path, default=None,
+                        help="json file of an earlier run to compare the results with")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=tolerance_default,
+                        help="compare: a drop in files/s of more than this fraction is reported as slower")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tree_names = args.trees or list(trees)
+    cores_list = args.cores or sorted({1, cores_default})
+    if args.trees_location is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run(pathlib.Path(tmp), tree_names, cores_list, args.scale, args.seed, args.repeat)
+    else:
+        results = run(args.trees_location, tree_names, cores_list, args.scale, args.seed, args.repeat)
+
+    run_info = {
+        "version": __version__,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": cpu_count(),
+        "scale": args.scale,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(run_info, indent=2))
+        print(f"results: {args.output}")
+    if args.compare is not None:
+        if compare(results, json.loads(args.compare.read_text()), args.tolerance):
+            raise SystemExit(1)
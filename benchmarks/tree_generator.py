@@ -0,0 +1,108 @@
+"""
+Make synthetic file trees to benchmark against, the same tree for the same arguments on any computer (the file
+contents are from a seeded random number generator)
+
+Run from the repository root:
+    python -m benchmarks.tree_generator /tmp/trees
+    python -m benchmarks.tree_generator /tmp/trees --tree tiny --scale 10
+"""
+import argparse
+import pathlib
+import random
+
+from app.hash_file import A_KB, A_MB
+
+seed_default: int = 1
+
+
+def write_file(file: pathlib.Path, size: int, rng: random.Random, block_size: int = A_MB):
+    """write size bytes, a block of random bytes repeated"""
+    block = rng.randbytes(min(size, block_size))
+    with open(file, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def make_tiny_files(location: pathlib.Path, scale: int, rng: random.Random, per_folder: int = 1000) -> tuple:
+    """many tiny files (0 to 4 kB), per_folder to a folder, the cost is per file not per byte"""
+    files = 10_000 * scale
+    total = 0
+    for i in range(files):
+        folder = location / f"{i // per_folder:05d}"
+        if i % per_folder == 0:
+            folder.mkdir()
+        size = rng.randrange(4 * A_KB + 1)
+        write_file(folder / f"{i}.txt", size, rng)
+        total += size
+    return files, total
+
+
+def make_deep_tree(location: pathlib.Path, scale: int, rng: random.Random, depth: int = 40) -> tuple:
+    """branches of nested folders depth deep, a small file in each folder, the cost is in the folder walk"""
+    files = 0
+    total = 0
+    for branch in range(20 * scale):
+        folder = location / f"branch-{branch:03d}"
+        for level in range(depth):
+            folder = folder / f"level-{level:02d}"
+            folder.mkdir(parents=True)
+            size = rng.randrange(A_KB, 16 * A_KB)
+            write_file(folder / "file.bin", size, rng)
+            files += 1
+            total += size
+    return files, total
+
+
+def make_huge_files(location: pathlib.Path, scale: int, rng: random.Random) -> tuple:
+    """a few huge files, the cost is in the read and the hash"""
+    files = 2
+    size = 256 * A_MB * scale
+    for i in range(files):
+        write_file(location / f"huge-{i}.bin", size, rng)
+    return files, files * size
+
+
+def make_sparse_files(location: pathlib.Path, scale: int, rng: random.Random) -> tuple:
+    """
+    large sparse files: a little data at the start and the end and a hole in between, which takes next to no disk
+    but is read (as zeros) and hashed in full
+    """
+    files = 4
+    size = 256 * A_MB * scale
+    for i in range(files):
+        with open(location / f"sparse-{i}.bin", "wb") as f:
+            f.write(rng.randbytes(A_KB))
+            f.seek(size - A_KB)
+            f.write(rng.randbytes(A_KB))
+    return files, files * size
+
+
+# name: function(location, scale, rng) -> (files, bytes)
+trees = {
+    "tiny": make_tiny_files,
+    "deep": make_deep_tree,
+    "huge": make_huge_files,
+    "sparse": make_sparse_files,
+}
+
+
+def make_tree(location: pathlib.Path, tree: str, scale: int = 1, seed: int = seed_default) -> tuple:
+    """make the named tree (see trees) in location (made if it does not exist), return (files, bytes)"""
+    location.mkdir(parents=True, exist_ok=True)
+    return trees[tree](location, scale, random.Random(f"{seed}-{tree}"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="make synthetic file trees to benchmark against")
+    parser.add_argument("location", type=pathlib.Path, help="directory to make the trees in, one folder per tree")
+    parser.add_argument("--tree", dest="trees", action="append", choices=list(trees),
+                        help="tree to make, repeat for more than one, default is all")
+    parser.add_argument("--scale", dest="scale", type=int, default=1, help="multiply the size of the trees by this")
+    parser.add_argument("--seed", dest="seed", type=int, default=seed_default, help="random seed of the contents")
+    args = parser.parse_args()
+
+    for name in args.trees or trees:
+        files, total = make_tree(args.location / name, name, args.scale, args.seed)
+        print(f"{name:<8}{files:>10} files{total / A_MB:>12.1f} MB  {args.location / name}")
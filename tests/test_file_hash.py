@@ -1,10 +1,24 @@
 import csv
+import hashlib
+import json
+import logging
+import mmap
+import os
 import pathlib
+import pickle
+import shutil
+import threading
+import time
+import sqlite3
+import tarfile
+import zipfile
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from typing import List
 
 import pytest
 
+import app.hash_file
 from app.hash_file import (
     get_file_list,
     get_file_size,
@@ -14,11 +28,48 @@ from app.hash_file import (
     get_date,
     get_time,
     get_sha1_hash,
+    read_into_hashes,
+    mmap_into_hashes,
+    IOLimits,
+    RateLimiter,
+    set_io_limits,
     main,
     A_KB,
     _csv_report_header_simple_,
     _csv_report_header_,
     get_relative_path,
+    get_csv_report_header,
+    get_hashes,
+    parse_hash_names,
+    HashCache,
+    lookup_hash_cache,
+    run_hash_multiprocessor_yield,
+    BatchSizer,
+    get_batches,
+    walk_files,
+    FileRecord,
+    get_file_and_hash_data,
+    find_duplicates,
+    get_csv_duplicates_header,
+    get_tree_hash,
+    get_journal,
+    get_segments_report,
+    stats_field,
+    get_hash_column_name,
+    hash_names_default,
+    build_known_hash_index,
+    KnownHashes,
+    compare_reports,
+    compare_tree_digests,
+    get_digests_file,
+    write_tree_digests,
+    get_csv_diff_header,
+    verify_report,
+    get_csv_verify_header,
+    run_batches_multiprocessor_yield,
+    DeviceScheduler,
+    InlineExecutor,
+    get_device_readers,
 )
 
 test_files_root = pathlib.Path().cwd().parent.parent / f"test-files/001"
@@ -191,6 +242,993 @@ def test_simple_sha1_hash_file(tmpdir):
     )  # confirmed with 7zip
 
 
+@pytest.mark.parametrize("buffer_size", [1, 7, 64, A_KB, A_KB * 64])
+def test_get_sha1_hash_buffer_size(tmp_path, buffer_size):
+    content = bytes(range(256)) * 41  # 10496 bytes, not a multiple of most of the buffer sizes
+    p = tmp_path / "buffer.bin"
+    p.write_bytes(content)
+    assert get_sha1_hash(p, buffer_size=buffer_size) == hashlib.sha1(content).hexdigest()
+
+
+def test_read_into_hashes(tmp_path):
+    content = b"conticontinet big snake" * 1000
+    p = tmp_path / "hello.txt"
+    p.write_bytes(content)
+    hashes = [hashlib.sha1(), hashlib.md5()]
+    with open(p, "rb", buffering=0) as f:
+        assert read_into_hashes(f, hashes, buffer_size=A_KB) == len(content)
+    assert hashes[0].hexdigest() == hashlib.sha1(content).hexdigest()
+    assert hashes[1].hexdigest() == hashlib.md5(content).hexdigest()
+
+
+def test_mmap_into_hashes(tmp_path):
+    content = bytes(range(256)) * (3 * mmap.ALLOCATIONGRANULARITY // 256) + b"snake"
+    p = tmp_path / "hello.bin"
+    p.write_bytes(content)
+    hashes = [hashlib.sha1(), hashlib.md5()]
+    with open(p, "rb", buffering=0) as f:
+        # more than one window, the last slice of each window shorter than the buffer
+        assert mmap_into_hashes(f, hashes, 3 * A_KB, window_size=mmap.ALLOCATIONGRANULARITY) == len(content)
+    assert hashes[0].hexdigest() == hashlib.sha1(content).hexdigest()
+    assert hashes[1].hexdigest() == hashlib.md5(content).hexdigest()
+
+    empty = tmp_path / "empty.bin"
+    empty.write_bytes(b"")
+    hashes = [hashlib.sha1()]
+    with open(empty, "rb", buffering=0) as f:
+        assert mmap_into_hashes(f, hashes) == 0
+    assert hashes[0].hexdigest() == hashlib.sha1(b"").hexdigest()
+
+    class ChangeFile:
+        """a hash that changes the file after the first slice: shrink to 2 kB then add data to the end"""
+
+        def __init__(self):
+            self.hash = hashlib.sha1()
+            self.slices = 0
+
+        def update(self, data):
+            self.hash.update(data)
+            self.slices += 1
+            if self.slices == 1:
+                os.truncate(p, 2 * A_KB)
+                with open(p, "ab") as appending:
+                    appending.write(b"big")
+
+    change_file = ChangeFile()
+    with open(p, "rb", buffering=0) as f:
+        assert mmap_into_hashes(f, [change_file], A_KB) == 2 * A_KB + 3
+    assert change_file.hash.hexdigest() == hashlib.sha1(content[:2 * A_KB] + b"big").hexdigest()
+    assert get_hashes(p, ("sha1",), mmap_threshold=1) == get_hashes(p, ("sha1",))
+
+
+def test_get_hashes(tmp_path):
+    content = b"continent big snake"
+    p = tmp_path / "hello.txt"
+    p.write_bytes(content)
+    result = get_hashes(p, ("sha1", "md5", "sha256", "blake2b"), buffer_size=4)
+    assert result == {
+        "sha1": hashlib.sha1(content).hexdigest(),
+        "md5": hashlib.md5(content).hexdigest(),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "blake2b": hashlib.blake2b(content).hexdigest(),
+    }
+
+
+def test_parse_hash_names():
+    assert parse_hash_names("sha1") == ("sha1",)
+    assert parse_hash_names("SHA-256, md5,sha256,") == ("sha256", "md5")
+    with pytest.raises(ValueError):
+        parse_hash_names("sha1,crc32")
+
+
+def test_get_csv_report_header():
+    assert get_csv_report_header(("sha1",), simple_output=True) == _csv_report_header_simple_
+    assert get_csv_report_header(("sha1",), simple_output=False) == _csv_report_header_
+    assert get_csv_report_header(("md5", "sha256"), simple_output=True)[2:4] == ["md5", "sha256"]
+    assert get_csv_report_header(("md5", "sha256"), simple_output=False)[2:6] == [
+        "md5",
+        "md5-uc",
+        "sha-256",
+        "sha-256-uc",
+    ]
+
+
+def test_main_multiple_hashes(tmp_path):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    contents = {"a.txt": b"continent", "sub/b.txt": b"big snake" * 1000}
+    for name, content in contents.items():
+        (scan_location / name).write_bytes(content)
+
+    hash_names = ("sha1", "md5", "sha256")
+    report_file = main(
+        scan_location,
+        tmp_path / "a_report.csv",
+        "case1-mongoose",
+        simple_output=True,
+        cores=2,
+        hash_names=hash_names,
+    )
+    with open(report_file, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+
+    assert list(rows[0].keys()) == get_csv_report_header(hash_names, simple_output=True)
+    assert len(rows) == len(contents)
+    for row in rows:
+        content = contents[pathlib.PurePath(row["relative-path"]).as_posix()]
+        for hash_name in hash_names:
+            assert row[hash_name] == hashlib.new(hash_name, content).hexdigest()
+
+
+def test_hash_cache(tmp_path):
+    cache_file = tmp_path / "cache.sqlite"
+    key1 = (1, 10, 100, 1000)
+    key2 = (1, 11, 100, 1000)
+    with HashCache(cache_file, max_entries=2) as hash_cache:
+        hash_cache.store(key1, {"sha1": "aa", "md5": "bb"})
+        assert hash_cache.lookup(key1, ("sha1",)) == {"sha1": "aa"}
+        assert hash_cache.lookup(key1, ("sha1", "sha256")) is None
+        assert hash_cache.lookup((1, 10, 100, 1001), ("sha1",)) is None  # modified since cached
+        hash_cache.store(key2, {"sha1": "cc"})
+    # 3 rows > max_entries, the first (least recently used) row is removed
+    assert lookup_hash_cache(cache_file, key2, ("sha1",)) == {"sha1": "cc"}
+    with HashCache(cache_file) as hash_cache:
+        (count,) = hash_cache.connection.execute("SELECT COUNT(*) FROM hash_cache").fetchone()
+    assert count == 2
+
+
+def test_main_hash_cache(tmp_path, caplog):
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    (scan_location / "a.txt").write_bytes(b"continent")
+    (scan_location / "b.txt").write_bytes(b"big snake")
+    cache_file = tmp_path / "cache.sqlite"
+
+    def run():
+        caplog.clear()
+        report_file = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2,
+                           cache=cache_file)
+        with open(report_file, "r", encoding="utf-8") as fin:
+            return {row["relative-path"]: row["sha1"] for row in csv.DictReader(fin)}
+
+    first = run()
+    assert "2 files hashed, hash cache hits: 0, misses: 2" in caplog.text
+    assert run() == first
+    assert "2 files hashed, hash cache hits: 2, misses: 0" in caplog.text
+
+    (scan_location / "b.txt").write_bytes(b"big snake changed")
+    assert run()["b.txt"] == hashlib.sha1(b"big snake changed").hexdigest()
+    assert "2 files hashed, hash cache hits: 1, misses: 1" in caplog.text
+
+
+@pytest.mark.parametrize("executor", ["process", "thread", "hybrid"])
+def test_run_hash_multiprocessor_yield_executors(tmp_path, executor):
+    contents = {f"{i}.bin": bytes([i]) * (i * 500) for i in range(1, 9)}
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+
+    results = run_hash_multiprocessor_yield(
+        get_file_list(tmp_path, file_records=True),
+        "case1",
+        True,
+        cores=2,
+        scan_location=tmp_path,
+        executor=executor,
+        hybrid_threshold=2000,
+    )
+    assert {result["relative-path"]: result["sha1"] for result in results} == {
+        name: hashlib.sha1(content).hexdigest() for name, content in contents.items()
+    }
+
+
+@pytest.mark.parametrize("device_readers", [1, 2])
+def test_run_batches_device_readers(device_readers):
+    # 3 devices of 20 files, the files of each device in reverse inode order
+    items = [SimpleNamespace(dev=dev, ino=100 - i, size=1) for i in range(20) for dev in (1, 2, 3)]
+    lock = threading.Lock()
+    readers = {1: 0, 2: 0, 3: 0}
+    most_readers = {1: 0, 2: 0, 3: 0}
+
+    def read_batch(item):
+        with lock:
+            readers[item.dev] += 1
+            most_readers[item.dev] = max(most_readers[item.dev], readers[item.dev])
+        time.sleep(0.001)
+        with lock:
+            readers[item.dev] -= 1
+        return item
+
+    results = list(run_batches_multiprocessor_yield(
+        read_batch, items, cores=8, batch_size=4, executor="thread", device_readers=device_readers,
+    ))
+    assert sorted(map(id, results)) == sorted(map(id, items))
+    # the files of a batch are read one after the other, so a batch is one reader
+    assert all(0 < most <= device_readers for most in most_readers.values())
+
+    scheduler = DeviceScheduler(device_readers)
+    for dev in (1, 2):
+        for i in range(3):
+            scheduler.add(dev, "thread", [item for item in items if item.dev == dev][i * 4:(i + 1) * 4])
+    ready = scheduler.ready(10)
+    assert [device for device, _, _ in ready] == [1] * device_readers + [2] * device_readers
+    assert all([item.ino for item in batch] == sorted(item.ino for item in batch) for _, _, batch in ready)
+    assert scheduler.ready(10) == []
+    scheduler.done(1)
+    assert [device for device, _, _ in scheduler.ready(10)] == [1]
+    assert scheduler.waiting == 6 - 2 * device_readers - 1
+
+
+def get_pid(item) -> int:
+    return os.getpid()
+
+
+def test_run_batches_small_file_size():
+    items = [SimpleNamespace(size=size) for size in (0, 10, 4096, 4097, 4 * A_KB * A_KB)]
+    results = list(run_batches_multiprocessor_yield(get_pid, items, cores=2, small_file_size=4097, batch_size=1))
+    assert len(results) == len(items)
+    # the files of less than 4097 bytes are run in this process, the rest in worker processes
+    assert results.count(os.getpid()) == 3
+
+    future = InlineExecutor().submit(int, "x")
+    assert future.done() and isinstance(future.exception(), ValueError)
+
+
+def test_get_device_readers():
+    assert get_device_readers(1, None) is None
+    assert get_device_readers(None, 2) is None
+    assert get_device_readers(1, 2) == 2
+    assert get_device_readers(os.stat(pathlib.Path(__file__)).st_dev, "auto") in (None, 1)
+
+
+def test_run_hash_multiprocessor_yield_streams(tmp_path):
+    files = []
+    for i in range(20):
+        p = tmp_path / f"{i}.txt"
+        p.write_text(f"continent {i}")
+        files.append(p)
+
+    taken = 0
+
+    def file_list():
+        nonlocal taken
+        for file in files:
+            taken += 1
+            yield file
+
+    hash_generator = run_hash_multiprocessor_yield(
+        file_list(), "case1", True, cores=2, scan_location=tmp_path, max_in_flight=3, batch_size=2
+    )
+    first = next(hash_generator)
+    # the first result is available before the file list has been read to the end
+    assert taken <= 3 * 2
+    results = [first, *hash_generator]
+    assert taken == len(files)
+    assert sorted(result["relative-path"] for result in results) == sorted(file.name for file in files)
+
+
+def test_worker_logging(tmp_path, caplog):
+    for i in range(4):
+        (tmp_path / f"{i}.txt").write_text(f"continent {i}" * i)
+
+    def big_file_records(level):
+        caplog.clear()
+        with caplog.at_level(level):
+            list(run_hash_multiprocessor_yield(get_file_list(tmp_path), "case1", True, cores=2, max_hash_size=20,
+                                               scan_location=tmp_path))
+        return [record for record in caplog.records if record.getMessage().startswith("big file")]
+
+    # the workers log to the listener in this process, not to stdout
+    records = big_file_records(logging.DEBUG)
+    assert sorted(pathlib.Path(record.getMessage().split(": ")[1]).name for record in records) == ["2.txt", "3.txt"]
+    assert all(record.process != os.getpid() for record in records)
+    assert big_file_records(logging.INFO) == []
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(bytes_per_second=100_000, iops=100)
+    t = time.monotonic()
+    rate_limiter.acquire(100_000)  # the bucket starts with a second of bytes
+    assert time.monotonic() - t < 0.05
+    rate_limiter.acquire(20_000)
+    assert 0.15 < time.monotonic() - t < 0.5
+
+    rate_limiter = RateLimiter(iops=100)
+    t = time.monotonic()
+    for _ in range(120):
+        rate_limiter.acquire(A_KB)
+    assert 0.15 < time.monotonic() - t < 0.5
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_io_limits(tmp_path, monkeypatch, executor):
+    for i in range(4):
+        (tmp_path / f"{i}.bin").write_bytes(bytes(10_000))
+    advice = []
+    if hasattr(os, "posix_fadvise"):
+        posix_fadvise = os.posix_fadvise
+
+        def record_fadvise(fd, offset, length, flag):
+            advice.append(flag)
+            posix_fadvise(fd, offset, length, flag)
+
+        monkeypatch.setattr(os, "posix_fadvise", record_fadvise)
+    set_io_limits(IOLimits(polite=True, rate_limiter=RateLimiter(bytes_per_second=20_000)))
+    try:
+        t = time.monotonic()
+        results = list(run_hash_multiprocessor_yield(get_file_list(tmp_path), "case1", True, cores=2,
+                                                     scan_location=tmp_path, executor=executor))
+        # 40,000 bytes at 20,000 a second for all the workers, less the first second in the bucket
+        assert time.monotonic() - t > 0.9
+    finally:
+        set_io_limits()
+    assert all(result["sha1"] == hashlib.sha1(bytes(10_000)).hexdigest() for result in results)
+    if hasattr(os, "posix_fadvise") and executor == "thread":
+        assert sorted(advice) == sorted([os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_DONTNEED] * 4)
+
+
+def test_batch_sizer():
+    fixed = BatchSizer(16)
+    fixed.record(16, 100.0)
+    assert fixed.size == 16
+    assert [len(batch) for batch in get_batches(range(40), fixed)] == [16, 16, 8]
+
+    adaptive = BatchSizer(None, target_seconds=0.1, max_size=500)
+    assert adaptive.size == 1
+    adaptive.record(10, 0.01)  # 1 ms per file
+    assert adaptive.size == 100
+    adaptive.record(1, 10.0)  # a big file, slower per file so smaller batches
+    assert adaptive.size == 1
+    adaptive = BatchSizer(None, target_seconds=0.1, max_size=500)
+    adaptive.record(1000, 0.001)
+    assert adaptive.size == 500
+
+
+def test_find_duplicates(tmp_path):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    big = bytes(range(256)) * 100  # 25600 bytes, more than 2 * the partial hash size
+    big_middle_changed = big[:12800] + b"x" + big[12801:]  # same size, first and last bytes as big
+    files = {
+        "a.txt": b"continent",
+        "sub/a copy.txt": b"continent",
+        "sub/a again.txt": b"continent",
+        "b.txt": b"continenT",  # same size as a.txt, different content
+        "unique.txt": b"big snake",
+        "empty1.txt": b"",
+        "empty2.txt": b"",
+        "big.bin": big,
+        "sub/big copy.bin": big,
+        "big changed.bin": big_middle_changed,
+    }
+    for name, content in files.items():
+        (scan_location / name).write_bytes(content)
+
+    report_file = find_duplicates(
+        scan_location, tmp_path / "duplicates.csv", "case1", simple_output=True, cores=2, partial_hash_size=A_KB
+    )
+    with open(report_file, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+
+    assert list(rows[0].keys()) == get_csv_duplicates_header(simple_output=True)
+    groups = {}
+    for row in rows:
+        groups.setdefault(row["group"], []).append(pathlib.PurePath(row["relative-path"]).as_posix())
+    # the group that reclaims the most bytes is first
+    assert groups == {
+        "1": ["big.bin", "sub/big copy.bin"],
+        "2": ["a.txt", "sub/a again.txt", "sub/a copy.txt"],
+    }
+    assert rows[0]["reclaimable-bytes"] == str(len(big))
+    assert rows[2]["reclaimable-bytes"] == str(2 * len(b"continent"))
+    assert rows[2]["sha1"] == hashlib.sha1(b"continent").hexdigest()
+
+
+def test_find_duplicates_hard_links(tmp_path):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    (scan_location / "a.txt").write_bytes(b"continent")
+    (scan_location / "sub" / "a copy.txt").write_bytes(b"continent")
+    (scan_location / "unique.txt").write_bytes(b"big snake")
+    os.link(scan_location / "a.txt", scan_location / "sub" / "a link.txt")
+    os.link(scan_location / "unique.txt", scan_location / "unique link.txt")
+
+    report_file = find_duplicates(scan_location, tmp_path / "duplicates.csv", "case1", simple_output=True, cores=2)
+    with open(report_file, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+    # the links to a file are one file: a.txt or its link is a duplicate of the copy, unique.txt has no duplicate
+    paths = sorted(pathlib.PurePath(row["relative-path"]).as_posix() for row in rows)
+    assert len(paths) == 2
+    assert paths[0] in ("a.txt", "sub/a link.txt")
+    assert paths[1] == "sub/a copy.txt"
+    assert {(row["files"], row["reclaimable-bytes"]) for row in rows} == {("2", str(len(b"continent")))}
+
+
+def test_main_tree_hash(tmp_path):
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    big = bytes(range(256)) * 40  # 10240 bytes
+    (scan_location / "big.bin").write_bytes(big)
+    (scan_location / "small.txt").write_bytes(b"continent")
+    segment_size = 3000
+    hash_names = ("sha1", "md5")
+
+    report_file = main(
+        scan_location,
+        tmp_path / "a_report.csv",
+        "case1",
+        simple_output=True,
+        cores=2,
+        max_hash_size=A_KB * 4,
+        hash_names=hash_names,
+        tree_hash=True,
+        segment_size=segment_size,
+    )
+    with open(report_file, "r", encoding="utf-8") as fin:
+        rows = {row["relative-path"]: row for row in csv.DictReader(fin)}
+    with open(tmp_path / "a_report.segments.csv", "r", encoding="utf-8") as fin:
+        segment_rows = list(csv.DictReader(fin))
+
+    assert rows["small.txt"]["sha1"] == hashlib.sha1(b"continent").hexdigest()
+    assert rows["small.txt"]["tree-sha1"] == ""
+    assert rows["big.bin"]["sha1"] == ""
+    assert "tree hash of 3000 byte segments" in rows["big.bin"]["hash-error"]
+    for hash_name in hash_names:
+        segments = [big[offset:offset + segment_size] for offset in range(0, len(big), segment_size)]
+        digests = [hashlib.new(hash_name, segment).hexdigest() for segment in segments]
+        assert [row["digest"] for row in segment_rows if row["hash"] == hash_name] == digests
+        assert rows["big.bin"][f"tree-{hash_name}"] == get_tree_hash(digests, hash_name)
+        assert get_tree_hash(digests, hash_name) == hashlib.new(
+            hash_name, b"".join(hashlib.new(hash_name, segment).digest() for segment in segments)
+        ).hexdigest()
+    assert [int(row["length"]) for row in segment_rows if row["hash"] == "sha1"] == [3000, 3000, 3000, 1240]
+
+
+def test_main_resume(tmp_path, monkeypatch):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    for i in range(10):
+        (scan_location / ("sub" if i % 2 else "") / f"{i}.txt").write_text(f"continent {i}")
+
+    def read_report(report_file):
+        with open(report_file, "r", encoding="utf-8") as fin:
+            return fin.readline(), sorted(fin.readlines())
+
+    ref_report = main(scan_location, tmp_path / "ref_report.csv", "case1", simple_output=True, cores=2)
+    assert not get_journal(ref_report).exists()
+
+    get_file_list = app.hash_file.get_file_list
+
+    def interrupted_file_list(*args, **kwargs):
+        for count, record in enumerate(get_file_list(*args, **kwargs)):
+            if count == 4:
+                raise KeyboardInterrupt
+            yield record
+
+    report = tmp_path / "a_report.csv"
+    monkeypatch.setattr(app.hash_file, "get_file_list", interrupted_file_list)
+    with pytest.raises(KeyboardInterrupt):
+        main(scan_location, report, "case1", simple_output=True, cores=2, max_in_flight=1, batch_size=1)
+    monkeypatch.setattr(app.hash_file, "get_file_list", get_file_list)
+
+    header, rows = read_report(report)
+    assert 0 < len(rows) < 10
+    with open(report, "a", encoding="utf-8") as fout:
+        fout.write('"case1","half a row')  # as if the scan had stopped part way through writing a row
+
+    main(scan_location, report, "case1", simple_output=True, cores=2, resume=True)
+    assert read_report(report) == read_report(ref_report)
+    assert not get_journal(report).exists()
+
+
+def test_main_resume_relative_location(tmp_path, monkeypatch):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    for i in range(10):
+        (scan_location / ("sub" if i % 2 else "") / f"{i}.txt").write_text(f"continent {i}")
+    monkeypatch.chdir(tmp_path)
+
+    def read_report(report_file):
+        with open(report_file, "r", encoding="utf-8") as fin:
+            return fin.readline(), sorted(fin.readlines())
+
+    ref_report = main(pathlib.Path("scan"), tmp_path / "ref_report.csv", "case1", simple_output=True, cores=2)
+    assert "None" not in read_report(ref_report)[1][0]
+
+    get_file_list = app.hash_file.get_file_list
+
+    def interrupted_file_list(*args, **kwargs):
+        for count, record in enumerate(get_file_list(*args, **kwargs)):
+            if count == 4:
+                raise KeyboardInterrupt
+            yield record
+
+    report = tmp_path / "a_report.csv"
+    monkeypatch.setattr(app.hash_file, "get_file_list", interrupted_file_list)
+    with pytest.raises(KeyboardInterrupt):
+        main(pathlib.Path("scan"), report, "case1", simple_output=True, cores=2, max_in_flight=1, batch_size=1)
+    monkeypatch.setattr(app.hash_file, "get_file_list", get_file_list)
+    assert 0 < len(read_report(report)[1]) < 10
+
+    main(pathlib.Path("scan"), report, "case1", simple_output=True, cores=2, resume=True)
+    assert read_report(report) == read_report(ref_report)
+    assert not get_journal(report).exists()
+
+
+def test_main_resume_tree_hash(tmp_path, monkeypatch):
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    for i in range(3):
+        (scan_location / f"big{i}.bin").write_bytes(bytes([i]) * 10 * A_KB)
+    (scan_location / "small.txt").write_bytes(b"continent")
+    kwargs = dict(simple_output=True, cores=2, max_hash_size=4 * A_KB, tree_hash=True, segment_size=3 * A_KB)
+
+    def read_report(report_file):
+        with open(report_file, "r", encoding="utf-8") as fin:
+            return fin.readline(), sorted(fin.readlines())
+
+    get_tree_hash = app.hash_file.get_tree_hash
+    calls = []
+
+    def interrupted_tree_hash(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise KeyboardInterrupt  # after the segments of the third big file are written
+        return get_tree_hash(*args)
+
+    report = tmp_path / "a_report.csv"
+    monkeypatch.setattr(app.hash_file, "get_tree_hash", interrupted_tree_hash)
+    with pytest.raises(KeyboardInterrupt):
+        main(scan_location, report, "case1", hash_names=("sha1",), **kwargs)
+    monkeypatch.setattr(app.hash_file, "get_tree_hash", get_tree_hash)
+    # the big files tree hashed before the interrupt are in the report (and the journal)
+    assert len(read_report(report)[1]) == 3
+
+    main(scan_location, report, "case1", hash_names=("sha1",), resume=True, **kwargs)
+    ref_report = main(scan_location, tmp_path / "ref_report.csv", "case1", hash_names=("sha1",), **kwargs)
+    assert read_report(report) == read_report(ref_report)
+    # each segment once
+    assert read_report(get_segments_report(report)) == read_report(get_segments_report(ref_report))
+
+
+@pytest.mark.parametrize("simple_output", [True, False])
+def test_main_sqlite_report(tmp_path, monkeypatch, simple_output):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    for i in range(10):
+        (scan_location / ("sub" if i % 2 else "") / f"{i}.txt").write_text(f"continent {i % 7}")
+
+    csv_report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=simple_output, cores=2)
+    with open(csv_report, "r", encoding="utf-8") as fin:
+        csv_rows = sorted(tuple(row.values()) for row in csv.DictReader(fin))
+
+    get_file_list = app.hash_file.get_file_list
+
+    def interrupted_file_list(*args, **kwargs):
+        for count, record in enumerate(get_file_list(*args, **kwargs)):
+            if count == 4:
+                raise KeyboardInterrupt
+            yield record
+
+    report = tmp_path / "a_report.sqlite"
+    monkeypatch.setattr(app.hash_file, "get_file_list", interrupted_file_list)
+    with pytest.raises(KeyboardInterrupt):
+        main(scan_location, report, "case1", simple_output=simple_output, cores=2, max_in_flight=1, batch_size=1,
+             report_format="sqlite")
+    monkeypatch.setattr(app.hash_file, "get_file_list", get_file_list)
+    main(scan_location, report, "case1", simple_output=simple_output, cores=2, resume=True, report_format="sqlite")
+
+    connection = sqlite3.connect(report)
+    columns = [column[1] for column in connection.execute("PRAGMA table_info(report)")]
+    rows = sorted(
+        tuple("" if value is None else str(value) for value in row)
+        for row in connection.execute("SELECT * FROM report")
+    )
+    indexed = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    duplicates = connection.execute(
+        f'SELECT COUNT(*) FROM report GROUP BY "{get_hash_column_name("sha1", simple_output)}" HAVING COUNT(*) > 1'
+    ).fetchall()
+    connection.close()
+
+    assert columns == get_csv_report_header(hash_names_default, simple_output)
+    assert rows == csv_rows
+    path_column = "relative-path" if simple_output else "path"
+    hash_column = get_hash_column_name("sha1", simple_output)
+    assert indexed == {f"report-{hash_column}", "report-size", f"report-{path_column}"}
+    assert sorted(duplicates) == [(2,), (2,), (2,)]
+
+
+def test_known_hashes(tmp_path):
+    digests = [hashlib.sha1(f"continent {i}".encode()).hexdigest() for i in range(100)]
+    hash_list = tmp_path / "known.txt"
+    with open(hash_list, "w", encoding="utf-8") as fout:
+        fout.write('"SHA-1","MD5","FileName"\n')  # e.g. the NSRL
+        for digest in digests[::-1] + digests[:10]:  # not sorted, with duplicates
+            fout.write(f'"{digest.upper()}","{hashlib.md5(digest.encode()).hexdigest()}","a name"\n')
+        fout.write(f"{hashlib.md5(b'not sha1').hexdigest()}\n")
+
+    index_file = build_known_hash_index(hash_list, tmp_path / "known.index", chunk_digests=7)
+    known = KnownHashes(index_file)
+    assert known.hash_name == "sha1"
+    assert len(known) == len(digests)
+    assert [known[i].hex() for i in range(len(known))] == sorted(digests)
+    assert all(digest in known for digest in digests)
+    assert hashlib.sha1(b"sea").hexdigest() not in known
+    assert "" not in known
+    known.close()
+
+    with pytest.raises(ValueError):
+        KnownHashes(hash_list)
+    with pytest.raises(ValueError):
+        KnownHashes.load(index_file, ("md5",), tmp_path)
+
+
+def test_main_known_hashes(tmp_path):
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    for i in range(10):
+        (scan_location / f"{i}.txt").write_text(f"continent {i}")
+    bad_list = tmp_path / "bad.txt"
+    bad_list.write_text("\n".join(hashlib.sha1(f"continent {i}".encode()).hexdigest() for i in (1, 2)))
+    good_list = tmp_path / "good.txt"
+    good_list.write_text("\n".join(hashlib.sha1(f"continent {i}".encode()).hexdigest() for i in (5, 6, 7)))
+    good_index = build_known_hash_index(good_list, tmp_path / "good.index")
+
+    report_file = main(
+        scan_location,
+        tmp_path / "a_report.csv",
+        "case1",
+        simple_output=True,
+        cores=2,
+        known_hashes=(bad_list, good_index),
+        omit_known_hashes=(good_index,),
+    )
+    with open(report_file, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+
+    assert list(rows[0].keys()) == get_csv_report_header(simple_output=True, known_hashes=True)
+    assert sorted(row["relative-path"] for row in rows) == [f"{i}.txt" for i in (0, 1, 2, 3, 4, 8, 9)]
+    assert {row["relative-path"]: row["known-hash"] for row in rows if row["known-hash"]} == {
+        "1.txt": "bad", "2.txt": "bad"
+    }
+
+
+@pytest.mark.parametrize("chunk_rows", [3, 1000])
+@pytest.mark.parametrize("simple_output", [True, False])
+def test_compare_reports(tmp_path, chunk_rows, simple_output):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    for i in range(20):
+        (scan_location / ("sub" if i % 2 else "") / f"{i}.txt").write_text(f"continent {i}")
+    old_report = main(scan_location, tmp_path / "old.csv", "case1", simple_output=simple_output, cores=2)
+
+    (scan_location / "4.txt").unlink()
+    (scan_location / "sub" / "5.txt").unlink()
+    (scan_location / "new.txt").write_text("continent new")
+    (scan_location / "8.txt").write_text("continent 08")  # same size
+    (scan_location / "sub" / "9.txt").write_text("continent 99")  # different size
+    new_report = main(scan_location, tmp_path / "new.csv", "case1", simple_output=simple_output, cores=2)
+
+    diff_report = tmp_path / "diff.csv"
+    counts = compare_reports(old_report, new_report, diff_report, chunk_rows=chunk_rows)
+    assert counts == {"added": 1, "removed": 2, "changed": 2, "unchanged": 16}
+
+    path_column = "relative-path" if simple_output else "path"
+    with open(diff_report, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+    changes = {}
+    for row in rows:
+        path = pathlib.Path(row[path_column])
+        if not simple_output:
+            path = path.relative_to(scan_location)
+        changes[path.as_posix()] = row["change"]
+    assert changes == {"4.txt": "removed", "sub/5.txt": "removed", "new.txt": "added", "8.txt": "changed",
+                       "sub/9.txt": "changed"}
+    hash_column = get_hash_column_name("sha1", simple_output)
+    assert list(rows[0].keys()) == get_csv_diff_header(path_column, [hash_column])
+    paths = [row[path_column] for row in rows]
+    assert paths == sorted(paths)
+    changed = next(row for row in rows if row[path_column].endswith("8.txt"))
+    assert changed["new-" + hash_column] == hashlib.sha1(b"continent 08").hexdigest()
+    assert changed["old-" + hash_column] == hashlib.sha1(b"continent 8").hexdigest()
+    assert not list(tmp_path.glob("**/*.run.csv"))
+
+
+def test_compare_reports_same_name(tmp_path):
+    # reports of the same name in different folders, each sorted in runs (larger than a read buffer) in the same
+    # runs location
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    for i in range(300):
+        (scan_location / f"{i}.txt").write_text(f"continent {i}")
+    (tmp_path / "day1").mkdir()
+    (tmp_path / "day2").mkdir()
+    old_report = main(scan_location, tmp_path / "day1" / "hash_report.csv", "case1", simple_output=True, cores=2)
+    (scan_location / "3.txt").write_text("continent 33")
+    new_report = main(scan_location, tmp_path / "day2" / "hash_report.csv", "case1", simple_output=True, cores=2)
+
+    counts = compare_reports(old_report, new_report, tmp_path / "diff.csv", chunk_rows=100)
+    assert counts == {"added": 0, "removed": 0, "changed": 1, "unchanged": 299}
+    assert not list(tmp_path.glob("**/*.run.csv"))
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_verify_report(tmp_path, executor):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub" / "deeper").mkdir(parents=True)
+    for i in range(12):
+        (scan_location / ["", "sub", "sub/deeper"][i % 3] / f"{i}.txt").write_text(f"continent {i}")
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2,
+                  hash_names=("sha1", "md5"))
+
+    copy_location = tmp_path / "copy"
+    shutil.copytree(scan_location, copy_location)
+    (copy_location / "0.txt").write_text("continent X")  # same size
+    (copy_location / "sub" / "1.txt").write_text("continent")
+    (copy_location / "sub" / "deeper" / "2.txt").unlink()
+    (copy_location / "sub" / "extra.txt").write_text("continent extra")
+    (copy_location / "new").mkdir()
+    (copy_location / "new" / "not found.txt").write_text("not in a folder of the report")
+
+    verify_output = tmp_path / "verify.csv"
+    # the extra files are found from the report sorted on the folders in runs of 2 rows
+    counts = verify_report(report, copy_location, verify_output, cores=2, executor=executor, chunk_rows=2)
+    assert counts == {"ok": 9, "mismatch": 2, "missing": 1, "extra": 1, "not hashed": 0, "not verified": 0,
+                      "error": 0}
+    assert not list(tmp_path.glob("**/*.run.csv"))
+
+    with open(verify_output, "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+    assert list(rows[0].keys()) == get_csv_verify_header(("sha1", "md5"))
+    statuses = {pathlib.PurePath(row["relative-path"]).as_posix(): row["status"] for row in rows}
+    assert statuses == {"0.txt": "mismatch", "sub/1.txt": "mismatch", "sub/deeper/2.txt": "missing",
+                        "sub/extra.txt": "extra"}
+    mismatch = next(row for row in rows if row["relative-path"] == "0.txt")
+    assert mismatch["expected-sha1"] == hashlib.sha1(b"continent 0").hexdigest()
+    assert mismatch["sha1"] == hashlib.sha1(b"continent X").hexdigest()
+    assert mismatch["md5"] == hashlib.md5(b"continent X").hexdigest()
+
+
+@pytest.mark.parametrize("executor", ["process", "hybrid"])
+def test_verify_report_no_size(tmp_path, executor):
+    # a row with an empty size is hashed (in the process pool) and not compared on size
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    for i in range(3):
+        (scan_location / f"{i}.txt").write_text(f"continent {i}")
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2)
+    with open(report, "r", encoding="utf-8") as fin:
+        reader = csv.DictReader(fin)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    rows[0]["size"] = ""
+    with open(report, "w", encoding="utf-8") as fout:
+        csv_writer = csv.DictWriter(fout, fieldnames=fieldnames, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    counts = verify_report(report, scan_location, tmp_path / "verify.csv", cores=2, executor=executor)
+    assert counts == {"ok": 3, "mismatch": 0, "missing": 0, "extra": 0, "not hashed": 0, "not verified": 0,
+                      "error": 0}
+
+
+def test_verify_report_no_relative_path(tmp_path):
+    # rows with no relative path (a relative or single file scan) can not be checked, they are not a pass
+    scan_location = tmp_path / "scan"
+    scan_location.mkdir()
+    for i in range(3):
+        (scan_location / f"{i}.txt").write_text(f"continent {i}")
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2)
+    with open(report, "r", encoding="utf-8") as fin:
+        reader = csv.DictReader(fin)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    for row in rows:
+        row["relative-path"] = "None"
+    with open(report, "w", encoding="utf-8") as fout:
+        csv_writer = csv.DictWriter(fout, fieldnames=fieldnames, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    verify_output = tmp_path / "verify.csv"
+    counts = verify_report(report, scan_location, verify_output, cores=2)
+    assert counts == {"ok": 0, "mismatch": 0, "missing": 0, "extra": 0, "not hashed": 0, "not verified": 3,
+                      "error": 0}
+    with open(verify_output, "r", encoding="utf-8") as fin:
+        assert [row["status"] for row in csv.DictReader(fin)] == ["not verified"] * 3
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_main_into_archives(tmp_path, executor):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    contents = {"a.txt": b"continent", "inner/b.txt": b"big snake" * 1000, "inner/empty.txt": b""}
+    with zipfile.ZipFile(scan_location / "files.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("inner/", "")
+        for name, content in contents.items():
+            archive.writestr(name, content)
+    for name, content in contents.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(content)
+    for archive_name, mode in (("sub/files.tar", "w"), ("files.tar.gz", "w:gz")):
+        with tarfile.open(scan_location / archive_name, mode) as archive:
+            for name in contents:
+                archive.add(tmp_path / name, name)
+    (scan_location / "not.zip").write_text("not a zip archive")
+
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2,
+                  executor=executor, into_archives=True)
+    with open(report, "r", encoding="utf-8") as fin:
+        rows = {pathlib.PurePath(row["relative-path"]).as_posix(): row for row in csv.DictReader(fin)}
+    assert len(rows) == 4 + 3 * len(contents)
+    for archive_name in ("files.zip", "sub/files.tar", "files.tar.gz"):
+        assert rows[archive_name]["sha1"] == hashlib.sha1((scan_location / archive_name).read_bytes()).hexdigest()
+        for name, content in contents.items():
+            row = rows[f"{archive_name}!/{name}"]
+            assert row["sha1"] == hashlib.sha1(content).hexdigest()
+            assert row["size"] == str(len(content))
+            assert row["file-name"] == pathlib.PurePosixPath(name).name
+            assert row["hash-error"] == ("file size is 0 bytes" if not content else "")
+    assert rows["not.zip"]["hash-error"] == ""
+
+    # the files in the archives are verified from the archives
+    (scan_location / "extra.txt").write_text("extra")
+    verify_output = tmp_path / "verify.csv"
+    counts = verify_report(report, scan_location, verify_output, cores=2, executor=executor)
+    assert counts == {"ok": 4 + 3 * len(contents), "mismatch": 0, "missing": 0, "extra": 1, "not hashed": 0,
+                      "not verified": 0, "error": 0}
+
+
+@pytest.mark.parametrize("simple_output", [True, False])
+def test_main_hard_links(tmp_path, caplog, simple_output):
+    scan_location = tmp_path / "scan"
+    for folder in ("a", "b", "c"):
+        (scan_location / folder).mkdir(parents=True)
+    (scan_location / "a" / "1.txt").write_text("continent" * 100)
+    (scan_location / "a" / "2.txt").write_text("big snake")
+    os.link(scan_location / "a" / "1.txt", scan_location / "b" / "1 link.txt")
+    os.link(scan_location / "a" / "1.txt", scan_location / "c" / "1 link.dat")
+    os.link(scan_location / "a" / "2.txt", scan_location / "c" / "2 link.txt")
+    os.link(scan_location / "a" / "2.txt", tmp_path / "outside the scan.txt")
+
+    with caplog.at_level(logging.INFO):
+        report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=simple_output, cores=2,
+                      batch_size=1)
+    assert "Hard links: 3 files not read again, 1809 bytes saved" in caplog.text
+
+    path_column = "relative-path" if simple_output else "path"
+    hash_column = "sha1" if simple_output else "sha-1"
+    with open(report, "r", encoding="utf-8") as fin:
+        rows = {pathlib.PurePath(row[path_column]).name: row for row in csv.DictReader(fin)}
+    assert sorted(rows) == ["1 link.dat", "1 link.txt", "1.txt", "2 link.txt", "2.txt"]
+    for name, content in (("1 link.dat", "continent" * 100), ("1 link.txt", "continent" * 100),
+                          ("2 link.txt", "big snake")):
+        assert rows[name][hash_column] == hashlib.sha1(content.encode()).hexdigest()
+        assert rows[name]["file-name"] == name
+        assert rows[name]["file-extension"] == pathlib.PurePath(name).suffix
+    assert pathlib.PurePath(rows["1 link.dat"][path_column]).parent.name == "c"
+
+
+def test_main_hard_links_archives_big_files(tmp_path):
+    scan_location = tmp_path / "scan"
+    (scan_location / "b").mkdir(parents=True)
+    with zipfile.ZipFile(scan_location / "files.zip", "w") as archive:
+        archive.writestr("a.txt", "continent")
+    (scan_location / "big.bin").write_bytes(b"x" * 10 * A_KB)
+    os.link(scan_location / "files.zip", scan_location / "b" / "files link.zip")
+    os.link(scan_location / "big.bin", scan_location / "b" / "big link.bin")
+
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2,
+                  into_archives=True, tree_hash=True, max_hash_size=4 * A_KB, segment_size=3 * A_KB)
+    with open(report, "r", encoding="utf-8") as fin:
+        rows = {pathlib.PurePath(row["relative-path"]).as_posix(): row for row in csv.DictReader(fin)}
+    # the files in an archive are listed once, under the first link found, a big file is tree hashed once
+    members = [path for path in rows if "!/" in path]
+    assert len(members) == 1
+    assert members[0] in ("files.zip!/a.txt", "b/files link.zip!/a.txt")
+    assert rows["files.zip"]["sha1"] == rows["b/files link.zip"]["sha1"] != ""
+    assert rows["big.bin"]["tree-sha1"] == rows["b/big link.bin"]["tree-sha1"] != ""
+    with open(get_segments_report(report), "r", encoding="utf-8") as fin:
+        assert len(list(csv.DictReader(fin))) == 4
+
+
+def test_tree_digests(tmp_path, monkeypatch, caplog):
+    scan_location = tmp_path / "scan"
+    # "a b" sorts between "a/x" and "a/z" as a string, not as a path
+    for folder in ("a", "a b", "a/deeper", "empty"):
+        (scan_location / folder).mkdir(parents=True)
+    for i, file in enumerate(("a/x.txt", "a/z.txt", "a b/y.txt", "a/deeper/w.txt", "top.txt", "a.txt")):
+        (scan_location / file).write_text(f"continent {i}")
+    copy_location = tmp_path / "copy"
+    shutil.copytree(scan_location, copy_location)
+
+    report = main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2, tree_digests=True)
+    with open(get_digests_file(report), "r", encoding="utf-8") as fin:
+        rows = list(csv.DictReader(fin))
+    # each folder before the folder it is in, the root last, the empty folder has no file so it is not in the report
+    assert [row["directory"] for row in rows] == ["a/deeper", "a", "a b", "."]
+    assert [(row["files"], row["bytes"]) for row in rows] == [("1", "11"), ("3", "33"), ("1", "11"), ("6", "66")]
+    root_digest = rows[-1]["digest"]
+
+    # the same for a copy, a default output report and an external sort
+    copy_report = main(copy_location, tmp_path / "copy_report.csv", "case1", simple_output=False, cores=2,
+                       tree_digests=True)
+    with open(get_digests_file(copy_report), "r", encoding="utf-8") as fin:
+        assert list(csv.DictReader(fin)) == rows
+    assert write_tree_digests(report, tmp_path / "sorted.digests.csv", simple_output=True, chunk_rows=2) == root_digest
+
+    # a relative scan location, the paths of the report are resolved
+    monkeypatch.chdir(tmp_path)
+    copy_report = main(pathlib.Path("copy"), tmp_path / "copy_report.csv", "case1", simple_output=False, cores=2,
+                       tree_digests=True)
+    with open(get_digests_file(copy_report), "r", encoding="utf-8") as fin:
+        assert list(csv.DictReader(fin)) == rows
+    # with none of the rows under the scan location there is no digest
+    with pytest.raises(ValueError, match="none of the 6 rows"):
+        write_tree_digests(copy_report, tmp_path / "outside.digests.csv", scan_location=scan_location)
+
+    # the rows with no relative path ("None") are not in the tree either, with none in the tree there is no digest
+    with open(report, "r", encoding="utf-8") as fin:
+        reader = csv.DictReader(fin)
+        fieldnames = reader.fieldnames
+        report_rows = list(reader)
+    for none_rows in (1, len(report_rows)):
+        for row in report_rows[:none_rows]:
+            row["relative-path"] = "None"
+        none_report = tmp_path / f"none_{none_rows}.csv"
+        with open(none_report, "w", encoding="utf-8") as fout:
+            csv_writer = csv.DictWriter(fout, fieldnames=fieldnames, quoting=csv.QUOTE_ALL, lineterminator="\n")
+            csv_writer.writeheader()
+            csv_writer.writerows(report_rows)
+        caplog.clear()
+        if none_rows < len(report_rows):
+            write_tree_digests(none_report, tmp_path / "none.digests.csv", simple_output=True)
+            assert "1 rows of" in caplog.text
+        else:
+            with pytest.raises(ValueError):
+                write_tree_digests(none_report, tmp_path / "none.digests.csv", simple_output=True)
+            assert not (tmp_path / "none.digests.csv").exists()
+
+    (copy_location / "a" / "deeper" / "w.txt").write_text("continent X")
+    (copy_location / "new").mkdir()
+    (copy_location / "new" / "v.txt").write_text("continent 7")
+    copy_report = main(copy_location, tmp_path / "copy_report.csv", "case1", simple_output=False, cores=2,
+                       tree_digests=True)
+    diff_report = tmp_path / "diff.csv"
+    counts = compare_tree_digests(get_digests_file(report), get_digests_file(copy_report), diff_report)
+    assert counts == {"added": 1, "removed": 0, "changed": 3, "unchanged": 1}
+    with open(diff_report, "r", encoding="utf-8") as fin:
+        changes = [(row["change"], row["directory"]) for row in csv.DictReader(fin)]
+    assert changes == [("changed", "."), ("changed", "a"), ("changed", "a/deeper"), ("added", "new")]
+
+
+def test_main_stats(tmp_path):
+    scan_location = tmp_path / "scan"
+    (scan_location / "sub").mkdir(parents=True)
+    sizes = [0, 10, 1000, 100_000, 20_000]
+    for i, size in enumerate(sizes):
+        (scan_location / ("sub" if i % 2 else "") / f"{i}.bin").write_bytes(b"x" * size)
+
+    stats_file = tmp_path / "stats.json"
+    main(scan_location, tmp_path / "a_report.csv", "case1", simple_output=True, cores=2, stats=stats_file)
+    with open(stats_file, "r", encoding="utf-8") as fin:
+        stats = json.load(fin)
+
+    assert stats["complete"]
+    assert stats["files"] == len(sizes)
+    assert stats["bytes read"] == sum(sizes)
+    assert {"walk", "stat", "read", "hash", "worker", "queue and ipc", "csv"} <= set(stats["stages"])
+    assert stats["stages"]["walk"]["files"] == len(sizes)
+    assert stats["stages"]["worker"]["files"] == len(sizes)
+    assert stats["stages"]["read"]["bytes"] == sum(sizes)
+    assert 0 < stats["worker utilisation"]
+    slowest = [file["seconds"] for file in stats["slowest files"]]
+    assert len(slowest) == len(sizes)
+    assert slowest == sorted(slowest, reverse=True)
+
+    result = get_file_and_hash_data(scan_location / "0.bin", "case1", simple_output=True)
+    assert stats_field not in result
+
+
 def test_files_exist():
     assert pathlib.Path(test_files_root).exists()
 
@@ -213,6 +1251,65 @@ def test_file_list():
     assert result_list_str == test_file_list_str
 
 
+@pytest.mark.parametrize("walk_threads", [1, 2, 8])
+def test_file_list_same_as_rglob(tmp_path, walk_threads):
+    for folder in ["a", "a/b", "a/b/c", "a/d", "e", "f/g/h"]:
+        (tmp_path / folder).mkdir(parents=True, exist_ok=True)
+        for i in range(3):
+            (tmp_path / folder / f"{i}.txt").write_text(f"{folder} {i}")
+    (tmp_path / "top.txt").write_text("top")
+    (tmp_path / "e" / "link-to-a").symlink_to(tmp_path / "a", target_is_directory=True)  # not followed
+    (tmp_path / "e" / "link-to-top.txt").symlink_to(tmp_path / "top.txt")  # a file
+
+    ref_list = [item for item in tmp_path.rglob("*") if item.is_file()]
+    assert list(get_file_list(tmp_path, walk_threads=walk_threads)) == ref_list
+    assert [entry.path for entry in walk_files(tmp_path, walk_threads)] == [str(item) for item in ref_list]
+    assert list(get_file_list(tmp_path, first_n_files=5, walk_threads=walk_threads)) == ref_list[:5]
+    assert list(get_file_list(tmp_path / "top.txt", walk_threads=walk_threads)) == [tmp_path / "top.txt"]
+
+
+def test_file_record_one_stat(tmp_path, monkeypatch):
+    p = tmp_path / "hello.txt"
+    p.write_text("conticontinet big snake")
+    size = p.stat().st_size
+    stat_calls = []
+    os_stat = os.stat
+
+    def counting_stat(*args, **kwargs):
+        stat_calls.append(args[0])
+        return os_stat(*args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+
+    for simple_output in [True, False]:
+        stat_calls.clear()
+        result = get_file_and_hash_data(p, "case1", simple_output, scan_location=tmp_path)
+        assert len(stat_calls) == 1
+        assert result["size"] == size
+
+        # the walk stat's the file, then there are no more stats
+        (record,) = list(get_file_list(tmp_path, file_records=True))
+        stat_calls.clear()
+        assert get_file_and_hash_data(record, "case1", simple_output, scan_location=tmp_path) == result
+        assert stat_calls == []
+
+
+def test_file_record(tmp_path):
+    p = tmp_path / "hello.txt"
+    p.write_text("continent")
+    record = FileRecord.from_path(p)
+    file_stat = p.stat()
+    assert (record.path, record.size, record.mtime_ns) == (p, 9, file_stat.st_mtime_ns)
+    assert record.cache_key() == (file_stat.st_dev, file_stat.st_ino, 9, file_stat.st_mtime_ns)
+    copy = pickle.loads(pickle.dumps(record))
+    assert [getattr(copy, name) for name in FileRecord.__slots__] == [
+        getattr(record, name) for name in FileRecord.__slots__
+    ]
+    result = get_file_and_hash_data(tmp_path / "missing.txt", "case1", True, scan_location=tmp_path)
+    assert result["relative-path"] == "missing.txt"
+    assert "No such file" in str(result["hash-error"])
+
+
 def test_get_file_size():
     """TODO: make this test not depend on the test files"""
     file = pathlib.Path(test_files_root) / rf"cam.ac~mgk25\grid-cyrillic-1.txt"